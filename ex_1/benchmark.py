@@ -0,0 +1,185 @@
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import timeit
+
+import numpy as np
+
+from flight_status import (
+    MINUTES_PER_DAY, check_flight_status, check_flight_status_batch, format_flight_status, monitor_arrivals
+)
+
+# Замеры скорости проверки статусов рейсов: check_flight_status по одному рейсу и пакетная обработка
+# на 1e3-1e7 рейсах. Для каждого замера берется лучшее время из --repeat повторов (timeit) и пересчитывается
+# в нс на рейс. Результат сравнивается с сохраненным замером (benchmark_baseline.json рядом с файлом);
+# при замедлении больше --tolerance программа завершается с кодом 1.
+#
+# Пример: python benchmark.py --sizes 1000,100000 --output results.json
+#         python benchmark.py --update-baseline
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json")
+# Количество рейсов в замерах по умолчанию
+DEFAULT_SIZES = (10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6, 10 ** 7)
+# Обработка по одной записи на 1e7 рейсах выполняется минуты и требует гигабайты памяти под строки Python,
+# поэтому такие замеры ограничены меньшим размером
+PER_RECORD_MAX_SIZE = 10 ** 5
+
+
+# Функция для формирования случайных пар времени ЧЧ:ММ
+def generate_times(size, seed=0):
+    rng = np.random.default_rng(seed)
+    times = np.array([f"{minute // 60:02d}:{minute % 60:02d}" for minute in range(MINUTES_PER_DAY)])
+    return times[rng.integers(0, MINUTES_PER_DAY, size)], times[rng.integers(0, MINUTES_PER_DAY, size)]
+
+
+# Замеряемые операции: название -> функция, получающая массивы времени и возвращающая функцию замера
+def scalar_case(schedule_times, actual_times):
+    pairs = list(zip(schedule_times.tolist(), actual_times.tolist()))
+    return lambda: [check_flight_status(schedule_time, actual_time) for schedule_time, actual_time in pairs]
+
+
+def scalar_window_case(schedule_times, actual_times):
+    pairs = list(zip(schedule_times.tolist(), actual_times.tolist()))
+    return lambda: [check_flight_status(schedule_time, actual_time, window=6) for schedule_time, actual_time in pairs]
+
+
+def batch_case(schedule_times, actual_times):
+    return lambda: check_flight_status_batch(schedule_times, actual_times)
+
+
+def batch_window_case(schedule_times, actual_times):
+    return lambda: check_flight_status_batch(schedule_times, actual_times, window=6)
+
+
+def batch_text_case(schedule_times, actual_times):
+    def function():
+        statuses, delays = check_flight_status_batch(schedule_times, actual_times)
+        return format_flight_status(delays, statuses)
+    return function
+
+
+def stream_case(schedule_times, actual_times):
+    pairs = list(zip(schedule_times.tolist(), actual_times.tolist()))
+    return lambda: sum(1 for _ in monitor_arrivals(pairs, size=10000, window=6))
+
+
+CASES = {
+    "scalar": scalar_case,
+    "scalar_window": scalar_window_case,
+    "batch": batch_case,
+    "batch_window": batch_window_case,
+    "batch_text": batch_text_case,
+    "stream": stream_case,
+}
+PER_RECORD_CASES = ("scalar", "scalar_window", "stream")
+
+
+# Функция для выполнения замеров. Возвращает словарь с результатом по каждому замеру "операция/размер"
+def run(cases, sizes, repeat, per_record_max_size):
+    results = {}
+    for size in sizes:
+        schedule_times, actual_times = generate_times(size)
+        for name in cases:
+            if name in PER_RECORD_CASES and size > per_record_max_size:
+                continue
+            timer = timeit.Timer(CASES[name](schedule_times, actual_times))
+            # Малые размеры выполняются несколько раз подряд (не меньше 0.2 с на повтор), чтобы снизить
+            # погрешность, большие повторяются меньше раз, чтобы замер занимал разумное время
+            number, _ = timer.autorange()
+            runs = max(1, min(repeat, 10 ** 7 // (size * number * (100 if name in PER_RECORD_CASES else 1))))
+            best = min(timer.repeat(repeat=runs, number=number)) / number
+            results[f"{name}/{size}"] = {
+                "case": name,
+                "size": size,
+                "best_s": best,
+                "ns_per_row": best / size * 1e9,
+                "rows_per_s": size / best,
+            }
+            print(f"{name:<15} {size:>10} {best * 1000:>12.3f} ms {best / size * 1e9:>10.1f} ns/row "
+                  f"{size / best:>14,.0f} rows/s", flush=True)
+    return results
+
+
+# Функция для сравнения результата с сохраненным замером.
+# Возвращает список замедлений: замеры, у которых время на рейс выросло больше допустимого
+def compare(results, baseline, tolerance):
+    slowdowns = []
+    for key, report in results.items():
+        old = baseline.get("results", {}).get(key)
+        if old is None or not old.get("ns_per_row"):
+            continue
+        change = report["ns_per_row"] / old["ns_per_row"] - 1
+        if change > tolerance:
+            slowdowns.append((key, old["ns_per_row"], report["ns_per_row"], change))
+    return slowdowns
+
+
+def parse_size(value):
+    return int(float(value))
+
+
+def parse_list(value, convert):
+    return [convert(item) for item in value.split(",") if item]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark of the flight status checks with a regression gate")
+    parser.add_argument("--sizes", type=lambda value: parse_list(value, parse_size),
+                        default=list(DEFAULT_SIZES), help="comma-separated numbers of flights, e.g. 1e3,1e5")
+    parser.add_argument("--cases", type=lambda value: parse_list(value, str), default=list(CASES),
+                        help=f"comma-separated cases (default: {','.join(CASES)})")
+    parser.add_argument("--repeat", type=int, default=5, help="timeit repeats, the best one is reported")
+    parser.add_argument("--per-record-max-size", type=parse_size, default=PER_RECORD_MAX_SIZE,
+                        help=f"largest size of the per-record cases ({', '.join(PER_RECORD_CASES)})")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--baseline", default=BASELINE_FILE, help="stored results to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.5,
+                        help="allowed relative growth of the time per flight (default 0.5 = 50%%)")
+    parser.add_argument("--update-baseline", action="store_true", help="store the results as the new baseline")
+    options = parser.parse_args(argv)
+    unknown = set(options.cases) - set(CASES)
+    if unknown:
+        parser.error(f"unknown cases: {', '.join(sorted(unknown))}")
+    return options
+
+
+def main(argv=None):
+    options = parse_args(argv)
+    result = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "repeat": options.repeat,
+        },
+        "results": run(options.cases, options.sizes, options.repeat, options.per_record_max_size),
+    }
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(result, f, indent=2)
+    if options.update_baseline:
+        with open(options.baseline, "w") as f:
+            json.dump(result, f, indent=2)
+        print(f"Baseline stored in {options.baseline}")
+        return 0
+
+    if not os.path.exists(options.baseline):
+        print(f"No baseline {options.baseline}, run with --update-baseline to store one")
+        return 0
+    with open(options.baseline) as f:
+        baseline = json.load(f)
+    slowdowns = compare(result["results"], baseline, options.tolerance)
+    for key, old, new, change in slowdowns:
+        print(f"Slowdown: {key} {old:.1f} -> {new:.1f} ns/row (+{change:.0%})")
+    if slowdowns:
+        return 1
+    print(f"No slowdowns against {options.baseline}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
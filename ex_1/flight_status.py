@@ -0,0 +1,781 @@
+import argparse
+import concurrent.futures
+import csv
+import io
+import itertools
+import json
+import mmap
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+# Проверка статуса прибытия самолетов по расписанию (первый кейс, red_soft_first_case.ipynb).
+# check_flight_status - проверка одного рейса, check_flight_status_batch - пакетная проверка массивов рейсов,
+# monitor_arrivals - потоковая обработка записей о прибытии со сводками по окну,
+# process_file - параллельная обработка большого файла, ResultsWriter и ResultsFile - хранение результатов по столбцам.
+
+MINUTES_PER_DAY = 24 * 60
+
+# Коды статуса рейса в пакетной обработке
+EARLY = -1
+ON_TIME = 0
+DELAYED = 1
+# Фактическое время вне окна расписания (режим window)
+UNKNOWN = 2
+# Запись файла с некорректным временем (обработка файлов)
+INVALID = 3
+
+UNKNOWN_STATUS_TEXT = "Статус рейса не определен: фактическое время вне окна расписания"
+INVALID_STATUS_TEXT = "Статус рейса не определен: некорректное время"
+
+
+# функция выбора суток прибытия для времени без даты
+def wrap_delay(delay, window):
+    '''
+    Приводит разницу фактического и планового времени прибытия к ближайшей: от -12 до +12 часов.
+
+    Параметры:
+    - delay (int | np.ndarray): Разница фактического и планового времени в минутах.
+    - window (float): Допустимое отклонение от расписания в часах (от 0 до 12).
+
+    Возвращаемое значение:
+    - tuple: Задержка в минутах (отрицательная - опережение) и признак попадания в окно ±window часов.
+    '''
+    if not 0 <= window <= 12:
+        raise ValueError("window must be between 0 and 12 hours")
+    half_day = MINUTES_PER_DAY // 2
+    # Ровно 12 часов разницы считаются опозданием
+    delay = half_day - (half_day - delay) % MINUTES_PER_DAY
+    return delay, abs(delay) <= window * 60
+
+
+# функция обработки фактического и запланированного времени прибытия самолёта
+def check_flight_status(schedule_time, actual_time, window=None):
+    '''
+    Проверяет статус прибытия самолета по расписанию.
+
+    Параметры:
+    - schedule_time (str | datetime): Время прибытия самолета по расписанию в формате ЧЧ:ММ
+      или полные дата и время.
+    - actual_time (str | datetime): Фактическое время прибытия самолета в аэропорт в формате ЧЧ:ММ
+      или полные дата и время.
+    - window (float | None): Для времени без даты - окно в часах: сутки фактического прибытия выбираются так,
+      чтобы оно было ближайшим к расписанию и отличалось от него не больше чем на window часов.
+      None - время сравнивается в пределах одних суток.
+
+    Возвращаемое значение:
+    - str: Текстовая информация о статусе рейса и времени задержки/опережения.
+    '''
+
+    # Преобразование строк в объекты datetime (полные дата и время используются как есть)
+    if isinstance(schedule_time, datetime) and isinstance(actual_time, datetime):
+        schedule_datetime, actual_datetime = schedule_time, actual_time
+        window = None
+    else:
+        schedule_datetime = datetime.strptime(schedule_time, '%H:%M')
+        actual_datetime = datetime.strptime(actual_time, '%H:%M')
+
+    # Выбор суток прибытия для времени без даты
+    if window is not None:
+        delay, in_window = wrap_delay((actual_datetime - schedule_datetime) // timedelta(minutes=1), window)
+        if not in_window:
+            return UNKNOWN_STATUS_TEXT
+        actual_datetime = schedule_datetime + timedelta(minutes=delay)
+
+    # Проверка статуса рейса
+    if actual_datetime > schedule_datetime:
+        delay = actual_datetime - schedule_datetime
+        return f"Самолет опаздывает. Задержка: {delay}"
+    elif actual_datetime < schedule_datetime:
+        ahead = schedule_datetime - actual_datetime
+        return f"Самолет прилетел раньше. Опережение: {ahead}"
+    else:
+        return "Самолет прилетел вовремя"
+
+
+# функция разбора кодов символов времени ЧЧ:ММ (по строке на значение, не меньше 6 столбцов, дополнение нулями).
+# Возвращает минуты от начала суток и признаки корректности значений.
+def _parse_codes(codes):
+    if (codes[:, 2] == ord(':')).all() and codes[:, 4].all() and not codes[:, 5:].any():
+        # Все значения из пяти символов с двоеточием посередине (ЧЧ:ММ): разбор без выбора варианта формата
+        digits = codes[:, [0, 1, 3, 4]].astype(np.int16) - ord('0')
+        hours = digits[:, 0] * 10 + digits[:, 1]
+        minutes = digits[:, 2] * 10 + digits[:, 3]
+        valid = ((digits >= 0) & (digits <= 9)).all(axis=1) & (hours <= 23) & (minutes <= 59)
+        return hours * 60 + minutes, valid
+
+    digits = codes[:, :5].astype(np.int16) - ord('0')
+    is_digit = (codes[:, :5] >= ord('0')) & (codes[:, :5] <= ord('9'))
+
+    # Двоеточие после одной (Ч:ММ) или двух (ЧЧ:ММ) цифр часов
+    colon_1 = codes[:, 1] == ord(':')
+    colon_2 = (codes[:, 2] == ord(':')) & is_digit[:, 1]
+    hours = np.where(colon_2, digits[:, 0] * 10 + digits[:, 1], digits[:, 0])
+    first = np.where(colon_2, digits[:, 3], digits[:, 2])
+    two_minutes = np.where(colon_2, is_digit[:, 4], is_digit[:, 3])
+    minutes = np.where(two_minutes, first * 10 + np.where(colon_2, digits[:, 4], digits[:, 3]), first)
+
+    valid = (
+        (colon_1 | colon_2) & is_digit[:, 0] & np.where(colon_2, is_digit[:, 3], is_digit[:, 2])
+        # После времени в строке нет других символов
+        & (np.count_nonzero(codes, axis=1) == 3 + colon_2 + two_minutes)
+        & (hours <= 23) & (minutes <= 59)
+    )
+    return hours * 60 + minutes, valid
+
+
+# функция преобразования массива строк ЧЧ:ММ в минуты от начала суток
+def parse_minutes(times):
+    '''
+    Преобразует строки времени в формате ЧЧ:ММ в количество минут от начала суток.
+
+    Принимает те же строки, что и datetime.strptime(..., '%H:%M'): часы и минуты из одной или двух цифр.
+    Строки разбираются арифметикой numpy над кодами символов, без вызова strptime для каждой строки.
+
+    Параметры:
+    - times (list | np.ndarray | pandas.Series): Строки времени.
+
+    Возвращаемое значение:
+    - np.ndarray (int16): Минуты от начала суток.
+    '''
+    array = np.asarray(times)
+    minutes, valid = _parse_strings(array)
+    if not valid.all():
+        value = array.reshape(-1)[np.argmin(valid)]
+        raise ValueError(f"time data {str(value)!r} does not match format '%H:%M'")
+    return minutes.reshape(array.shape)
+
+
+# функция разбора массива строк ЧЧ:ММ: возвращает минуты от начала суток и признаки корректности строк
+# (одномерные массивы)
+def _parse_strings(array):
+    if array.dtype.kind != 'U':
+        array = array.astype(str)
+    flat = array.reshape(-1)
+    # Коды символов строк: по столбцу на символ, короткие строки дополнены нулями
+    width = array.dtype.itemsize // 4
+    codes = np.ascontiguousarray(flat).view(np.uint32).reshape(-1, width)
+    if width < 6:
+        codes = np.pad(codes, ((0, 0), (0, 6 - width)))
+    minutes, valid = _parse_codes(codes)
+    # Строки с цифрами не из ASCII (их тоже принимает strptime) разбираются по одной
+    for index in np.flatnonzero(~valid & (codes > 127).any(axis=1)):
+        try:
+            parsed = datetime.strptime(flat[index], '%H:%M')
+        except ValueError:
+            continue
+        minutes[index] = parsed.hour * 60 + parsed.minute
+        valid[index] = True
+    return minutes, valid
+
+
+# функция приведения массива полных дат и времени к минутам (None - массив строк ЧЧ:ММ)
+def _as_timestamps(times):
+    array = np.asarray(times)
+    if array.dtype.kind == 'M' or (array.dtype.kind == 'O' and array.size
+                                   and isinstance(array.reshape(-1)[0], datetime)):
+        return array.astype('datetime64[m]')
+    return None
+
+
+# функция пакетной обработки фактического и запланированного времени прибытия самолётов
+def check_flight_status_batch(schedule_times, actual_times, window=None):
+    '''
+    Проверяет статусы прибытия самолетов по расписанию для массивов рейсов.
+
+    Параметры:
+    - schedule_times (list | np.ndarray | pandas.Series): Время прибытия по расписанию в формате ЧЧ:ММ
+      или полные дата и время (datetime, datetime64), точность - минута.
+    - actual_times (list | np.ndarray | pandas.Series): Фактическое время прибытия в том же виде.
+    - window (float | None): Для времени без даты - окно в часах, как в check_flight_status.
+
+    Возвращаемое значение:
+    - tuple(np.ndarray, np.ndarray): Коды статуса (int8: EARLY, ON_TIME, DELAYED, UNKNOWN - вне окна)
+      и задержка в минутах (положительная - опоздание, отрицательная - опережение;
+      int16 для времени без даты, int32 для полных дат).
+    '''
+    schedule = _as_timestamps(schedule_times)
+    actual = _as_timestamps(actual_times)
+    if schedule is not None and actual is not None:
+        delays = (actual - schedule).astype(np.int32)
+        return np.sign(delays).astype(np.int8), delays
+
+    return _evaluate(parse_minutes(schedule_times), parse_minutes(actual_times), window)
+
+
+# функция получения кодов статуса и задержек по минутам от начала суток
+def _evaluate(schedule_minutes, actual_minutes, window):
+    delays = actual_minutes - schedule_minutes
+    if window is None:
+        return np.sign(delays).astype(np.int8), delays
+    delays, in_window = wrap_delay(delays, window)
+    statuses = np.sign(delays).astype(np.int8)
+    statuses[~in_window] = UNKNOWN
+    return statuses, delays
+
+
+# Тексты результата для задержки в минутах
+def _status_text(delay):
+    if delay > 0:
+        return f"Самолет опаздывает. Задержка: {timedelta(minutes=delay)}"
+    elif delay < 0:
+        return f"Самолет прилетел раньше. Опережение: {timedelta(minutes=-delay)}"
+    return "Самолет прилетел вовремя"
+
+
+# Тексты для всех задержек в пределах суток: от -(24 * 60 - 1) до 24 * 60 - 1 минут
+STATUS_TEXTS = np.array([_status_text(delay) for delay in range(1 - MINUTES_PER_DAY, MINUTES_PER_DAY)],
+                        dtype=object)
+
+
+# функция получения текстов результата по задержкам пакетной обработки
+def format_flight_status(delays, statuses=None):
+    '''
+    Формирует тексты статусов рейсов, совпадающие с результатом check_flight_status.
+
+    Параметры:
+    - delays (np.ndarray): Задержки в минутах из check_flight_status_batch.
+    - statuses (np.ndarray | None): Коды статуса из check_flight_status_batch или process_file
+      (нужны для UNKNOWN и INVALID).
+
+    Возвращаемое значение:
+    - np.ndarray (object): Текстовая информация о статусе рейса и времени задержки/опережения.
+    '''
+    delays = np.asarray(delays)
+    within_day = np.abs(delays) < MINUTES_PER_DAY
+    if within_day.all():
+        texts = STATUS_TEXTS[delays + (MINUTES_PER_DAY - 1)]
+    else:
+        # Задержки больше суток бывают только у полных дат
+        texts = np.empty(delays.shape, dtype=object)
+        texts[within_day] = STATUS_TEXTS[delays[within_day] + (MINUTES_PER_DAY - 1)]
+        texts[~within_day] = [_status_text(int(delay)) for delay in delays[~within_day]]
+    if statuses is not None:
+        statuses = np.asarray(statuses)
+        texts[statuses == UNKNOWN] = UNKNOWN_STATUS_TEXT
+        texts[statuses == INVALID] = INVALID_STATUS_TEXT
+    return texts
+
+
+# функция потокового чтения записей о прибытии из CSV или NDJSON
+def read_arrivals(lines, file_format='csv'):
+    '''
+    Читает записи о прибытии по одной, не загружая поток в память.
+
+    Параметры:
+    - lines (Iterable[str]): Строки потока (файл, sys.stdin или генератор строк).
+    - file_format (str): 'csv' (столбцы schedule_time и actual_time) или 'ndjson' (объект JSON в строке).
+
+    Возвращаемое значение:
+    - Iterator[tuple]: Пары (время по расписанию, фактическое время) в формате ЧЧ:ММ.
+    '''
+    if file_format != 'ndjson':
+        for record in csv.DictReader(lines):
+            yield record.get('schedule_time'), record.get('actual_time')
+        return
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            record = None
+        # Некорректная строка передается дальше и отклоняется при проверке времени
+        if not isinstance(record, dict):
+            record = {}
+        yield record.get('schedule_time'), record.get('actual_time')
+
+
+# Статистика задержек рейсов
+class DelayTotals:
+    '''
+    Хранит количество рейсов по кодам статуса, сумму и гистограмму задержек,
+    поэтому процентили вычисляются без сортировки, а статистики частей потока или файла складываются.
+    '''
+
+    def __init__(self, percentiles=(50, 90, 99)):
+        self.percentiles = percentiles
+        # Количество рейсов по кодам статуса EARLY, ON_TIME, DELAYED, UNKNOWN, INVALID (индекс - код + 1)
+        self.status_counts = np.zeros(5, dtype=np.int64)
+        # Гистограмма задержек рейсов с известным статусом (индекс - задержка + 24 * 60). Задержки
+        # и опережения полных дат на сутки и больше учитываются в крайних ячейках
+        self.histogram = np.zeros(2 * MINUTES_PER_DAY + 1, dtype=np.int64)
+        self.delay_sum = 0
+
+    def _count(self, statuses, delays, sign):
+        known = np.abs(statuses) <= DELAYED
+        known_delays = delays[known]
+        self.status_counts += sign * np.bincount(statuses + 1, minlength=5)
+        self.histogram += sign * np.bincount(np.clip(known_delays, -MINUTES_PER_DAY, MINUTES_PER_DAY)
+                                             + MINUTES_PER_DAY, minlength=len(self.histogram))
+        self.delay_sum += sign * int(known_delays.sum(dtype=np.int64))
+
+    def add(self, statuses, delays):
+        self._count(statuses, delays, 1)
+
+    def merge(self, other):
+        self.status_counts += other.status_counts
+        self.histogram += other.histogram
+        self.delay_sum += other.delay_sum
+
+    def clear(self):
+        self.status_counts[:] = 0
+        self.histogram[:] = 0
+        self.delay_sum = 0
+
+    def summary(self):
+        early, on_time, delayed, unknown, _ = (int(count) for count in self.status_counts)
+        known = early + on_time + delayed
+        result = {
+            'flights': known + unknown,
+            'on_time_pct': round(100 * on_time / known, 2) if known else None,
+            'early': early,
+            'delayed': delayed,
+            'unknown': unknown,
+            'mean_delay': round(self.delay_sum / known, 2) if known else None,
+        }
+        # Процентиль по рангу: наименьшая задержка, которой не превышают задержки q% рейсов.
+        # Процентили в крайних ячейках гистограммы выводятся как -24 * 60 и 24 * 60 (сутки и больше)
+        cumulative = np.cumsum(self.histogram)
+        for q in self.percentiles:
+            rank = max(1, -(-q * known // 100))
+            index = int(np.searchsorted(cumulative, rank))
+            result[f'p{q}_delay'] = index - MINUTES_PER_DAY if known else None
+        return result
+
+
+# Скользящая статистика задержек по последним size рейсам
+class RollingDelays(DelayTotals):
+    '''
+    Хранит статусы и задержки последних size рейсов в кольцевом буфере,
+    поэтому память не зависит от длины потока.
+    '''
+
+    def __init__(self, size, percentiles=(50, 90, 99)):
+        super().__init__(percentiles)
+        self.size = size
+        self.statuses = np.zeros(size, dtype=np.int8)
+        # int32: задержки полных дат не помещаются в int16
+        self.delays = np.zeros(size, dtype=np.int32)
+        self.count = 0
+        self.position = 0
+
+    def add(self, statuses, delays):
+        # Пакет больше окна: в окно попадают только последние size рейсов
+        statuses = statuses[-self.size:]
+        delays = delays[-self.size:]
+        positions = (self.position + np.arange(len(delays))) % self.size
+        # Свободные ячейки буфера идут первыми, остальные ячейки заняты самыми старыми рейсами
+        free = self.size - self.count
+        if len(delays) > free:
+            old = positions[free:]
+            self._count(self.statuses[old], self.delays[old], -1)
+        self.statuses[positions] = statuses
+        self.delays[positions] = delays
+        self._count(statuses, delays, 1)
+        self.position = (self.position + len(delays)) % self.size
+        self.count = min(self.count + len(delays), self.size)
+
+    def clear(self):
+        super().clear()
+        self.count = 0
+        self.position = 0
+
+
+# функция пакетной обработки части потока с пропуском некорректных записей
+def _check_chunk(chunk, window):
+    schedule_times, actual_times = zip(*chunk)
+    if isinstance(schedule_times[0], datetime) and isinstance(actual_times[0], datetime):
+        return check_flight_status_batch(schedule_times, actual_times, window=window) + (0,)
+    # Часть потока разбирается один раз: некорректные записи (поле не строка ЧЧ:ММ, нет поля в NDJSON)
+    # отбрасываются по признакам корректности разбора, без повторной проверки записей по одной
+    fields = []
+    for times in (schedule_times, actual_times):
+        fields.append(_parse_strings(np.array([value if isinstance(value, str) else '' for value in times])))
+    (schedule_minutes, schedule_valid), (actual_minutes, actual_valid) = fields
+    valid = schedule_valid & actual_valid
+    statuses, delays = _evaluate(schedule_minutes[valid], actual_minutes[valid], window)
+    return statuses, delays, len(chunk) - int(np.count_nonzero(valid))
+
+
+# функция потоковой обработки прибытий со сводками по окну
+def monitor_arrivals(arrivals, size=10000, step=None, window=None, percentiles=(50, 90, 99)):
+    '''
+    Обрабатывает поток записей о прибытии и выдает сводки по последним size рейсам.
+
+    Память не зависит от длины потока: записи читаются частями по step штук и обрабатываются
+    check_flight_status_batch, а статистика окна хранится в RollingDelays.
+
+    Параметры:
+    - arrivals (Iterable[tuple]): Пары (время по расписанию, фактическое время), например из read_arrivals.
+    - size (int): Размер окна в рейсах.
+    - step (int | None): Через сколько рейсов выдавать сводку. None или size - неперекрывающиеся окна,
+      меньше size - скользящее окно.
+    - window (float | None): Окно в часах для времени без даты, как в check_flight_status.
+    - percentiles (tuple): Процентили задержки в сводке.
+
+    Возвращаемое значение:
+    - Iterator[dict]: Сводки: статистика окна, всего обработано и отклонено записей, скорость в записях в секунду.
+    '''
+    step = step or size
+    if not 0 < step <= size:
+        raise ValueError("step must be between 1 and size")
+    stats = RollingDelays(size, percentiles)
+    records = rejected = 0
+    started = time.perf_counter()
+    arrivals = iter(arrivals)
+    while True:
+        chunk = list(itertools.islice(arrivals, step))
+        if not chunk:
+            break
+        statuses, delays, invalid = _check_chunk(chunk, window)
+        if step == size:
+            stats.clear()
+        stats.add(statuses, delays)
+        records += len(chunk)
+        rejected += invalid
+        elapsed = time.perf_counter() - started
+        yield dict(stats.summary(), records=records, rejected=rejected,
+                   records_per_sec=round(records / elapsed) if elapsed > 0 else None)
+
+
+# Размер части файла для параллельной обработки по умолчанию (в байтах): части в несколько мегабайт
+# обрабатываются быстрее больших, так как промежуточные массивы помещаются в кэш процессора
+CHUNK_SIZE = 4 * 1024 * 1024
+# Наибольшая длина поля времени, которую имеет смысл разбирать (ЧЧ:ММ и один лишний символ)
+FIELD_WIDTH = 6
+
+
+# функция извлечения поля каждой строки части файла в виде кодов символов (по строке на запись)
+def _field_codes(data, starts, ends):
+    widths = ends - starts
+    codes = np.zeros((len(starts), FIELD_WIDTH), dtype=np.uint8)
+    last = len(data) - 1
+    for offset in range(FIELD_WIDTH):
+        codes[:, offset] = np.where(widths > offset, data[np.minimum(starts + offset, last)], 0)
+    return codes
+
+
+# функция разбора поля по одной записи для значений не из ASCII (их тоже принимает strptime)
+def _parse_non_ascii(data, starts, ends, minutes, valid):
+    for index in np.flatnonzero(~valid):
+        value = bytes(data[starts[index]:ends[index]])
+        if value.isascii():
+            continue
+        try:
+            minutes[index] = parse_minutes(value.decode('utf-8'))
+        except (UnicodeDecodeError, ValueError):
+            continue
+        valid[index] = True
+
+
+# функция разбора части файла CSV: возвращает минуты по расписанию, фактические минуты и признаки корректности
+# для каждой непустой строки части
+def _parse_csv_chunk(data, columns, column_count):
+    fields = []
+    for starts, ends, well_formed in _field_bounds(data, columns, column_count):
+        minutes, valid = _parse_codes(_field_codes(data, starts, ends))
+        if not valid.all():
+            _parse_non_ascii(data, starts, ends, minutes, valid)
+        fields.append((minutes, valid & well_formed))
+    (schedule_minutes, schedule_valid), (actual_minutes, actual_valid) = fields
+    return schedule_minutes, actual_minutes, schedule_valid & actual_valid
+
+
+# функция поиска полей строк части файла CSV: для каждого столбца из columns - начала и концы полей
+# и признаки строк с правильным количеством полей
+def _field_bounds(data, columns, column_count):
+    # Разделители по порядку: в правильной строке column_count - 1 запятых и перевод строки
+    separators = np.flatnonzero((data == ord(',')) | (data == ord('\n')))
+    line_end = data[separators] == ord('\n')
+    if len(data) and data[-1] != ord('\n'):
+        separators = np.append(separators, len(data))
+        line_end = np.append(line_end, True)
+    if (len(separators) % column_count == 0 and line_end[column_count - 1::column_count].all()
+            and np.count_nonzero(line_end) == len(separators) // column_count):
+        # Все строки правильные: разделители строки образуют строку таблицы
+        bounds = separators.reshape(-1, column_count)
+        line_starts = np.concatenate(([0], bounds[:, -1] + 1))[:len(bounds)]
+        well_formed = np.ones(len(bounds), dtype=bool)
+    else:
+        line_ends = separators[line_end]
+        line_starts = np.concatenate(([0], line_ends + 1))[:len(line_ends)]
+        # Пустые строки пропускаются
+        not_empty = (line_ends > line_starts) & ~((line_ends == line_starts + 1)
+                                                  & (data[np.minimum(line_starts, len(data) - 1)] == ord('\r')))
+        line_starts, line_ends = line_starts[not_empty], line_ends[not_empty]
+        commas = separators[~line_end]
+        comma_lines = np.searchsorted(line_ends, commas)
+        well_formed = np.bincount(comma_lines, minlength=len(line_starts)) == column_count - 1
+        # Таблица разделителей правильных строк; строки с другим количеством запятых получают пустые поля
+        bounds = np.zeros((len(line_starts), column_count), dtype=np.intp)
+        bounds[:, -1] = line_ends
+        first_commas = np.searchsorted(comma_lines, np.flatnonzero(well_formed))
+        for column in range(column_count - 1):
+            bounds[well_formed, column] = commas[first_commas + column]
+        bounds[~well_formed] = line_starts[~well_formed, None]
+
+    for column in columns:
+        starts = line_starts if column == 0 else bounds[:, column - 1] + 1
+        ends = bounds[:, column]
+        if column == column_count - 1:
+            # Окончание строки \r\n (файлы Windows)
+            ends = ends - ((ends > starts) & (data[np.maximum(ends - 1, 0)] == ord('\r')))
+        yield starts, ends, well_formed
+
+
+# функция разбора части файла с кавычками модулем csv (значения в кавычках могут содержать запятые,
+# но не переводы строк: части файла делятся по строкам)
+def _parse_quoted_chunk(data, columns, column_count):
+    rows = [row for row in csv.reader(io.StringIO(bytes(data).decode('utf-8', errors='replace'), newline=''))
+            if row]
+    well_formed = np.array([len(row) == column_count for row in rows], dtype=bool)
+    fields = [_parse_strings(np.array([row[column] if column < len(row) else '' for row in rows], dtype=str))
+              for column in columns]
+    (schedule_minutes, schedule_valid), (actual_minutes, actual_valid) = fields
+    return schedule_minutes, actual_minutes, well_formed & schedule_valid & actual_valid
+
+
+# Задача рабочего процесса: обработка части файла [start, end) с выравниванием границ по строкам.
+# Строка относится к части, в которой находится ее первый байт.
+def _process_chunk(task):
+    path, start, end, data_start, columns, column_count, window, percentiles, keep_results = task
+    with open(path, 'rb') as file:
+        mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        if start > data_start:
+            start = mapped.find(b'\n', start - 1) + 1 or len(mapped)
+        if end < len(mapped):
+            end = mapped.find(b'\n', end - 1) + 1 or len(mapped)
+        return _process_data(mapped, start, max(start, end), columns, column_count, window, percentiles,
+                             keep_results)
+    finally:
+        try:
+            mapped.close()
+        except BufferError:
+            # Массивы из трассировки исключения еще ссылаются на отображение: его закроет сборщик мусора
+            pass
+
+
+# Обработка байтов части файла. Массивы numpy ссылаются на отображение файла в память только внутри функции,
+# поэтому после возврата отображение можно закрыть.
+def _process_data(mapped, start, end, columns, column_count, window, percentiles, keep_results):
+    data = np.frombuffer(mapped, dtype=np.uint8, count=end - start, offset=start)
+    if (data == ord('"')).any():
+        schedule_minutes, actual_minutes, valid = _parse_quoted_chunk(data, columns, column_count)
+    else:
+        schedule_minutes, actual_minutes, valid = _parse_csv_chunk(data, columns, column_count)
+    statuses, delays = _evaluate(schedule_minutes, actual_minutes, window)
+    statuses[~valid] = INVALID
+    delays[~valid] = 0
+    totals = DelayTotals(percentiles)
+    totals.add(statuses, delays)
+    return totals, (statuses, delays) if keep_results else None
+
+
+# функция чтения заголовка файла CSV: номера столбцов schedule_time и actual_time, количество столбцов
+# и смещение первой записи
+def _read_header(path):
+    with open(path, 'rb') as file:
+        header = file.readline()
+    names = next(csv.reader([header.decode('utf-8-sig').rstrip('\r\n')]), [])
+    if 'schedule_time' not in names or 'actual_time' not in names:
+        raise ValueError(f"{path}: the CSV header must contain schedule_time and actual_time")
+    return (names.index('schedule_time'), names.index('actual_time')), len(names), len(header)
+
+
+# функция параллельной обработки большого файла CSV
+def process_file(path, workers=None, chunk_size=CHUNK_SIZE, window=None, percentiles=(50, 90, 99),
+                 on_chunk=None):
+    '''
+    Проверяет статусы всех рейсов файла CSV (столбцы schedule_time и actual_time) в нескольких процессах.
+
+    Файл делится на части по chunk_size байт, границы которых выравниваются по строкам. Рабочие процессы
+    читают свои части через отображение файла в память (mmap), разбирают их арифметикой numpy и возвращают
+    статистику части (DelayTotals), а при on_chunk - еще коды статуса и задержки записей. Результаты
+    объединяются в порядке частей файла.
+
+    Параметры:
+    - path (str): Путь к файлу CSV.
+    - workers (int | None): Количество рабочих процессов (None - по количеству ядер, 1 - без процессов).
+    - chunk_size (int): Размер части файла в байтах.
+    - window (float | None): Окно в часах для времени без даты, как в check_flight_status.
+    - percentiles (tuple): Процентили задержки в сводке.
+    - on_chunk (Callable | None): Функция, получающая коды статуса (int8, INVALID - некорректная запись)
+      и задержки (int16) записей каждой части в порядке файла.
+
+    Возвращаемое значение:
+    - dict: Сводка по всем рейсам файла, количество записей, отклоненных записей, частей и скорость в записях в секунду.
+    '''
+    if window is not None:
+        wrap_delay(0, window)
+    started = time.perf_counter()
+    columns, column_count, data_start = _read_header(path)
+    size = os.path.getsize(path)
+    tasks = [(path, start, min(start + chunk_size, size), data_start, columns, column_count, window, percentiles,
+              on_chunk is not None) for start in range(data_start, size, chunk_size)]
+    totals = DelayTotals(percentiles)
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(tasks) <= 1:
+        results = map(_process_chunk, tasks)
+        executor = None
+    else:
+        executor = concurrent.futures.ProcessPoolExecutor(min(workers, len(tasks)))
+        results = executor.map(_process_chunk, tasks)
+    try:
+        for chunk_totals, chunk_results in results:
+            totals.merge(chunk_totals)
+            if on_chunk is not None:
+                on_chunk(*chunk_results)
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+    elapsed = time.perf_counter() - started
+    records = int(totals.status_counts.sum())
+    return dict(totals.summary(), records=records, rejected=int(totals.status_counts[INVALID + 1]),
+                chunks=len(tasks), records_per_sec=round(records / elapsed) if elapsed > 0 else None)
+
+
+# Столбцы файла результатов: имя -> тип значений
+RESULT_COLUMNS = {'status': np.int8, 'delay': np.int16}
+# Количество записей, обрабатываемых за раз при подсчете статистики по файлу результатов
+RESULTS_BLOCK_SIZE = 1024 * 1024
+
+
+# Запись результатов проверки рейсов в файлы .npy по столбцам
+class ResultsWriter:
+    '''
+    Записывает коды статуса (int8) и задержки в минутах (int16, для полных дат - до 22 суток) в каталог path:
+    столбец status.npy и delay.npy, 3 байта на рейс вместо текста статуса. Результаты дописываются частями
+    (add подходит как on_chunk для process_file), количество записей в заголовках .npy обновляется при close.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+        os.makedirs(path, exist_ok=True)
+        self.files = {name: open(os.path.join(path, f'{name}.npy'), 'wb') for name in RESULT_COLUMNS}
+        for name, file in self.files.items():
+            self._write_header(file, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _write_header(self, file, name):
+        # Заголовок .npy оставляет место для роста количества записей, поэтому его можно перезаписать на месте
+        np.lib.format.write_array_header_1_0(file, {
+            'descr': np.lib.format.dtype_to_descr(np.dtype(RESULT_COLUMNS[name])),
+            'fortran_order': False,
+            'shape': (self.count,),
+        })
+
+    def add(self, statuses, delays):
+        statuses = np.asarray(statuses)
+        delays = np.asarray(delays)
+        if statuses.shape != delays.shape or statuses.ndim != 1:
+            raise ValueError("statuses and delays must be one-dimensional arrays of the same length")
+        if len(delays) and not -2 ** 15 <= delays.min() <= delays.max() < 2 ** 15:
+            raise ValueError("delays must fit into int16")
+        self.files['status'].write(statuses.astype(np.int8).tobytes())
+        self.files['delay'].write(delays.astype(np.int16).tobytes())
+        self.count += len(delays)
+
+    def close(self):
+        for name, file in self.files.items():
+            if file.closed:
+                continue
+            file.seek(0)
+            self._write_header(file, name)
+            file.close()
+
+
+# Результаты проверки рейсов из файлов .npy без загрузки в память
+class ResultsFile:
+    '''
+    Открывает столбцы, записанные ResultsWriter, через отображение в память (np.load с mmap_mode):
+    срезы и выборки читают с диска только нужные записи, а тексты статусов формируются только по запросу.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.statuses = np.load(os.path.join(path, 'status.npy'), mmap_mode='r')
+        self.delays = np.load(os.path.join(path, 'delay.npy'), mmap_mode='r')
+        if self.statuses.shape != self.delays.shape:
+            raise ValueError(f"{path}: status.npy and delay.npy have different lengths")
+
+    def __len__(self):
+        return len(self.statuses)
+
+    def totals(self, start=0, stop=None, percentiles=(50, 90, 99)):
+        # Статистика записей [start, stop) считается блоками, поэтому память не зависит от размера файла
+        start, stop, _ = slice(start, stop).indices(len(self))
+        totals = DelayTotals(percentiles)
+        for position in range(start, stop, RESULTS_BLOCK_SIZE):
+            end = min(position + RESULTS_BLOCK_SIZE, stop)
+            totals.add(np.asarray(self.statuses[position:end]), np.asarray(self.delays[position:end]))
+        return totals
+
+    def find(self, status):
+        # Номера записей с кодом статуса status
+        return np.concatenate([np.flatnonzero(self.statuses[position:position + RESULTS_BLOCK_SIZE] == status)
+                               + position for position in range(0, len(self), RESULTS_BLOCK_SIZE)]
+                              or [np.zeros(0, dtype=np.intp)])
+
+    def texts(self, indices):
+        # Тексты статусов для среза или номеров записей, как у check_flight_status
+        return format_flight_status(self.delays[indices], self.statuses[indices])
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Rolling delay statistics of a stream of flight arrivals")
+    parser.add_argument("file", nargs="?", default="-", help="CSV or NDJSON file with schedule_time and actual_time "
+                                                             "('-' for stdin, default)")
+    parser.add_argument("--format", choices=("csv", "ndjson"), help="default: by file extension, csv for stdin")
+    parser.add_argument("--size", type=int, default=10000, help="window size in flights")
+    parser.add_argument("--step", type=int, help="flights between summaries (default: --size, tumbling windows)")
+    parser.add_argument("--window", type=float, help="hours around the schedule for times without a date")
+    parser.add_argument("--workers", type=int,
+                        help="summarize the whole CSV file in this many processes instead of streaming (0: all cores)")
+    parser.add_argument("--chunk-size", type=float, default=CHUNK_SIZE / 1024 / 1024,
+                        help="size of the file chunks of --workers in MiB")
+    parser.add_argument("--output", help="with --workers: directory for the status and delay columns (.npy)")
+    args = parser.parse_args(argv)
+    if args.workers is not None and (args.file == "-" or args.format == "ndjson"):
+        parser.error("--workers needs a CSV file")
+    if args.output and args.workers is None:
+        parser.error("--output needs --workers")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.workers is not None:
+        writer = ResultsWriter(args.output) if args.output else None
+        try:
+            summary = process_file(args.file, args.workers or None, max(1, int(args.chunk_size * 1024 * 1024)),
+                                   args.window, on_chunk=writer and writer.add)
+        finally:
+            if writer is not None:
+                writer.close()
+        print(json.dumps(summary))
+        return 0
+    file_format = args.format or ("ndjson" if args.file.lower().endswith((".ndjson", ".jsonl")) else "csv")
+    stream = sys.stdin if args.file == "-" else open(args.file, encoding="utf-8", newline="")
+    try:
+        # Сводки выводятся строками JSON по мере обработки потока
+        for summary in monitor_arrivals(read_arrivals(stream, file_format), args.size, args.step, args.window):
+            print(json.dumps(summary), flush=True)
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
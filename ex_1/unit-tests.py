@@ -0,0 +1,312 @@
+import io
+import os
+import tempfile
+import unittest
+from datetime import datetime
+
+import numpy as np
+
+import benchmark
+from flight_status import (
+    EARLY, ON_TIME, DELAYED, UNKNOWN, INVALID, UNKNOWN_STATUS_TEXT, INVALID_STATUS_TEXT, DelayTotals,
+    ResultsFile, ResultsWriter, RollingDelays, check_flight_status, check_flight_status_batch, format_flight_status,
+    monitor_arrivals, parse_minutes, process_file, read_arrivals, wrap_delay
+)
+
+ALL_TIMES = [f"{hour:02d}:{minute:02d}" for hour in range(24) for minute in range(60)]
+
+
+class TestCheckFlightStatus(unittest.TestCase):
+
+    # Тесты №1-5 из red_soft_first_case.ipynb
+    def test_notebook_cases(self):
+        cases = [
+            ("15:30", "15:30", "Самолет прилетел вовремя"),
+            ("18:00", "15:40", "Самолет прилетел раньше. Опережение: 2:20:00"),
+            ("13:30", "15:59", "Самолет опаздывает. Задержка: 2:29:00"),
+            ("00:00", "23:59", "Самолет опаздывает. Задержка: 23:59:00"),
+            ("22:45", "01:00", "Самолет прилетел раньше. Опережение: 21:45:00"),
+        ]
+        for schedule_time, actual_time, expected in cases:
+            with self.subTest(schedule_time=schedule_time, actual_time=actual_time):
+                self.assertEqual(check_flight_status(schedule_time, actual_time), expected)
+
+    def test_short_fields_and_invalid_times(self):
+        self.assertEqual(check_flight_status("9:05", "09:5"), "Самолет прилетел вовремя")
+        self.assertEqual(check_flight_status("00:00", "00:01"), "Самолет опаздывает. Задержка: 0:01:00")
+        for value in ("24:00", "12:60", "12-30", "", "12:30 ", "1230"):
+            with self.subTest(value=value), self.assertRaises(ValueError):
+                check_flight_status(value, "12:00")
+
+    def test_window_wraps_around_midnight(self):
+        self.assertEqual(check_flight_status("00:00", "23:59", window=6), "Самолет прилетел раньше. Опережение: 0:01:00")
+        self.assertEqual(check_flight_status("22:45", "01:00", window=6), "Самолет опаздывает. Задержка: 2:15:00")
+        self.assertEqual(check_flight_status("12:00", "01:00", window=6), UNKNOWN_STATUS_TEXT)
+        # Ровно 12 часов разницы - опоздание
+        self.assertEqual(check_flight_status("00:00", "12:00", window=12), "Самолет опаздывает. Задержка: 12:00:00")
+        with self.assertRaises(ValueError):
+            check_flight_status("00:00", "12:00", window=13)
+
+    def test_full_timestamps(self):
+        self.assertEqual(check_flight_status(datetime(2024, 3, 1, 22, 45), datetime(2024, 3, 2, 1, 0)),
+                         "Самолет опаздывает. Задержка: 2:15:00")
+        self.assertEqual(check_flight_status(datetime(2024, 3, 1, 10, 0), datetime(2024, 3, 3, 11, 30), window=6),
+                         "Самолет опаздывает. Задержка: 2 days, 1:30:00")
+
+    def test_wrap_delay(self):
+        delays, in_window = wrap_delay(np.array([-1439, -720, -1, 0, 1, 719, 720, 721, 1439]), 6)
+        self.assertEqual(delays.tolist(), [1, 720, -1, 0, 1, 719, 720, -719, -1])
+        self.assertEqual(in_window.tolist(), [True, False, True, True, True, False, False, False, True])
+        self.assertEqual(wrap_delay(-1305, 3), (135, True))
+
+
+class TestCheckFlightStatusBatch(unittest.TestCase):
+
+    def assert_same_as_scalar(self, schedule_times, actual_times, window=None):
+        statuses, delays = check_flight_status_batch(schedule_times, actual_times, window=window)
+        expected = [check_flight_status(schedule_time, actual_time, window=window)
+                    for schedule_time, actual_time in zip(schedule_times, actual_times)]
+        self.assertEqual(format_flight_status(delays, statuses).tolist(), expected)
+        return statuses, delays
+
+    def test_notebook_cases(self):
+        statuses, delays = self.assert_same_as_scalar(["15:30", "18:00", "13:30", "00:00", "22:45"],
+                                                      ["15:30", "15:40", "15:59", "23:59", "01:00"])
+        self.assertEqual(statuses.tolist(), [ON_TIME, EARLY, DELAYED, DELAYED, EARLY])
+        self.assertEqual(delays.tolist(), [0, -140, 149, 1439, -1305])
+        self.assertEqual((statuses.dtype, delays.dtype), (np.int8, np.int16))
+
+    def test_same_as_scalar(self):
+        rng = np.random.default_rng(0)
+        schedule_times = rng.choice(ALL_TIMES, 20000).tolist()
+        actual_times = rng.choice(ALL_TIMES, 20000).tolist()
+        for window in (None, 0, 2.5, 12):
+            with self.subTest(window=window):
+                statuses, _ = self.assert_same_as_scalar(schedule_times, actual_times, window)
+                self.assertEqual(window is not None and window < 12, bool((statuses == UNKNOWN).any()))
+
+    def test_parse_accepts_what_strptime_accepts(self):
+        values = ["0:0", "1:05", "01:5", "23:59", "٣:00", "24:00", "12:60", "1::0", ":10", "12:345", "12:3a",
+                  " 1:00", "1:00 ", "", "abc", "１:00"]
+        for value in values:
+            try:
+                parsed = datetime.strptime(value, '%H:%M')
+                expected = parsed.hour * 60 + parsed.minute
+            except ValueError:
+                expected = None
+            with self.subTest(value=value):
+                if expected is None:
+                    with self.assertRaises(ValueError):
+                        parse_minutes([value])
+                else:
+                    self.assertEqual(parse_minutes([value]).tolist(), [expected])
+
+    def test_shapes_and_errors(self):
+        self.assertEqual(parse_minutes("7:05"), 425)
+        self.assertEqual(parse_minutes(np.array([["00:00", "23:59"]])).tolist(), [[0, 1439]])
+        self.assertEqual(parse_minutes([]).tolist(), [])
+        with self.assertRaisesRegex(ValueError, "'25:00'"):
+            check_flight_status_batch(["10:00", "12:00"], ["11:00", "25:00"])
+
+    def test_full_timestamps(self):
+        schedule_times = [datetime(2024, 3, 1, 22, 45), datetime(2024, 3, 1, 10, 0), datetime(2024, 3, 1, 10, 0)]
+        actual_times = [datetime(2024, 3, 2, 1, 0), datetime(2024, 3, 3, 11, 30), datetime(2024, 2, 29, 10, 0)]
+        statuses, delays = self.assert_same_as_scalar(schedule_times, actual_times)
+        self.assertEqual(delays.tolist(), [135, 2970, -1440])
+        statuses, delays = check_flight_status_batch(np.array(schedule_times, dtype='datetime64[m]'),
+                                                     np.array(actual_times, dtype='datetime64[m]'))
+        self.assertEqual(statuses.tolist(), [DELAYED, DELAYED, EARLY])
+
+
+class TestMonitorArrivals(unittest.TestCase):
+
+    def test_read_arrivals(self):
+        csv_stream = io.StringIO("schedule_time,actual_time\n22:45,01:00\n00:00,23:59\n")
+        self.assertEqual(list(read_arrivals(csv_stream)), [("22:45", "01:00"), ("00:00", "23:59")])
+        ndjson_lines = ['{"schedule_time": "10:00", "actual_time": "10:05"}\n', "not json\n", "\n", "[1]\n"]
+        self.assertEqual(list(read_arrivals(ndjson_lines, "ndjson")), [("10:00", "10:05"), (None, None), (None, None)])
+
+    def test_rolling_window_matches_recomputation(self):
+        rng = np.random.default_rng(1)
+        statuses, delays = check_flight_status_batch(rng.choice(ALL_TIMES, 3000), rng.choice(ALL_TIMES, 3000), 6)
+        stats = RollingDelays(1000, percentiles=(50, 90))
+        for end in range(7, 3001, 7):
+            stats.add(statuses[end - 7:end], delays[end - 7:end])
+            window_statuses = statuses[max(0, end - 1000):end]
+            known = np.sort(delays[max(0, end - 1000):end][window_statuses != UNKNOWN]).astype(int)
+            summary = stats.summary()
+            self.assertEqual(summary["flights"], len(window_statuses))
+            self.assertEqual(summary["unknown"], np.count_nonzero(window_statuses == UNKNOWN))
+            self.assertEqual(summary["early"], np.count_nonzero(window_statuses == EARLY))
+            self.assertAlmostEqual(summary["mean_delay"], known.mean(), places=2)
+            self.assertEqual(summary["p50_delay"], known[-(-50 * len(known) // 100) - 1])
+            self.assertEqual(summary["p90_delay"], known[-(-90 * len(known) // 100) - 1])
+
+    def test_delays_of_a_day_and_more(self):
+        # Полные даты: задержки и опережения на сутки и больше попадают в крайние ячейки гистограммы
+        schedule = np.array(["2024-01-01T22:45", "2024-01-05T10:00", "2024-01-01T10:00", "2024-01-01T10:00"],
+                            dtype="datetime64[m]")
+        actual = np.array(["2024-01-03T01:00", "2024-01-01T09:00", "2024-01-01T10:30", "2024-01-01T10:00"],
+                          dtype="datetime64[m]")
+        statuses, delays = check_flight_status_batch(schedule, actual)
+        self.assertEqual(delays.tolist(), [1575, -5820, 30, 0])
+        percentiles = (0, 50, 100)
+        # Скользящее окно из 3 рейсов хранит задержки -5820, 30 и 0
+        for stats, expected in ((DelayTotals(percentiles), (-1053.75, -1440, 0, 1440)),
+                                (RollingDelays(3, percentiles), (-1930, -1440, 0, 30))):
+            with self.subTest(stats=type(stats).__name__):
+                stats.add(statuses, delays)
+                summary = stats.summary()
+                self.assertEqual((summary["mean_delay"], summary["p0_delay"], summary["p50_delay"],
+                                  summary["p100_delay"]), expected)
+        # Вытеснение из окна вычитает полные задержки, а не усеченные до int16
+        stats = RollingDelays(2)
+        stats.add(statuses, delays)
+        stats.add(statuses[:2], delays[:2])
+        self.assertEqual(stats.summary()["mean_delay"], (1575 - 5820) / 2)
+
+    def test_tumbling_windows_and_rejected_records(self):
+        arrivals = [("10:00", "10:00"), ("10:00", "10:10"), ("bad", "10:00"), ("10:00", "09:00"), ("10:00", "11:00")]
+        summaries = list(monitor_arrivals(arrivals, size=2))
+        self.assertEqual([summary["records"] for summary in summaries], [2, 4, 5])
+        self.assertEqual([summary["rejected"] for summary in summaries], [0, 1, 1])
+        self.assertEqual([summary["flights"] for summary in summaries], [2, 1, 1])
+        self.assertEqual(summaries[0]["on_time_pct"], 50.0)
+        self.assertEqual(summaries[1]["mean_delay"], -60)
+        with self.assertRaises(ValueError):
+            list(monitor_arrivals(arrivals, size=2, step=3))
+
+    def test_chunk_with_invalid_records(self):
+        # Некорректные записи в одной части потока с корректными: отклоняются, остальные учитываются
+        arrivals = [("10:00", "10:30"), ("bad", "10:00"), ("9:00", "8:45"), (None, None), ("10:00", "24:00"),
+                    ("23:00", "23:00"), ("10:00", 930), ("10:00", ["10:00"]), ("٣:00", "01:00"), ("10:00", "10:00x")]
+        summary, = monitor_arrivals(arrivals, size=len(arrivals))
+        self.assertEqual((summary["records"], summary["rejected"], summary["flights"]), (10, 6, 4))
+        self.assertEqual((summary["early"], summary["delayed"], summary["on_time_pct"]), (2, 1, 25.0))
+        self.assertEqual(summary["mean_delay"], (30 - 15 + 0 - 120) / 4)
+
+
+class TestProcessFile(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, "arrivals.csv")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def write(self, text):
+        with open(self.path, "w", encoding="utf-8", newline="") as f:
+            f.write(text)
+
+    def process(self, **options):
+        chunks = []
+        summary = process_file(self.path, on_chunk=lambda *chunk: chunks.append(chunk), **options)
+        statuses = np.concatenate([chunk[0] for chunk in chunks])
+        delays = np.concatenate([chunk[1] for chunk in chunks])
+        return summary, statuses, delays
+
+    def test_chunks_are_merged_in_file_order(self):
+        rng = np.random.default_rng(2)
+        schedule_times = rng.choice(ALL_TIMES, 5000)
+        actual_times = rng.choice(ALL_TIMES, 5000)
+        self.write("flight,schedule_time,actual_time\n" + "".join(
+            f"SU{number},{schedule_time},{actual_time}\n"
+            for number, (schedule_time, actual_time) in enumerate(zip(schedule_times, actual_times))))
+        expected_statuses, expected_delays = check_flight_status_batch(schedule_times, actual_times, window=6)
+        expected = DelayTotals()
+        expected.add(expected_statuses, expected_delays)
+        for workers, chunk_size in ((1, 1000), (1, 7), (2, 4096), (3, 10 ** 9)):
+            with self.subTest(workers=workers, chunk_size=chunk_size):
+                summary, statuses, delays = self.process(workers=workers, chunk_size=chunk_size, window=6)
+                self.assertEqual(statuses.tolist(), expected_statuses.tolist())
+                self.assertEqual(delays.tolist(), expected_delays.tolist())
+                self.assertEqual({key: summary[key] for key in expected.summary()}, expected.summary())
+                self.assertEqual((summary["records"], summary["rejected"]), (5000, 0))
+
+    def test_malformed_lines(self):
+        # Окончания строк Windows, пустые строки, поля в кавычках, лишние и недостающие поля, нет перевода строки в конце
+        self.write('actual_time,schedule_time\r\n10:05,10:00\r\n\r\n"9:00",10:00\r\n25:00,10:00\r\n'
+                   '10:00\r\n10:00,10:00,x\r\n٣:00,01:00\r\n23:59,00:00')
+        for chunk_size in (3, 1000):
+            with self.subTest(chunk_size=chunk_size):
+                summary, statuses, delays = self.process(workers=1, chunk_size=chunk_size)
+                self.assertEqual(statuses.tolist(), [DELAYED, EARLY, INVALID, INVALID, INVALID, DELAYED, DELAYED])
+                self.assertEqual(delays.tolist(), [5, -60, 0, 0, 0, 120, 1439])
+                self.assertEqual((summary["records"], summary["rejected"]), (7, 3))
+        self.assertEqual(format_flight_status(delays, statuses)[2], INVALID_STATUS_TEXT)
+
+        self.write("flight,time\n1,10:00\n")
+        with self.assertRaisesRegex(ValueError, "schedule_time and actual_time"):
+            process_file(self.path, workers=1)
+
+    def test_results_file(self):
+        rng = np.random.default_rng(3)
+        schedule_times = rng.choice(ALL_TIMES, 3000)
+        actual_times = rng.choice(ALL_TIMES, 3000)
+        self.write("schedule_time,actual_time\n" + "".join(
+            f"{schedule_time},{actual_time}\n" for schedule_time, actual_time in zip(schedule_times, actual_times))
+            + "10:00,x\n")
+        output = os.path.join(self.tmp_dir.name, "results")
+        with ResultsWriter(output) as writer:
+            summary = process_file(self.path, workers=1, chunk_size=1000, window=6, on_chunk=writer.add)
+        results = ResultsFile(output)
+        self.assertEqual(len(results), 3001)
+        self.assertEqual((results.statuses.dtype, results.delays.dtype), (np.int8, np.int16))
+        self.assertEqual(os.path.getsize(os.path.join(output, "delay.npy")), 128 + 2 * 3001)
+
+        expected_statuses, expected_delays = check_flight_status_batch(schedule_times, actual_times, window=6)
+        self.assertEqual(results.statuses[:-1].tolist(), expected_statuses.tolist())
+        self.assertEqual(results.delays[:-1].tolist(), expected_delays.tolist())
+        self.assertEqual(results.find(INVALID).tolist(), [3000])
+        self.assertEqual(results.find(UNKNOWN).tolist(), np.flatnonzero(expected_statuses == UNKNOWN).tolist())
+        self.assertEqual({key: summary[key] for key in results.totals().summary()}, results.totals().summary())
+        expected = DelayTotals()
+        expected.add(expected_statuses[1000:2000], expected_delays[1000:2000])
+        self.assertEqual(results.totals(1000, 2000).summary(), expected.summary())
+
+        # Тексты формируются только для запрошенных записей и совпадают с check_flight_status
+        self.assertEqual(results.texts([0, 3000]).tolist(), [
+            check_flight_status(schedule_times[0], actual_times[0], window=6), INVALID_STATUS_TEXT])
+        self.assertEqual(results.texts(slice(10, 20)).tolist(), [
+            check_flight_status(schedule_time, actual_time, window=6)
+            for schedule_time, actual_time in zip(schedule_times[10:20], actual_times[10:20])])
+
+        with ResultsWriter(output) as writer:
+            with self.assertRaisesRegex(ValueError, "int16"):
+                writer.add(np.array([DELAYED]), np.array([40000]))
+        self.assertEqual(len(ResultsFile(output)), 0)
+
+    def test_results_file_with_full_timestamps(self):
+        # Задержки полных дат больше суток сохраняются и учитываются в статистике
+        schedule = np.array(["2024-01-01T22:45", "2024-01-05T10:00", "2024-01-01T10:00"], dtype="datetime64[m]")
+        actual = np.array(["2024-01-03T01:00", "2024-01-01T09:00", "2024-01-01T10:30"], dtype="datetime64[m]")
+        statuses, delays = check_flight_status_batch(schedule, actual)
+        output = os.path.join(self.tmp_dir.name, "results")
+        with ResultsWriter(output) as writer:
+            writer.add(statuses, delays)
+        results = ResultsFile(output)
+        self.assertEqual(results.delays.tolist(), [1575, -5820, 30])
+        summary = results.totals(percentiles=(0, 100)).summary()
+        self.assertEqual((summary["flights"], summary["mean_delay"], summary["p0_delay"], summary["p100_delay"]),
+                         (3, -1405, -1440, 1440))
+        self.assertEqual(results.texts([0, 1]).tolist(), [
+            "Самолет опаздывает. Задержка: 1 day, 2:15:00", "Самолет прилетел раньше. Опережение: 4 days, 1:00:00"])
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_run_and_slowdowns(self):
+        options = benchmark.parse_args(["--sizes", "1e3,2e3", "--per-record-max-size", "1e3", "--repeat", "1"])
+        self.assertEqual(options.sizes, [1000, 2000])
+        results = benchmark.run(["scalar", "batch"], options.sizes, options.repeat, options.per_record_max_size)
+        self.assertEqual(sorted(results), ["batch/1000", "batch/2000", "scalar/1000"])
+
+        baseline = {"results": {key: dict(report, ns_per_row=report["ns_per_row"] / 2)
+                                for key, report in results.items()}}
+        self.assertEqual(sorted(slowdown[0] for slowdown in benchmark.compare(results, baseline, 0.5)), sorted(results))
+        self.assertEqual(benchmark.compare(results, baseline, 1.5), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,306 @@
+import argparse
+import asyncio
+import contextlib
+import csv
+import itertools
+import json
+import os
+import sqlite3
+import sys
+import time
+import uuid
+
+import aiosqlite
+
+from working_server import (
+    CONNECTION_PRAGMAS, DATABASE_NAME, EVER_CONNECTED_CLIENTS_PAGE_QUERY, migrate_database, parse_resource_size
+)
+
+# Массовый импорт и экспорт пользователей и их виртуальных машин в CSV или NDJSON.
+#
+#   python inventory.py import machines.csv [--database clients.db] [--resume]
+#   python inventory.py export machines.ndjson [--database clients.db]
+#
+# Каждая запись - пользователь и его машина: username, client_id, ram_size, cpu_count, hdd_size, hdd_id.
+# Файл читается и пишется потоково, поэтому память не зависит от его размера. Импорт вставляет записи
+# пакетами executemany в больших транзакциях и после каждой транзакции запоминает количество
+# обработанных записей файла, поэтому прерванный импорт можно продолжить с --resume.
+# Работающий сервер узнает об импортированных машинах при очередной сверке статистики
+# (STATS_CHECK_INTERVAL); кэши сервера содержат только найденных пользователей, поэтому не устаревают.
+
+# Поля записи в порядке столбцов CSV
+FIELDS = ("username", "client_id", "ram_size", "cpu_count", "hdd_size", "hdd_id")
+# Количество записей в одном вызове executemany
+BATCH_SIZE = 5000
+# Количество записей в одной транзакции импорта (и шаг сохранения позиции продолжения)
+TRANSACTION_SIZE = 50000
+# Интервал вывода промежуточной скорости (в секундах)
+PROGRESS_INTERVAL = 2.0
+
+INSERT_USER = "INSERT OR IGNORE INTO users (username, client_id) VALUES (?, ?)"
+# Машина вставляется, только если пользователь файла владеет этим client_id (в том числе уже существующий),
+# поэтому пропуск существующего пользователя не создает машину без владельца
+INSERT_CLIENT = """
+    INSERT OR IGNORE INTO clients (client_id, ram_size, cpu_count, hdd_size, hdd_id)
+    SELECT ?, ?, ?, ?, ?
+    WHERE EXISTS (SELECT 1 FROM users WHERE username = ? AND client_id = ?)
+"""
+REPLACE_CLIENT = """
+    INSERT OR REPLACE INTO clients (client_id, ram_size, cpu_count, hdd_size, hdd_id)
+    SELECT ?, ?, ?, ?, ?
+    WHERE EXISTS (SELECT 1 FROM users WHERE username = ? AND client_id = ?)
+"""
+
+
+# Ошибка записи входного файла
+class RecordError(ValueError):
+    pass
+
+
+# Определение формата файла по расширению
+def detect_format(path, value=None):
+    if value:
+        return value
+    if path != "-" and path.lower().endswith((".ndjson", ".jsonl", ".json")):
+        return "ndjson"
+    return "csv"
+
+
+# Функция для открытия соединения с базой данных с настройками сервера и актуальной схемой
+def connect(database):
+    async def migrate():
+        async with aiosqlite.connect(database) as db:
+            await migrate_database(db)
+
+    asyncio.run(migrate())
+    db = sqlite3.connect(database, isolation_level=None)
+    for pragma in CONNECTION_PRAGMAS:
+        db.execute(pragma)
+    return db
+
+
+# Потоковое чтение записей файла в виде словарей
+def read_records(stream, file_format):
+    if file_format == "ndjson":
+        for line in stream:
+            if line.strip():
+                try:
+                    record = json.loads(line)
+                except ValueError as e:
+                    yield RecordError(f"Invalid JSON: {e}")
+                    continue
+                yield record if isinstance(record, dict) else RecordError("Record must be a JSON object")
+    else:
+        yield from csv.DictReader(stream)
+
+
+# Проверка записи и приведение к строке для вставки: (username, client_id, ram, cpu, hdd, hdd_id).
+# Пользователь без машины (все ресурсы пустые) импортируется без строки clients.
+def convert_record(record):
+    if isinstance(record, RecordError):
+        raise record
+    username = str(record.get("username") or "").strip()
+    if not username:
+        raise RecordError("Missing username")
+    client_id = str(record.get("client_id") or "").strip() or str(uuid.uuid4())
+    values = [record.get(name) for name in ("ram_size", "cpu_count", "hdd_size")]
+    hdd_id = record.get("hdd_id")
+    if all(value in (None, "") for value in values) and hdd_id in (None, ""):
+        return username, client_id, None, None, None, None
+    try:
+        ram_size, cpu_count, hdd_size = (parse_resource_size(value) for value in values)
+    except (TypeError, ValueError):
+        raise RecordError("ram_size, cpu_count and hdd_size must be positive integers") from None
+    return username, client_id, ram_size, cpu_count, hdd_size, "" if hdd_id is None else str(hdd_id)
+
+
+# Вывод скорости обработки записей
+class Progress:
+    def __init__(self, action, interval=PROGRESS_INTERVAL, out=sys.stderr):
+        self.action = action
+        self.interval = interval
+        self.out = out
+        self.started = time.perf_counter()
+        self._last_report = self.started
+        self.rows = 0
+
+    def add(self, rows):
+        self.rows += rows
+        now = time.perf_counter()
+        if self.interval and now - self._last_report >= self.interval:
+            self._last_report = now
+            print(f"{self.action} {self.rows} rows, {self.rate():.0f} rows/s", file=self.out)
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def rate(self):
+        elapsed = self.elapsed()
+        return self.rows / elapsed if elapsed > 0 else 0.0
+
+
+# Функция для импорта записей из потока.
+# source - ключ позиции продолжения (None - импорт без сохранения позиции).
+# Возвращает словарь со статистикой: прочитано, вставлено пользователей и машин, отклонено, пропущено.
+def import_records(db, stream, file_format, source=None, resume=False, replace=False, batch_size=BATCH_SIZE,
+                   transaction_size=TRANSACTION_SIZE, rejects=None, progress=None):
+    skip = 0
+    if source is not None:
+        row = db.execute("SELECT records FROM import_progress WHERE source = ?", (source,)).fetchone()
+        if resume and row is not None:
+            skip = row[0]
+    result = {"records": skip, "users": 0, "clients": 0, "rejected": 0, "resumed_at": skip}
+    insert_client = REPLACE_CLIENT if replace else INSERT_CLIENT
+
+    records = read_records(stream, file_format)
+    # Уже импортированные записи пропускаются без проверки
+    for _ in itertools.islice(records, skip):
+        pass
+
+    while True:
+        transaction = itertools.islice(records, transaction_size)
+        count = 0
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            while True:
+                batch = list(itertools.islice(transaction, batch_size))
+                if not batch:
+                    break
+                users = []
+                clients = []
+                for number, record in enumerate(batch, result["records"] + count + 1):
+                    try:
+                        username, client_id, ram_size, cpu_count, hdd_size, hdd_id = convert_record(record)
+                    except RecordError as e:
+                        result["rejected"] += 1
+                        if rejects is not None:
+                            rejects.write(json.dumps({"record": number, "error": str(e),
+                                                      "data": record if isinstance(record, dict) else None},
+                                                     ensure_ascii=False) + "\n")
+                        continue
+                    users.append((username, client_id))
+                    if ram_size is not None:
+                        clients.append((client_id, ram_size, cpu_count, hdd_size, hdd_id, username, client_id))
+                count += len(batch)
+                changes = db.total_changes
+                db.executemany(INSERT_USER, users)
+                result["users"] += db.total_changes - changes
+                changes = db.total_changes
+                db.executemany(insert_client, clients)
+                result["clients"] += db.total_changes - changes
+                if progress is not None:
+                    progress.add(len(batch))
+            result["records"] += count
+            if source is not None and count:
+                db.execute(
+                    "INSERT OR REPLACE INTO import_progress (source, records, updated_at) VALUES (?, ?, ?)",
+                    (source, result["records"], time.time())
+                )
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        if count < transaction_size:
+            break
+
+    # Импорт завершен: позиция продолжения больше не нужна
+    if source is not None:
+        db.execute("DELETE FROM import_progress WHERE source = ?", (source,))
+    return result
+
+
+# Функция для экспорта всех пользователей с их машинами в поток.
+# Строки читаются курсором по мере записи, поэтому память не зависит от размера базы.
+def export_records(db, stream, file_format, progress=None, fetch_size=BATCH_SIZE):
+    # Отрицательный LIMIT в SQLite означает отсутствие ограничения: весь список одним запросом
+    cursor = db.execute(EVER_CONNECTED_CLIENTS_PAGE_QUERY, ("", -1))
+    if file_format == "csv":
+        writer = csv.writer(stream, lineterminator="\n")
+        writer.writerow(FIELDS)
+    count = 0
+    while True:
+        rows = cursor.fetchmany(fetch_size)
+        if not rows:
+            break
+        if file_format == "csv":
+            writer.writerows(rows)
+        else:
+            stream.write("".join(json.dumps(dict(zip(FIELDS, row)), ensure_ascii=False) + "\n" for row in rows))
+        count += len(rows)
+        if progress is not None:
+            progress.add(len(rows))
+    cursor.close()
+    return count
+
+
+# Открытие входного или выходного файла ('-' - стандартный поток)
+def open_stream(path, mode):
+    if path == "-":
+        return contextlib.nullcontext(sys.stdin if mode == "r" else sys.stdout)
+    return open(path, mode, encoding="utf-8", newline="")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Bulk import and export of users and their virtual machines")
+    parser.add_argument("--database", default=DATABASE_NAME)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    import_parser = commands.add_parser("import", help="import users and machines from a CSV or NDJSON file")
+    import_parser.add_argument("file", help="input file ('-' for stdin)")
+    import_parser.add_argument("--format", choices=("csv", "ndjson"), help="default: by file extension")
+    import_parser.add_argument("--resume", action="store_true",
+                               help="continue an interrupted import of the same file")
+    import_parser.add_argument("--replace", action="store_true",
+                               help="overwrite machines of existing users instead of keeping them")
+    import_parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="rows per executemany")
+    import_parser.add_argument("--transaction-size", type=int, default=TRANSACTION_SIZE,
+                               help="rows per transaction and resume checkpoint")
+    import_parser.add_argument("--rejects", help="write rejected records with the reason to this NDJSON file")
+
+    export_parser = commands.add_parser("export", help="export users and machines to a CSV or NDJSON file")
+    export_parser.add_argument("file", help="output file ('-' for stdout)")
+    export_parser.add_argument("--format", choices=("csv", "ndjson"), help="default: by file extension")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    file_format = detect_format(args.file, args.format)
+    db = connect(args.database)
+    try:
+        if args.command == "import":
+            if args.resume and args.file == "-":
+                print("Error: --resume needs a file, not stdin", file=sys.stderr)
+                return 2
+            source = None if args.file == "-" else os.path.realpath(args.file)
+            progress = Progress("Imported")
+            rejects = open(args.rejects, "w", encoding="utf-8") if args.rejects else None
+            try:
+                with open_stream(args.file, "r") as stream:
+                    result = import_records(db, stream, file_format, source, args.resume, args.replace,
+                                            args.batch_size, args.transaction_size, rejects, progress)
+            finally:
+                if rejects is not None:
+                    rejects.close()
+            print(f"Read {result['records']} records (resumed at {result['resumed_at']}), "
+                  f"inserted {result['users']} users and {result['clients']} machines, "
+                  f"rejected {result['rejected']} in {progress.elapsed():.2f} s ({progress.rate():.0f} rows/s)",
+                  file=sys.stderr)
+        else:
+            progress = Progress("Exported")
+            try:
+                with open_stream(args.file, "w") as stream:
+                    count = export_records(db, stream, file_format, progress)
+            except BrokenPipeError:
+                # Получатель закрыл стандартный вывод (например, head): завершение без трассировки
+                os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+                return 1
+            print(f"Exported {count} rows in {progress.elapsed():.2f} s ({progress.rate():.0f} rows/s)",
+                  file=sys.stderr)
+    finally:
+        db.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
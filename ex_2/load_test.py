@@ -0,0 +1,438 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+# Нагрузочное тестирование сервера working_server.py.
+# Запускает сервер на временной базе данных (или использует уже запущенный через --external),
+# создает пользователей пакетным запросом машиночитаемого режима, затем одновременно подключает
+# указанное количество клиентов по текстовому протоколу (как telnet) и выполняет заданную смесь команд.
+# Результат - пропускная способность и перцентили задержки по каждой команде, сохраняемые в JSON;
+# при указании --baseline результат сравнивается с предыдущим запуском.
+#
+# Пример: python load_test.py --clients 2000 --requests 20 --output results.json --baseline baseline.json
+
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "working_server.py")
+
+# Смесь команд по умолчанию: команда -> вес
+DEFAULT_MIX = {
+    "list_of_current_connections": 3,
+    "list_of_users_ever_connected": 2,
+    "list_of_hard_disks": 2,
+    "list_total_stats": 4,
+    "update_client_info": 2,
+    "remove_virtual_machine": 1,
+}
+# Перцентили, попадающие в отчет
+PERCENTILES = (50, 95, 99)
+# Признак конца ответа на вход: последняя строка меню команд
+MENU_END = b"Type 'exit' to exit\r\n"
+# Максимальная длина строки ответа, которую может прочитать клиент
+READ_LIMIT = 1 << 24
+# Размер пакета пользователей при подготовке базы
+SEED_BATCH_SIZE = 1000
+# Время ожидания запуска сервера, секунд
+SERVER_START_TIMEOUT = 30.0
+
+
+# Ошибка ответа сервера на команду
+class CommandError(Exception):
+    pass
+
+
+# Функция для поиска свободного порта
+def find_free_port(host):
+    with socket.socket() as sock:
+        sock.bind((host, 0))
+        return sock.getsockname()[1]
+
+
+# Функция для запуска сервера на временной базе данных
+# (вывод сервера записывается в log, если он указан)
+async def start_server(host, port, database, workers, log=None, storage="sqlite"):
+    output = open(log, "w") if log else subprocess.DEVNULL
+    process = subprocess.Popen(
+        [sys.executable, SERVER_SCRIPT, "--host", host, "--port", str(port), "--database", database,
+         "--workers", str(workers), "--storage", storage, "--shutdown-timeout", "1"],
+        stdout=output, stderr=output
+    )
+    if log:
+        output.close()
+    deadline = time.monotonic() + SERVER_START_TIMEOUT
+    while True:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited with code {process.returncode}")
+        try:
+            _, writer = await asyncio.open_connection(host, port)
+        except OSError:
+            if time.monotonic() > deadline:
+                process.kill()
+                raise RuntimeError("Server did not start in time")
+            await asyncio.sleep(0.1)
+            continue
+        writer.close()
+        return process
+
+
+# Функция для остановки запущенного сервера
+def stop_server(process):
+    process.terminate()
+    try:
+        process.wait(SERVER_START_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+# Открытие подключения в машиночитаемом режиме
+async def open_json_connection(host, port):
+    reader, writer = await asyncio.open_connection(host, port, limit=READ_LIMIT)
+    await reader.readuntil(b"Enter your username: ")
+    writer.write(b"MODE json\r\n")
+    await reader.readline()
+    return reader, writer
+
+
+# Выполнение одного запроса машиночитаемого режима
+async def json_request(reader, writer, op, args):
+    writer.write(json.dumps({"id": 1, "op": op, "args": args}).encode() + b"\n")
+    response = json.loads(await reader.readline())
+    if not response["ok"]:
+        raise CommandError(f"{op}: {response['error']}")
+    return response["result"]
+
+
+# Функция для создания пользователей нагрузочного теста и машин, которые будут удаляться во время теста.
+# Возвращает идентификаторы клиентов пользователей и список идентификаторов машин для удаления.
+async def seed_database(host, port, prefix, clients, victims):
+    reader, writer = await open_json_connection(host, port)
+    spec = {"ram_size": 4, "cpu_count": 2, "hdd_size": 100}
+    await json_request(reader, writer, "login", {"username": f"{prefix}admin", "spec": dict(spec, hdd_id="seed")})
+
+    names = [f"{prefix}user{i}" for i in range(clients)] + [f"{prefix}victim{i}" for i in range(victims)]
+    created = {}
+    for start in range(0, len(names), SEED_BATCH_SIZE):
+        batch = [
+            dict(spec, username=name, hdd_id=f"hdd{i % 16}", ram_size=1 + i % 64, hdd_size=10 * (1 + i % 100))
+            for i, name in enumerate(names[start:start + SEED_BATCH_SIZE], start)
+        ]
+        for item in await json_request(reader, writer, "create_clients", {"clients": batch}):
+            if "error" in item:
+                raise CommandError(f"create_clients: {item['error']}")
+            created[item["username"]] = item["client_id"]
+
+    await json_request(reader, writer, "exit", {})
+    writer.close()
+    users = {name: created[name] for name in names[:clients]}
+    return users, [created[name] for name in names[clients:]]
+
+
+# Чтение ответа до строки-признака конца; строка с ошибкой завершает ответ исключением.
+# Приглашения ввода не заканчиваются переводом строки, поэтому признаки ищутся в конце строки.
+async def read_response(reader, ending):
+    while True:
+        line = await reader.readline()
+        if not line:
+            raise CommandError("Connection closed by the server")
+        if b"Error:" in line:
+            raise CommandError(line[line.index(b"Error:"):].decode().strip())
+        if line.endswith(ending):
+            return
+
+
+# Выполнение команды вывода списка
+async def run_list(reader, writer, client, command):
+    writer.write(f"{command} limit={client.options.list_limit}\r\n".encode())
+    await read_response(reader, b"End of the list\r\n")
+
+
+# Выполнение команды изменения характеристик собственной машины клиента
+async def run_update(reader, writer, client, command):
+    ram = random.randint(1, 64)
+    writer.write(f"update_client_info\r\n{client.client_id}\r\n{ram}\r\n2\r\n{ram * 10}\r\nhdd{ram % 16}\r\n".encode())
+    await read_response(reader, b"Client information updated\r\n")
+
+
+# Выполнение команды удаления одной из подготовленных машин; если они закончились, команда пропускается
+async def run_remove(reader, writer, client, command):
+    if not client.victims:
+        return False
+    writer.write(f"remove_virtual_machine\r\n{client.victims.pop()}\r\n".encode())
+    await read_response(reader, b"Virtual machine removed\r\n")
+
+
+# Выполнение команды вывода общей статистики (ответ заканчивается строкой статистики HDD)
+async def run_stats(reader, writer, client, command):
+    writer.write(b"list_total_stats\r\n")
+    while True:
+        line = await reader.readline()
+        if not line:
+            raise CommandError("Connection closed by the server")
+        if line.startswith(b"HDD Size: min"):
+            return
+
+
+# Команды, которые умеет выполнять клиент нагрузочного теста
+RUNNERS = {
+    "list_of_current_connections": run_list,
+    "list_of_users_ever_connected": run_list,
+    "list_of_hard_disks": run_list,
+    "list_total_stats": run_stats,
+    "update_client_info": run_update,
+    "remove_virtual_machine": run_remove,
+}
+
+
+# Накопитель задержек по командам
+class Recorder:
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+        self.skipped = {}
+
+    def add(self, command, seconds):
+        self.latencies.setdefault(command, []).append(seconds)
+
+    def error(self, command, message):
+        self.errors.setdefault(command, {})
+        self.errors[command][message] = self.errors[command].get(message, 0) + 1
+
+    def skip(self, command):
+        self.skipped[command] = self.skipped.get(command, 0) + 1
+
+
+# Клиент нагрузочного теста: вход по текстовому протоколу и выполнение заданного количества команд
+class LoadClient:
+    def __init__(self, username, client_id, options, victims, recorder):
+        self.username = username
+        self.client_id = client_id
+        self.options = options
+        self.victims = victims
+        self.recorder = recorder
+
+    async def run(self, commands):
+        started = time.perf_counter()
+        try:
+            reader, writer = await asyncio.open_connection(self.options.host, self.options.port, limit=READ_LIMIT)
+            await reader.readuntil(b"Enter your username: ")
+            writer.write(f"{self.username}\r\n".encode())
+            await reader.readuntil(MENU_END)
+        except (OSError, asyncio.IncompleteReadError, asyncio.LimitOverrunError) as e:
+            self.recorder.error("login", type(e).__name__)
+            return
+        self.recorder.add("login", time.perf_counter() - started)
+
+        try:
+            for command in commands:
+                if self.options.think_time:
+                    await asyncio.sleep(random.uniform(0, 2 * self.options.think_time))
+                started = time.perf_counter()
+                try:
+                    skipped = await RUNNERS[command](reader, writer, self, command) is False
+                except CommandError as e:
+                    self.recorder.error(command, str(e))
+                    continue
+                if skipped:
+                    self.recorder.skip(command)
+                else:
+                    self.recorder.add(command, time.perf_counter() - started)
+            writer.write(b"exit\r\n")
+            await writer.drain()
+            await reader.read()
+        except (OSError, asyncio.IncompleteReadError) as e:
+            self.recorder.error("connection", type(e).__name__)
+        finally:
+            writer.close()
+
+
+# Функция для разбора смеси команд вида 'list_total_stats=4,update_client_info=1'
+def parse_mix(value):
+    mix = {}
+    for item in value.split(","):
+        name, _, weight = item.strip().partition("=")
+        if name not in RUNNERS:
+            raise argparse.ArgumentTypeError(f"Unknown command: {name} (known: {', '.join(RUNNERS)})")
+        try:
+            mix[name] = float(weight or 1)
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"Invalid weight: {item}") from None
+    return mix
+
+
+# Функция для расчета перцентиля по отсортированному списку (метод ближайшего ранга)
+def percentile(values, percent):
+    index = max(0, -(-len(values) * percent // 100) - 1)
+    return values[int(index)]
+
+
+# Функция для формирования итогового отчета
+def summarize(recorder, duration, options):
+    commands = {}
+    total = 0
+    for command, latencies in sorted(recorder.latencies.items()):
+        latencies.sort()
+        total += len(latencies)
+        report = {
+            "count": len(latencies),
+            "errors": sum(recorder.errors.get(command, {}).values()),
+            "skipped": recorder.skipped.get(command, 0),
+            "throughput": len(latencies) / duration,
+            "mean_ms": sum(latencies) / len(latencies) * 1000,
+            "max_ms": latencies[-1] * 1000,
+        }
+        for percent in PERCENTILES:
+            report[f"p{percent}_ms"] = percentile(latencies, percent) * 1000
+        commands[command] = report
+    return {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "clients": options.clients,
+            "requests": options.requests,
+            "mix": options.mix,
+            "workers": options.workers,
+            "storage": options.storage,
+            "list_limit": options.list_limit,
+            "think_time": options.think_time,
+        },
+        "duration_s": duration,
+        "throughput": total / duration,
+        "commands": commands,
+        "errors": recorder.errors,
+    }
+
+
+# Функция для сравнения результата с предыдущим запуском.
+# Возвращает список регрессий: команды, у которых перцентиль задержки вырос больше допустимого
+def compare(result, baseline, tolerance, metric):
+    regressions = []
+    for command, report in result["commands"].items():
+        old = baseline.get("commands", {}).get(command)
+        if old is None or not old.get(metric):
+            continue
+        change = report[metric] / old[metric] - 1
+        if change > tolerance:
+            regressions.append((command, old[metric], report[metric], change))
+    return regressions
+
+
+# Функция для вывода отчета в консоль
+def print_report(result):
+    print(f"Duration: {result['duration_s']:.2f} s, throughput: {result['throughput']:.1f} commands/s")
+    header = f"{'command':<30} {'count':>8} {'errors':>7} {'ops/s':>9} " + \
+             " ".join(f"{f'p{percent} ms':>9}" for percent in PERCENTILES) + f" {'max ms':>9}"
+    print(header)
+    for command, report in result["commands"].items():
+        print(f"{command:<30} {report['count']:>8} {report['errors']:>7} {report['throughput']:>9.1f} " +
+              " ".join(f"{report[f'p{percent}_ms']:>9.2f}" for percent in PERCENTILES) +
+              f" {report['max_ms']:>9.2f}")
+    for command, errors in result["errors"].items():
+        for message, count in errors.items():
+            print(f"Error in {command} ({count}x): {message}")
+
+
+async def run(options):
+    process = None
+    tmp_dir = None
+    if not options.external:
+        tmp_dir = tempfile.TemporaryDirectory()
+        options.port = options.port or find_free_port(options.host)
+        process = await start_server(options.host, options.port, os.path.join(tmp_dir.name, "clients.db"),
+                                     options.workers, options.server_log, options.storage)
+    try:
+        # Уникальный префикс позволяет запускать тест повторно на одной базе внешнего сервера
+        prefix = f"lt{int(time.time() * 1000):x}_"
+        victims_needed = options.clients * options.requests  # верхняя оценка количества удалений
+        if "remove_virtual_machine" in options.mix:
+            share = options.mix["remove_virtual_machine"] / sum(options.mix.values())
+            victims_needed = int(victims_needed * share * 1.5) + 1
+        else:
+            victims_needed = 0
+        seed_started = time.perf_counter()
+        users, victims = await seed_database(options.host, options.port, prefix, options.clients, victims_needed)
+        print(f"Seeded {len(users) + len(victims)} machines in {time.perf_counter() - seed_started:.2f} s")
+
+        rng = random.Random(options.seed)
+        random.seed(options.seed)
+        names, weights = zip(*options.mix.items())
+        recorder = Recorder()
+        clients = [LoadClient(username, client_id, options, victims, recorder) for username, client_id in users.items()]
+
+        # Клиенты подключаются равномерно в течение ramp-up, чтобы не переполнить очередь accept сервера
+        async def start_client(index, client):
+            if options.ramp_up:
+                await asyncio.sleep(options.ramp_up * index / len(clients))
+            await client.run(rng.choices(names, weights, k=options.requests))
+
+        started = time.perf_counter()
+        await asyncio.gather(*(start_client(i, client) for i, client in enumerate(clients)))
+        duration = time.perf_counter() - started
+    finally:
+        if process is not None:
+            stop_server(process)
+        if tmp_dir is not None:
+            tmp_dir.cleanup()
+    return summarize(recorder, duration, options)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Load test for the virtual machine management server")
+    parser.add_argument("--clients", type=int, default=1000, help="number of concurrent clients")
+    parser.add_argument("--requests", type=int, default=20, help="commands per client after login")
+    parser.add_argument("--mix", type=parse_mix, default=DEFAULT_MIX,
+                        help="weighted command mix, e.g. 'list_total_stats=4,update_client_info=1' "
+                             f"(default: {','.join(f'{k}={v}' for k, v in DEFAULT_MIX.items())})")
+    parser.add_argument("--list-limit", type=int, default=100, help="limit= argument of list commands")
+    parser.add_argument("--think-time", type=float, default=0.0, help="mean pause between commands, seconds")
+    parser.add_argument("--ramp-up", type=float, default=1.0, help="seconds over which clients connect")
+    parser.add_argument("--workers", type=int, default=1, help="--workers of the started server")
+    parser.add_argument("--storage", choices=("sqlite", "memory"), default="sqlite",
+                        help="--storage of the started server (memory: protocol overhead without the database)")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=None)
+    parser.add_argument("--external", action="store_true",
+                        help="use an already running server at --host/--port instead of starting one")
+    parser.add_argument("--server-log", help="file for the output of the started server")
+    parser.add_argument("--seed", type=int, default=0, help="random seed of the command sequence")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--baseline", help="compare with the results of a previous run")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="allowed relative growth of the compared percentile (default 0.2 = 20%%)")
+    parser.add_argument("--metric", default="p95_ms", choices=[f"p{percent}_ms" for percent in PERCENTILES],
+                        help="percentile compared with the baseline")
+    options = parser.parse_args(argv)
+    if options.external and options.port is None:
+        parser.error("--external requires --port")
+    return options
+
+
+def main(argv=None):
+    options = parse_args(argv)
+    result = asyncio.run(run(options))
+    print_report(result)
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(result, f, indent=2)
+
+    if options.baseline:
+        with open(options.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(result, baseline, options.tolerance, options.metric)
+        for command, old, new, change in regressions:
+            print(f"Regression: {command} {options.metric} {old:.2f} -> {new:.2f} ms (+{change:.0%})")
+        if regressions:
+            return 1
+        print(f"No regressions against {options.baseline}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
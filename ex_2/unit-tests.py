@@ -1,10 +1,21 @@
 import unittest
+from contextlib import redirect_stdout
 from io import StringIO
 import asyncio
+import json
+import os
+import sqlite3
+import tempfile
 import aiosqlite
 
+import inventory
+import load_test
+import working_server
 from working_server import (
-    create_user, create_client, add_current_connection, remove_current_connection,
+    ConnectionPool, WriteQueue, MIGRATIONS, migrate_database, TotalStats, check_total_stats, get_total_stats,
+    get_stats_aggregator, execute_write, iter_rows, HARD_DISKS_PAGE_QUERY, sessions, snapshot_current_connections,
+    list_current_connections, apply_change, COMMANDS, register_command, dispatch_command, get_menu, JsonConnection,
+    LRUCache, lookup_user, client_cache, create_user, create_client, add_current_connection, remove_current_connection,
     clear_current_connections, client_exists, remove_virtual_machine,
     update_client_info, list_ever_connected_clients, handle_remove_virtual_machine, handle_update_client_info,
     handle_list_ever_connected_clients, handle_list_current_connections,
@@ -12,57 +23,52 @@ from working_server import (
 )
 
 
-class TestYourCode(unittest.TestCase):
+class TestYourCode(unittest.IsolatedAsyncioTestCase):
 
-    def setUp(self):
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-
-        # Создаем асинхронное подключение
-        self.db_connection = loop.run_until_complete(aiosqlite.connect(":memory:"))
-        self.db_cursor = loop.run_until_complete(self.db_connection.cursor())
-        self.stdout = StringIO()
+    async def asyncSetUp(self):
+        # Открываем хранилище в памяти процесса
+        await working_server.init_storage("memory")
+        await working_server.init_total_stats()
 
-    def tearDown(self):
-        asyncio.run(self.db_cursor.close())
-        asyncio.run(self.db_connection.close())
+    async def asyncTearDown(self):
+        sessions.clear()
+        await working_server.close_storage()
 
-    async def run_command(self, command, input_data=None):
+    async def run_command(self, command, input_data=None, *args):
         reader = asyncio.StreamReader()
-        reader_protocol = asyncio.StreamReaderProtocol(reader)
-        reader_transport, _ = await asyncio.connect_read_pipe(lambda: reader_protocol, asyncio.StreamWriter)
-
-        writer = asyncio.StreamWriter(self.stdout, None, None, None)
-        writer_transport = asyncio.BufferedWriter(writer)
-
         if input_data:
-            writer.write(input_data.encode())
-
-        await command(reader, writer)
+            reader.feed_data(input_data.encode())
+        reader.feed_eof()
+        writer = FakeWriter()
 
-        writer_transport.close()
-        await writer_transport.wait_closed()
+        await command(reader, writer, *args)
 
-        return self.stdout.getvalue()
+        return writer.output()
 
     async def test_create_user(self):
         await create_user("test_user", "test_id")
-        self.assertTrue(await client_exists("test_id"))
+        self.assertEqual((await lookup_user("test_user"))[0], "test_id")
+        # Пользователь создан без машины
+        self.assertFalse(await client_exists("test_id"))
 
     async def test_create_client(self):
         await create_client("test_id", "2", "2", "500", "001")
         self.assertTrue(await client_exists("test_id"))
 
     async def test_add_remove_current_connection(self):
+        await create_user("test_user", "test_id")
+        await create_client("test_id", "2", "2", "500", "001")
         await add_current_connection("test_id")
-        self.assertTrue(await client_exists("test_id"))
+        self.assertEqual(sessions.get("test_id").username, "test_user")
         await remove_current_connection("test_id")
-        self.assertFalse(await client_exists("test_id"))
+        self.assertIsNone(sessions.get("test_id"))
+        self.assertTrue(await client_exists("test_id"))
 
     async def test_clear_current_connections(self):
+        await create_client("test_id", "2", "2", "500", "001")
         await add_current_connection("test_id")
         await clear_current_connections()
-        self.assertFalse(await client_exists("test_id"))
+        self.assertEqual(len(sessions), 0)
 
     async def test_remove_virtual_machine(self):
         await create_user("test_user", "test_id")
@@ -70,14 +76,17 @@ class TestYourCode(unittest.TestCase):
         await add_current_connection("test_id")
         await remove_virtual_machine("test_id")
         self.assertFalse(await client_exists("test_id"))
+        self.assertIsNone(sessions.get("test_id"))
 
     async def test_update_client_info(self):
+        await create_user("test_user", "test_id")
         await create_client("test_id", "2", "2", "500", "001")
         await update_client_info("test_id", "4", "4", "1000", "002")
         client_info = await list_ever_connected_clients()
-        self.assertEqual(client_info[0][2], "4")
-        self.assertEqual(client_info[0][3], "4")
-        self.assertEqual(client_info[0][4], "1000")
+        # Размеры ресурсов хранятся целыми числами
+        self.assertEqual(client_info[0][2], 4)
+        self.assertEqual(client_info[0][3], 4)
+        self.assertEqual(client_info[0][4], 1000)
         self.assertEqual(client_info[0][5], "002")
 
     async def test_list_ever_connected_clients(self):
@@ -108,12 +117,13 @@ class TestYourCode(unittest.TestCase):
         await create_user("test_user", "test_id")
         await create_client("test_id", "2", "2", "500", "001")
         await add_current_connection("test_id")
-        result = await self.run_command(handle_remove_virtual_machine, "test_id\n")
+        result = await self.run_command(handle_remove_virtual_machine, "test_id\n", "test_id")
         self.assertIn("Removing your own virtual machine. Disconnecting...", result)
+        self.assertFalse(await client_exists("test_id"))
 
     async def test_handle_update_client_info(self):
         await create_client("test_id", "2", "2", "500", "001")
-        result = await self.run_command(handle_update_client_info, "test_id\n4\n4\n1000\002\n")
+        result = await self.run_command(handle_update_client_info, "test_id\n4\n4\n1000\n002\n")
         self.assertIn("Client information updated", result)
 
     async def test_handle_list_ever_connected_clients(self):
@@ -149,5 +159,936 @@ class TestYourCode(unittest.TestCase):
         self.assertIn("HDD Size: 500", result)
 
 
+class TestConnectionPool(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.pool = ConnectionPool(os.path.join(self.tmp_dir.name, "clients.db"), size=2, timeout=0.1)
+        await self.pool.open()
+
+    async def asyncTearDown(self):
+        await self.pool.close()
+        self.tmp_dir.cleanup()
+
+    async def test_reader_connections_are_reused(self):
+        seen = set()
+        for _ in range(5):
+            async with self.pool.reader() as db:
+                seen.add(id(db))
+        self.assertEqual(len(seen), 2)
+        self.assertEqual(self.pool.get_stats()["reader_acquired"], 5)
+
+    async def test_reader_timeout_when_pool_is_exhausted(self):
+        async with self.pool.reader(), self.pool.reader():
+            with self.assertRaises(TimeoutError):
+                async with self.pool.reader():
+                    pass
+        stats = self.pool.get_stats()
+        self.assertEqual(stats["timeouts"], 1)
+        self.assertEqual(stats["readers_in_use"], 0)
+
+    async def test_readers_are_read_only(self):
+        async with self.pool.writer() as db:
+            await db.execute("CREATE TABLE t (x INTEGER)")
+            await db.commit()
+        async with self.pool.reader() as db:
+            with self.assertRaises(aiosqlite.OperationalError):
+                await db.execute("INSERT INTO t VALUES (1)")
+
+
+class TestWriteQueue(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.pool = ConnectionPool(os.path.join(self.tmp_dir.name, "clients.db"), size=1)
+        await self.pool.open()
+        async with self.pool.writer() as db:
+            await db.execute("CREATE TABLE t (x INTEGER PRIMARY KEY)")
+            await db.commit()
+        self.queue = WriteQueue(self.pool, max_delay=0.05, max_batch=10)
+        self.queue.start()
+
+    async def asyncTearDown(self):
+        await self.queue.stop()
+        await self.pool.close()
+        self.tmp_dir.cleanup()
+
+    async def test_concurrent_writes_share_one_commit(self):
+        results = await asyncio.gather(*(
+            self.queue.submit([("INSERT INTO t (x) VALUES (?)", (i,))]) for i in range(5)
+        ))
+        self.assertEqual(results, [1] * 5)
+        stats = self.queue.get_stats()
+        self.assertEqual(stats["batches"], 1)
+        self.assertEqual(stats["max_batch"], 5)
+        async with self.pool.reader() as db:
+            cursor = await db.execute("SELECT COUNT(*) FROM t")
+            self.assertEqual((await cursor.fetchone())[0], 5)
+
+    async def test_failed_operation_does_not_affect_batch(self):
+        results = await asyncio.gather(
+            self.queue.submit([("INSERT INTO t (x) VALUES (?)", (1,))]),
+            self.queue.submit([("INSERT INTO t (x) VALUES (?)", (2,)), ("INSERT INTO t (x) VALUES (?)", (1,))]),
+            self.queue.submit([("INSERT INTO t (x) VALUES (?)", (3,))]),
+            return_exceptions=True
+        )
+        self.assertEqual(results[0], 1)
+        self.assertIsInstance(results[1], sqlite3.IntegrityError)
+        self.assertEqual(results[2], 1)
+        async with self.pool.reader() as db:
+            cursor = await db.execute("SELECT x FROM t ORDER BY x")
+            self.assertEqual(await cursor.fetchall(), [(1,), (3,)])
+
+    async def test_unexpected_error_rolls_back_transaction(self):
+        # Ошибка не из sqlite3 внутри транзакции: операция без параметров запроса
+        with self.assertRaises(ValueError):
+            await self.queue.submit([("INSERT INTO t (x) VALUES (1)",)])
+        self.assertEqual(await self.queue.submit([("INSERT INTO t (x) VALUES (?)", (2,))]), 1)
+
+        # Отмена задачи-писателя во время транзакции
+        slow = asyncio.ensure_future(self.queue.submit([(
+            "INSERT INTO t (x) WITH RECURSIVE r(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM r WHERE i < 3000000) "
+            "SELECT MAX(i) + 10 FROM r", ())]))
+        await asyncio.sleep(0.1)
+        self.queue._task.cancel()
+        with self.assertRaisesRegex(RuntimeError, "stopped"):
+            await slow
+        await self.queue.stop()
+        self.queue.start()
+        self.assertEqual(await self.queue.submit([("INSERT INTO t (x) VALUES (?)", (3,))]), 1)
+        async with self.pool.reader() as db:
+            cursor = await db.execute("SELECT x FROM t ORDER BY x")
+            self.assertEqual(await cursor.fetchall(), [(2,), (3,)])
+
+    async def test_operations_queued_after_stop_fail(self):
+        first = asyncio.ensure_future(self.queue.submit([("INSERT INTO t (x) VALUES (?)", (1,))]))
+        stop = asyncio.ensure_future(self.queue.stop())
+        late = asyncio.ensure_future(self.queue.submit([("INSERT INTO t (x) VALUES (?)", (2,))]))
+        await asyncio.wait_for(stop, 5)
+        self.assertEqual(await first, 1)
+        with self.assertRaisesRegex(RuntimeError, "stopped"):
+            await late
+        with self.assertRaisesRegex(RuntimeError, "not running"):
+            await self.queue.submit([("INSERT INTO t (x) VALUES (?)", (3,))])
+
+    async def test_batch_size_limit(self):
+        await asyncio.gather(*(
+            self.queue.submit([("INSERT INTO t (x) VALUES (?)", (i,))]) for i in range(25)
+        ))
+        stats = self.queue.get_stats()
+        self.assertEqual(stats["operations"], 25)
+        self.assertEqual(stats["max_batch"], 10)
+        self.assertGreaterEqual(stats["batches"], 3)
+
+
+class TestMigrations(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.database = os.path.join(self.tmp_dir.name, "clients.db")
+
+    async def asyncTearDown(self):
+        self.tmp_dir.cleanup()
+
+    async def test_legacy_database_is_migrated_in_place(self):
+        with sqlite3.connect(self.database) as db:
+            db.executescript(MIGRATIONS[0])
+            db.execute("INSERT INTO users VALUES ('user', 'id1')")
+            db.execute("INSERT INTO clients VALUES ('id1', '4', ' 2', '500', '001')")
+            db.execute("INSERT INTO clients VALUES ('id2', 'big', '0', '1.5', '002')")
+            db.execute("INSERT INTO current_connections VALUES ('id1'), ('missing')")
+        db.close()
+
+        async with aiosqlite.connect(self.database) as db:
+            self.assertEqual(await migrate_database(db), len(MIGRATIONS))
+            # Повторный запуск ничего не меняет
+            self.assertEqual(await migrate_database(db), len(MIGRATIONS))
+            cursor = await db.execute("SELECT * FROM clients ORDER BY client_id")
+            self.assertEqual(await cursor.fetchall(), [("id1", 4, 2, 500, "001"), ("id2", None, None, None, "002")])
+            cursor = await db.execute("SELECT client_id FROM current_connections")
+            self.assertEqual(await cursor.fetchall(), [("id1",)])
+            cursor = await db.execute("PRAGMA journal_mode")
+            self.assertEqual((await cursor.fetchone())[0], "wal")
+            with self.assertRaises(sqlite3.IntegrityError):
+                await db.execute("UPDATE clients SET ram_size = 'a lot' WHERE client_id = 'id1'")
+
+
+# Заглушка StreamWriter, накапливающая отправленные клиенту данные
+class FakeWriter:
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.writes = 0
+        self.drains = 0
+        self.closed = False
+
+    def write(self, data):
+        self.buffer += data
+        self.writes += 1
+
+    async def drain(self):
+        self.drains += 1
+
+    def close(self):
+        self.closed = True
+
+    def is_closing(self):
+        return self.closed
+
+    def get_extra_info(self, name, default=None):
+        return default
+
+    def output(self):
+        return self.buffer.decode()
+
+
+# Базовый класс для тестов, работающих с сервером. По умолчанию данные хранятся в памяти процесса,
+# поэтому тесты не зависят от файлов и могут выполняться параллельно; тесты, проверяющие SQLite,
+# задают storage = "sqlite" и получают временную базу данных.
+class ServerTestCase(unittest.IsolatedAsyncioTestCase):
+    storage = "memory"
+
+    async def asyncSetUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        if self.storage == "sqlite":
+            await working_server.init_storage("sqlite", database=os.path.join(self.tmp_dir.name, "clients.db"),
+                                              pool_size=2, write_batch_delay=0.001)
+        else:
+            await working_server.init_storage(self.storage)
+        await working_server.init_total_stats()
+
+    async def asyncTearDown(self):
+        await working_server.close_storage()
+        self.tmp_dir.cleanup()
+
+
+class TestTotalStats(ServerTestCase):
+
+    def test_min_max_follow_removals(self):
+        stats = TotalStats()
+        stats.add_client((2, 1, 100))
+        stats.add_client((8, 4, 300))
+        stats.add_client((8, 2, 200))
+        stats.remove_client((8, 4, 300))
+        self.assertEqual(stats.totals(), (2, 10, 3, 300))
+        self.assertEqual(stats.resources["ram_size"].max, 8)
+        self.assertEqual(stats.resources["cpu_count"].max, 2)
+        stats.update_client((8, 2, 200), (1, 1, 50))
+        self.assertEqual(stats.resources["ram_size"].min, 1)
+        self.assertEqual(stats.resources["ram_size"].max, 2)
+        self.assertEqual(stats.resources["hdd_size"].avg, 75)
+
+    async def test_mutations_update_stats_without_queries(self):
+        await create_client("id1", "2", "2", "500", "001")
+        await create_client("id2", "4", "1", "100", "002")
+        await update_client_info("id1", 8, 2, 500, "001")
+        await remove_virtual_machine("id2")
+        self.assertEqual(await get_total_stats(), (1, 8, 2))
+        self.assertTrue(await check_total_stats())
+
+    async def test_resource_constraints(self):
+        # Оба хранилища принимают и отклоняют одни и те же значения ресурсов
+        await create_client("id1", " 3", 2.0, "1e3", 7)
+        await create_user("user", "id1")
+        self.assertEqual(await lookup_user("user"), ("id1", (3, 2, 1000, "7")))
+        for value in (0, -1, 2.5, "abc", "0x10", "1_000"):
+            with self.subTest(value=value), self.assertRaisesRegex(sqlite3.IntegrityError, "CHECK constraint"):
+                await create_client("id2", 1, value, 1, "x")
+        with self.assertRaises(sqlite3.IntegrityError):
+            await working_server.create_user_with_client("user2", "id3", 1, 1, 0, "x")
+        with self.assertRaises(sqlite3.IntegrityError):
+            await update_client_info("id1", 1, 1, -5, "x")
+        self.assertEqual(await lookup_user("user2"), (None, None))
+        self.assertEqual(await get_total_stats(), (1, 3, 2))
+        self.assertTrue(await check_total_stats())
+
+
+class TestStreamedLists(ServerTestCase):
+
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        for i in range(5):
+            await create_user(f"user{i}", f"id{i}")
+            await create_client(f"id{i}", 1, 1, 100 + i, f"hdd{i}")
+
+    async def test_rows_are_read_in_chunks(self):
+        chunks = [rows async for rows in iter_rows(HARD_DISKS_PAGE_QUERY, 2, chunk_size=2)]
+        self.assertEqual([len(rows) for rows in chunks], [2, 2, 1])
+        chunks = [rows async for rows in iter_rows(HARD_DISKS_PAGE_QUERY, 2, after="id1", limit=2, chunk_size=2)]
+        self.assertEqual([row[2] for rows in chunks for row in rows], ["id2", "id3"])
+
+    async def test_list_hard_disks_pagination(self):
+        writer = FakeWriter()
+        await handle_list_hard_disks(None, writer, ["limit=2"])
+        self.assertIn("Username: user1, HDD Size: 101", writer.output())
+        self.assertNotIn("user2", writer.output())
+        self.assertIn("Next page: after=id1 limit=2", writer.output())
+
+        writer = FakeWriter()
+        await handle_list_hard_disks(None, writer, ["after=id1"])
+        self.assertNotIn("user1", writer.output())
+        self.assertIn("Username: user4, HDD Size: 104", writer.output())
+        self.assertEqual(writer.drains, 2)
+
+    async def test_invalid_list_arguments(self):
+        writer = FakeWriter()
+        await handle_list_ever_connected_clients(None, writer, ["limit=0"])
+        self.assertIn("Error: Invalid argument: limit=0", writer.output())
+
+
+class TestSessionRegistry(ServerTestCase):
+
+    async def asyncTearDown(self):
+        sessions.clear()
+        await super().asyncTearDown()
+
+    async def test_registry_serves_current_connections(self):
+        await create_user("user", "id1")
+        await create_client("id1", 2, 2, 500, "001")
+        session = await add_current_connection("id1", writer=FakeWriter())
+        self.assertEqual(session.username, "user")
+        self.assertEqual(await list_current_connections(), [("user", "id1", 2, 2, 500, "001")])
+
+        await update_client_info("id1", 4, 4, 1000, "002")
+        self.assertEqual(await list_current_connections(), [("user", "id1", 4, 4, 1000, "002")])
+
+        await remove_current_connection("id1", session)
+        self.assertEqual(await list_current_connections(), [])
+
+    async def test_stale_session_does_not_remove_newer_one(self):
+        old = await add_current_connection("id1", "user", spec=(1, 1, 1, "x"))
+        new = await add_current_connection("id1", "user", spec=(1, 1, 1, "x"))
+        await remove_current_connection("id1", old)
+        self.assertIs(sessions.get("id1"), new)
+
+    async def test_changes_from_other_workers(self):
+        apply_change({"type": "session_added", "client_id": "id9", "username": "remote", "spec": [1, 2, 3, "x"]})
+        apply_change({"type": "client_created", "client_id": "id9", "spec": [1, 2, 3, "x"]})
+        self.assertEqual(await list_current_connections(), [("remote", "id9", 1, 2, 3, "x")])
+        self.assertEqual(await get_total_stats(), (1, 1, 2))
+
+        apply_change({"type": "client_updated", "client_id": "id9", "old": [1, 2, 3], "spec": [4, 4, 4, "y"]})
+        self.assertEqual(await list_current_connections(), [("remote", "id9", 4, 4, 4, "y")])
+        apply_change({"type": "client_removed", "client_id": "id9", "old": [4, 4, 4]})
+        self.assertEqual(await list_current_connections(), [])
+        self.assertEqual(await get_total_stats(), (0, 0, 0))
+
+
+# Запуск рабочего процесса в режиме --workers: этот процесс играет роль нового рабочего процесса B,
+# а рабочий процесс A подключается к супервизору напрямую через сокет
+class TestClusterStartup(ServerTestCase):
+    storage = "sqlite"
+
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        self.supervisor = working_server.Supervisor(2, {})
+        self.hub = await asyncio.start_unix_server(self.supervisor._handle_worker, self.supervisor.hub_path)
+        _, self.worker_a = await asyncio.open_unix_connection(self.supervisor.hub_path)
+        self.send_a({"type": "hello", "pid": 1})
+        self.send_a({"type": "ready", "pid": 1})
+
+    async def asyncTearDown(self):
+        if working_server._cluster is not None:
+            cluster, working_server._cluster = working_server._cluster, None
+            await cluster.close()
+        self.worker_a.close()
+        self.hub.close()
+        await self.hub.wait_closed()
+        os.unlink(self.supervisor.hub_path)
+        os.rmdir(os.path.dirname(self.supervisor.hub_path))
+        sessions.clear()
+        await super().asyncTearDown()
+
+    def send_a(self, event):
+        self.worker_a.write(json.dumps(event).encode() + b"\n")
+
+    async def wait_for(self, condition):
+        for _ in range(100):
+            if condition():
+                return
+            await asyncio.sleep(0.01)
+        self.fail("Condition was not reached")
+
+    async def test_changes_committed_while_worker_starts(self):
+        self.send_a({"type": "session_added", "client_id": "idA", "username": "a", "spec": [1, 1, 1, "x"]})
+        await self.wait_for(lambda: "idA" in self.supervisor._sessions.get(1, {}))
+        ready = self.supervisor._ready[os.getpid()] = asyncio.Event()
+
+        # Процесс B подключается к супервизору и загружает статистику; A фиксирует новую машину
+        # после того, как B прочитал снимок базы, но до замены статистики
+        storage = working_server.get_storage()
+        load_stats = storage.load_stats
+        loaded = asyncio.Event()
+        resume = asyncio.Event()
+
+        async def paused_load_stats(stats):
+            await load_stats(stats)
+            loaded.set()
+            await resume.wait()
+
+        storage.load_stats = paused_load_stats
+        working_server._cluster = working_server.ClusterLink(self.supervisor.hub_path)
+        await working_server._cluster.connect()
+        starting = asyncio.create_task(working_server.init_total_stats())
+        await loaded.wait()
+        await execute_write(("INSERT INTO clients VALUES ('idB', 2, 2, 500, '001')", ()))
+        self.send_a({"type": "client_created", "client_id": "idB", "spec": [2, 2, 500, "001"]})
+        await self.wait_for(lambda: working_server._stats_backlog)
+        resume.set()
+        await starting
+
+        self.assertEqual(await get_total_stats(), (1, 2, 2))
+        self.assertTrue(await check_total_stats())
+        # Сессии процесса A, открытые до запуска B, видны в B
+        await self.wait_for(lambda: "idA" in sessions._remote)
+        self.assertFalse(ready.is_set())
+        working_server._cluster.ready()
+        await asyncio.wait_for(ready.wait(), 1)
+
+
+class TestCommandDispatcher(ServerTestCase):
+
+    async def asyncTearDown(self):
+        COMMANDS.pop("echo", None)
+        working_server._menu = None
+        sessions.clear()
+        await super().asyncTearDown()
+
+    async def test_registered_command_receives_arguments(self):
+        @register_command("echo", "repeat the arguments", "<words>")
+        async def echo(reader, writer, session, args):
+            writer.write(f"{session.username}: {' '.join(args)}\r\n".encode())
+
+        self.assertIn(b"Type 'echo <words>' to repeat the arguments", get_menu())
+        writer = FakeWriter()
+        session = await add_current_connection("id1", "user", writer, (1, 1, 1, "x"))
+        await dispatch_command(None, writer, session, "ECHO hello world\r\n")
+        self.assertEqual(writer.output(), "user: hello world\r\n")
+
+    async def test_unknown_command_and_exit(self):
+        writer = FakeWriter()
+        session = await add_current_connection("id1", "user", writer, (1, 1, 1, "x"))
+        await dispatch_command(None, writer, session, "\r\n")
+        self.assertIn("Error: Unknown command", writer.output())
+        await dispatch_command(None, writer, session, "exit\r\n")
+        self.assertTrue(writer.closed)
+        self.assertIsNone(sessions.get("id1"))
+
+    def test_menu_is_encoded_once(self):
+        self.assertIs(get_menu(), get_menu())
+
+
+class TestJsonProtocol(ServerTestCase):
+
+    async def asyncTearDown(self):
+        sessions.clear()
+        await super().asyncTearDown()
+
+    # Выполнение набора запросов и разбор ответов по id
+    async def run_requests(self, *requests):
+        reader = asyncio.StreamReader()
+        for request in requests:
+            reader.feed_data((request if isinstance(request, str) else json.dumps(request)).encode() + b"\n")
+        reader.feed_eof()
+        writer = FakeWriter()
+        await JsonConnection(reader, writer).serve()
+        responses = [json.loads(line) for line in writer.output().splitlines()]
+        self.assertEqual(responses[0], {"id": None, "ok": True, "result": {"mode": "json"}})
+        return {response["id"]: response for response in responses[1:]}
+
+    async def test_login_and_pipelined_requests(self):
+        spec = {"ram_size": 4, "cpu_count": 2, "hdd_size": 100, "hdd_id": "hdd"}
+        responses = await self.run_requests(
+            {"id": 1, "op": "login", "args": {"username": "admin", "spec": spec}},
+            {"id": 2, "op": "create_clients", "args": {"clients": [
+                dict(spec, username="user1"), dict(spec, username="user2"), dict(spec, username="user3", ram_size=0)
+            ]}},
+            {"id": 3, "op": "list_total_stats"},
+            {"id": 4, "op": "list_of_current_connections"},
+        )
+        self.assertTrue(responses[1]["result"]["created"])
+        created = responses[2]["result"]
+        self.assertEqual([item.get("username") for item in created], ["user1", "user2", None])
+        self.assertIn("error", created[2])
+        # Запросы 3 и 4 выполняются одновременно с 2, поэтому видят только пользователя admin или больше
+        self.assertGreaterEqual(responses[3]["result"]["machines"], 1)
+        self.assertEqual(responses[4]["result"]["items"][0]["username"], "admin")
+        # После отключения сессия удаляется из реестра
+        self.assertEqual(len(sessions), 0)
+
+        responses = await self.run_requests(
+            {"id": "a", "op": "login", "args": {"username": "admin"}},
+            {"id": "b", "op": "remove_virtual_machines", "args": {"client_ids": [created[0]["client_id"], "missing"]}},
+            {"id": "c", "op": "list_of_users_ever_connected", "args": {"limit": 1}},
+        )
+        self.assertFalse(responses["a"]["result"]["created"])
+        self.assertEqual([item["removed"] for item in responses["b"]["result"]], [True, False])
+        self.assertEqual(len(responses["c"]["result"]["items"]), 1)
+        self.assertIsNotNone(responses["c"]["result"]["next"])
+
+        responses = await self.run_requests(
+            {"id": 1, "op": "login", "args": {"username": "admin"}},
+            {"id": 2, "op": "query", "args": {"kind": "summary", "ram": [4, None], "hdd_id": "hdd"}},
+            {"id": 3, "op": "query", "args": {"kind": "top", "by": "hdd", "limit": 1}},
+            {"id": 4, "op": "query", "args": {"kind": "histogram", "cpu": "3..", "field": "gpu"}},
+        )
+        self.assertEqual(responses[2]["result"], {"machines": 2, "ram_size": 8, "cpu_count": 4, "hdd_size": 200})
+        self.assertEqual(responses[3]["result"]["items"][0]["hdd_size"], 100)
+        self.assertIn("resource", responses[4]["error"])
+
+    async def test_errors(self):
+        responses = await self.run_requests(
+            "not json",
+            {"id": 1, "op": "list_total_stats"},
+            {"id": 2, "op": "missing"},
+            {"id": 3, "op": "login", "args": {"username": "nobody"}},
+        )
+        self.assertIn("Invalid request", responses[None]["error"])
+        self.assertIn("Not logged in", responses[1]["error"])
+        self.assertIn("Unknown op", responses[2]["error"])
+        self.assertIn("spec", responses[3]["error"])
+
+
+class TestMetrics(ServerTestCase):
+    # Медленные команды сохраняются вместе с запросами SQL
+    storage = "sqlite"
+
+    async def asyncTearDown(self):
+        working_server.close_metrics()
+        sessions.clear()
+        await super().asyncTearDown()
+
+    async def test_disabled_by_default(self):
+        self.assertIsNone(working_server.metrics)
+        await create_user("user", "id1")
+
+    async def test_commands_and_helpers_are_measured(self):
+        registry = working_server.init_metrics(slow_threshold=0.0)
+        await create_client("id1", 1, 2, 3, "hdd")
+        writer = FakeWriter()
+        session = await add_current_connection("id1", "user", writer, (1, 2, 3, "hdd"))
+        reader = asyncio.StreamReader()
+        reader.feed_data(b"id1\r\n4\r\n2\r\n8\r\nhdd2\r\n")
+        log = StringIO()
+        with redirect_stdout(log):
+            await dispatch_command(reader, writer, session, "update_client_info\r\n")
+            await dispatch_command(reader, writer, session, "missing\r\n")
+
+        text = registry.render()
+        self.assertIn('vm_db_helper_duration_seconds_count{helper="create_client"} 1', text)
+        self.assertIn('vm_command_duration_seconds_count{command="update_client_info"} 1', text)
+        self.assertIn('vm_command_duration_seconds_bucket{command="update_client_info",le="+Inf"} 1', text)
+        self.assertIn("vm_unknown_commands_total 1", text)
+        self.assertIn("vm_sessions_active 1", text)
+        self.assertIn("vm_machines 1", text)
+
+        # Порог 0 - каждая команда считается медленной и сохраняется вместе со своими запросами SQL
+        slow = registry.slow_commands[-1]
+        self.assertEqual(slow["command"], "update_client_info")
+        self.assertTrue(any("FROM clients" in sql for sql in slow["sql"]))
+        # В журнал выводится одна строка на медленную команду, без текста запросов
+        lines = log.getvalue().splitlines()
+        self.assertEqual(len(lines), 1)
+        self.assertTrue(lines[0].startswith("Slow command 'update_client_info': "))
+
+    async def test_exporter(self):
+        working_server.init_metrics()
+        server = await working_server.start_metrics_server("127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        try:
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(b"GET /metrics HTTP/1.1\r\nHost: localhost\r\n\r\n")
+            response = await reader.read()
+            writer.close()
+        finally:
+            server.close()
+        self.assertTrue(response.startswith(b"HTTP/1.0 200 OK"))
+        self.assertIn(b"# TYPE vm_sessions_active gauge", response)
+
+
+class TestLookupCache(ServerTestCase):
+
+    def test_lru_and_ttl(self):
+        cache = LRUCache(maxsize=2, ttl=60)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        self.assertEqual(cache.get("a"), 1)
+        cache.set("c", 3)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), 1)
+        cache.ttl = -1
+        cache.set("d", 4)
+        self.assertIsNone(cache.get("d"))
+        stats = cache.get_stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["evictions"], stats["expirations"]), (2, 2, 2, 1))
+
+    async def test_login_lookup_is_cached_and_invalidated(self):
+        await create_user("user", "id1")
+        await create_client("id1", 1, 2, 3, "hdd")
+        self.assertEqual(await lookup_user("user"), ("id1", (1, 2, 3, "hdd")))
+        misses = client_cache.get_stats()["misses"]
+        self.assertEqual(await lookup_user("user"), ("id1", (1, 2, 3, "hdd")))
+        self.assertTrue(await client_exists("id1"))
+        self.assertEqual(client_cache.get_stats()["misses"], misses)
+
+        await update_client_info("id1", 4, 5, 6, "hdd2")
+        self.assertEqual(await lookup_user("user"), ("id1", (4, 5, 6, "hdd2")))
+
+        await remove_virtual_machine("id1")
+        self.assertEqual(await lookup_user("user"), (None, None))
+        self.assertFalse(await client_exists("id1"))
+
+        # Пользователь с тем же именем создается заново с новой машиной
+        await create_user("user", "id2")
+        await create_client("id2", 7, 8, 9, "hdd3")
+        self.assertEqual(await lookup_user("user"), ("id2", (7, 8, 9, "hdd3")))
+
+
+class TestConnectionLimits(ServerTestCase):
+
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        self.server = None
+
+    async def asyncTearDown(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        working_server.init_connection_limiter()
+        sessions.clear()
+        await super().asyncTearDown()
+
+    async def start(self, limit=working_server.MAX_LINE_LENGTH, **options):
+        working_server.init_connection_limiter(**options)
+        self.server = await asyncio.start_server(working_server.handle_client, "127.0.0.1", 0, limit=limit)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def login(self, port, username):
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        await reader.readuntil(b"Enter your username: ")
+        writer.write(f"{username}\r\n1\r\n1\r\n1\r\nhdd\r\n".encode())
+        await reader.readuntil(b"Type 'exit' to exit\r\n")
+        return reader, writer
+
+    # Ожидание выполнения условия, проверяемого в цикле событий сервера
+    async def wait_for(self, condition):
+        for _ in range(100):
+            if condition():
+                return
+            await asyncio.sleep(0.01)
+        self.fail("Condition was not reached")
+
+    async def test_queue_hands_over_slots(self):
+        limiter = working_server.ConnectionLimiter(max_sessions=1, queue_size=1, queue_timeout=1)
+        self.assertTrue(await limiter.acquire())
+        waiter = asyncio.create_task(limiter.acquire())
+        await asyncio.sleep(0)
+        self.assertFalse(await limiter.acquire())
+        limiter.release()
+        self.assertTrue(await waiter)
+        self.assertEqual((limiter.active, limiter.waiting, limiter.rejected), (1, 0, 1))
+
+        limiter.queue_timeout = 0.01
+        self.assertFalse(await limiter.acquire())
+        self.assertEqual(limiter.waiting, 0)
+        limiter.release()
+        self.assertEqual(limiter.active, 0)
+
+    async def test_reject_policy_and_idle_timeout(self):
+        port = await self.start(max_sessions=1, policy="reject", idle_timeout=0.2)
+        reader, writer = await self.login(port, "user")
+        self.assertIsNotNone(sessions.get((await lookup_user("user"))[0]))
+
+        busy_reader, busy_writer = await asyncio.open_connection("127.0.0.1", port)
+        self.assertEqual(await busy_reader.read(), b"Error: Server is busy, try again later\r\n")
+        busy_writer.close()
+
+        # Клиент не отправляет команд и отключается по истечении времени ожидания
+        self.assertEqual(await asyncio.wait_for(reader.read(), 2), b"")
+        writer.close()
+        self.assertEqual(len(sessions), 0)
+        self.assertEqual(working_server.get_connection_limiter().timed_out, 1)
+
+    async def test_abrupt_disconnect_removes_session(self):
+        port = await self.start()
+        reader, writer = await self.login(port, "user")
+        self.assertEqual(len(sessions), 1)
+        writer.transport.abort()
+        await self.wait_for(lambda: len(sessions) == 0)
+        await self.wait_for(lambda: working_server.get_connection_limiter().active == 0)
+
+    async def test_new_user_is_created_after_spec(self):
+        port = await self.start()
+        # Обрыв связи во время ввода характеристик не оставляет пользователя без машины
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        await reader.readuntil(b"Enter your username: ")
+        writer.write(b"user\r\n1\r\n")
+        await reader.readuntil(b"Enter CPU count: ")
+        writer.transport.abort()
+        await self.wait_for(lambda: working_server.get_connection_limiter().active == 0)
+        self.assertEqual(await lookup_user("user"), (None, None))
+
+        # Два одновременных входа нового пользователя: второй подключается к созданной первым машине
+        clients = []
+        for _ in range(2):
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            await reader.readuntil(b"Enter your username: ")
+            writer.write(b"user\r\n1\r\n1\r\n1\r\n")
+            await reader.readuntil(b"Enter HDD ID: ")
+            clients.append((reader, writer))
+        replies = []
+        for reader, writer in clients:
+            writer.write(b"hdd\r\n")
+            replies.append(await reader.readuntil(b"Type 'exit' to exit\r\n"))
+        self.assertIn(b"Client information saved", replies[0])
+        self.assertIn(b"User already exists. Connecting to virtual machine...", replies[1])
+        self.assertEqual(len(sessions), 1)
+        self.assertEqual(working_server.get_storage().operations, 1)
+        for reader, writer in clients:
+            writer.close()
+
+    async def test_too_long_line(self):
+        port = await self.start(limit=64)
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        await reader.readuntil(b"Enter your username: ")
+        writer.write(b"x" * 200 + b"\r\n")
+        self.assertIn(b"Error: Invalid or too long line", await reader.read())
+        writer.close()
+
+
+class TestEventBus(ServerTestCase):
+
+    async def test_slow_subscriber_queue_is_bounded(self):
+        bus = working_server.EventBus()
+        subscription = bus.subscribe(["vm_created", "stats"], maxsize=3)
+        for i in range(3):
+            bus.publish("stats", delta={"machines": 1}, totals={"machines": i + 1})
+        for i in range(4):
+            bus.publish("vm_created", client_id=f"id{i}")
+        bus.publish("connected", client_id="id0")
+        bus.publish("stats", delta={"machines": -1}, totals={"machines": 2})
+        bus.publish("stats", delta={"machines": -1}, totals={"machines": 1})
+        self.assertEqual((len(subscription), subscription.coalesced, subscription.dropped), (3, 3, 3))
+
+        events = [await subscription.get() for _ in range(4)]
+        self.assertEqual(events[0], {"type": "overflow", "dropped": 3, "time": events[0]["time"]})
+        self.assertEqual([event.get("client_id") for event in events[1:3]], ["id2", "id3"])
+        self.assertEqual((events[3]["delta"], events[3]["totals"]), ({"machines": -2}, {"machines": 1}))
+        subscription.close()
+        self.assertIsNone(await subscription.get())
+        with self.assertRaises(ValueError):
+            bus.subscribe(["unknown"])
+
+    async def test_events_from_mutations(self):
+        subscription = working_server.event_bus.subscribe()
+
+        async def types():
+            await asyncio.sleep(0)
+            return [event["type"] for event in await subscription.get_batch()]
+
+        try:
+            await create_user("user", "id1")
+            await create_client("id1", 1, 2, 3, "hdd")
+            self.assertEqual(await types(), ["vm_created", "stats"])
+            session = await add_current_connection("id1", "user", spec=(1, 2, 3, "hdd"))
+            await update_client_info("id1", 4, 2, 3, "hdd")
+            self.assertEqual(await types(), ["connected", "vm_updated", "stats"])
+            await remove_current_connection("id1", session)
+            await remove_virtual_machine("id1")
+            events = await subscription.get_batch()
+        finally:
+            subscription.close()
+        self.assertEqual([event["type"] for event in events], ["disconnected", "vm_removed", "stats"])
+        self.assertEqual(events[2]["delta"], {"machines": -1, "ram_size": -4, "cpu_count": -2, "hdd_size": -3})
+        self.assertEqual(events[2]["totals"], {"machines": 0, "ram_size": 0, "cpu_count": 0, "hdd_size": 0})
+        self.assertEqual(len(working_server.event_bus), 0)
+
+    async def test_subscribe_command(self):
+        reader = asyncio.StreamReader()
+        writer = FakeWriter()
+        session = working_server.Session("id0", "watcher")
+        task = asyncio.create_task(dispatch_command(reader, writer, session, "subscribe vm_created"))
+        await asyncio.sleep(0)
+        await create_user("user", "id1")
+        await create_client("id1", 1, 2, 3, "hdd")
+        await asyncio.sleep(0.01)
+        reader.feed_data(b"stop\r\n")
+        await task
+        lines = writer.output().splitlines()
+        self.assertEqual(lines[0], "Subscribed. Send any line to stop")
+        self.assertEqual(json.loads(lines[1][len("Event: "):])["client_id"], "id1")
+        self.assertEqual(lines[2:], ["Unsubscribed"])
+        self.assertEqual(len(working_server.event_bus), 0)
+
+
+class TestQuery(ServerTestCase):
+
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        machines = [("a", 4, 2, 100, "h1"), ("b", 8, 4, 300, "h1"), ("c", 16, 8, 200, "h2"), ("d", 16, 16, 50, "h3")]
+        for name, ram, cpu, hdd, hdd_id in machines:
+            await working_server.create_user_with_client(name, f"id-{name}", ram, cpu, hdd, hdd_id)
+
+    async def test_queries_with_and_without_filters(self):
+        query = working_server.query_clients
+        self.assertEqual(await query("summary"), (4, 44, 30, 650))
+        self.assertEqual(await query("summary", {"ram_size": (8, 16)}, hdd_id="h2"), (1, 16, 8, 200))
+        self.assertEqual(await query("histogram", field="ram_size", bucket=8), [(0, 1), (8, 1), (16, 2)])
+        self.assertEqual(await query("histogram", {"cpu_count": (4, None)}, field="ram_size"), [(8, 1), (16, 2)])
+        self.assertEqual([row[0] for row in await query("top", limit=2)], ["b", "c"])
+        self.assertEqual([row[0] for row in await query("top", {"ram_size": (16, 16)}, by="cpu_count")], ["d", "c"])
+        self.assertEqual(await query("hdd_by_id"), [("h1", 2, 400), ("h2", 1, 200), ("h3", 1, 50)])
+        self.assertEqual(await query("hdd_by_id", {"hdd_size": (None, 150)}), [("h1", 1, 100), ("h3", 1, 50)])
+
+        # Статистика дисков в памяти следует за изменениями машин
+        await update_client_info("id-a", 4, 2, 1000, "h3")
+        await remove_virtual_machine("id-b")
+        self.assertEqual(await query("hdd_by_id", limit=2), [("h3", 2, 1050), ("h2", 1, 200)])
+
+    async def test_query_command(self):
+        writer = FakeWriter()
+        await dispatch_command(None, writer, None, "query hdd_by_id ram=..8 limit=5")
+        self.assertEqual(writer.output(), "Total HDD size by HDD ID:\r\nHDD ID: h1, Machines: 2, Total HDD Size: 400\r\n"
+                                          "End of the list\r\n")
+        for line in ("query", "query top ram=8..4", "query histogram field=gpu", "query top limit=0"):
+            writer = FakeWriter()
+            await dispatch_command(None, writer, None, line)
+            self.assertTrue(writer.output().startswith("Error: "), line)
+
+
+class TestSqliteStorage(ServerTestCase):
+    storage = "sqlite"
+
+    async def asyncTearDown(self):
+        sessions.clear()
+        await super().asyncTearDown()
+
+    async def test_drift_is_detected_and_repaired(self):
+        await create_client("id1", "2", "2", "500", "001")
+        await execute_write(("DELETE FROM clients", ()))
+        self.assertFalse(await check_total_stats())
+        self.assertEqual(await get_total_stats(), (0, 0, 0))
+        self.assertEqual((await get_stats_aggregator()).resources["ram_size"].min, None)
+
+    async def test_snapshot(self):
+        await create_user("user", "id1")
+        await add_current_connection("id1", "user", spec=(1, 1, 1, "x"))
+        await add_current_connection("unknown", "ghost", spec=(1, 1, 1, "x"))
+        await snapshot_current_connections()
+        pool = await working_server.get_pool()
+        async with pool.reader() as db:
+            cursor = await db.execute("SELECT client_id FROM current_connections")
+            self.assertEqual(await cursor.fetchall(), [("id1",)])
+
+    async def test_removal_by_other_worker(self):
+        await create_user("user", "id1")
+        await create_client("id1", 1, 2, 3, "hdd")
+        await lookup_user("user")
+        async with (await working_server.get_pool()).writer() as db:
+            await db.execute("DELETE FROM clients")
+            await db.execute("DELETE FROM users")
+            await db.commit()
+        apply_change({"type": "client_removed", "client_id": "id1", "old": [1, 2, 3], "username": "user"})
+        self.assertEqual(await lookup_user("user"), (None, None))
+
+    async def test_cached_client_with_null_resources_exists(self):
+        # После миграции у машины могут быть столбцы характеристик NULL
+        await create_user("user", "id1")
+        await execute_write(("INSERT INTO clients VALUES ('id1', NULL, NULL, NULL, 'hdd')", ()))
+        self.assertEqual(await lookup_user("user"), ("id1", (None, None, None, "hdd")))
+        self.assertTrue(await client_exists("id1"))
+        client_cache.clear()
+        self.assertEqual(await working_server.get_client_info("id1"), ("user", (None, None, None, "hdd")))
+        self.assertTrue(await client_exists("id1"))
+
+    async def test_ranges_use_covering_indexes(self):
+        where, params = working_server.query_conditions({"hdd_size": (100, None)}, required="hdd_size")
+        rows = await working_server.fetch_all(
+            f"EXPLAIN QUERY PLAN SELECT COUNT(*), SUM(ram_size), SUM(cpu_count) FROM clients{where}", params
+        )
+        self.assertIn("USING COVERING INDEX idx_clients_hdd_size", " ".join(row[-1] for row in rows))
+
+
+# Те же проверки списков и запросов на хранилище SQLite
+class TestTotalStatsSqlite(TestTotalStats):
+    storage = "sqlite"
+
+
+class TestStreamedListsSqlite(TestStreamedLists):
+    storage = "sqlite"
+
+
+class TestQuerySqlite(TestQuery):
+    storage = "sqlite"
+
+
+class TestInventory(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db = inventory.connect(os.path.join(self.tmpdir.name, "inventory.db"))
+
+    def tearDown(self):
+        self.db.close()
+        self.tmpdir.cleanup()
+
+    def test_import_export_round_trip(self):
+        source = StringIO(
+            "username,client_id,ram_size,cpu_count,hdd_size,hdd_id\n"
+            "alice,a1,4,2,100,h1\n"
+            "bob,b1,,,,\n"
+            "carol,c1,x,1,1,h2\n"
+        )
+        rejects = StringIO()
+        result = inventory.import_records(self.db, source, "csv", batch_size=2, rejects=rejects)
+        self.assertEqual((result["records"], result["users"], result["clients"], result["rejected"]), (3, 2, 1, 1))
+        self.assertEqual(json.loads(rejects.getvalue())["record"], 3)
+
+        output = StringIO()
+        self.assertEqual(inventory.export_records(self.db, output, "ndjson"), 2)
+        rows = [json.loads(line) for line in output.getvalue().splitlines()]
+        self.assertEqual(rows[0], {"username": "alice", "client_id": "a1", "ram_size": 4, "cpu_count": 2,
+                                   "hdd_size": 100, "hdd_id": "h1"})
+        self.assertEqual(rows[1]["ram_size"], None)
+
+    def test_resume_after_interruption(self):
+        lines = [json.dumps({"username": f"user{i}", "client_id": f"id{i}", "ram_size": 1, "cpu_count": 1,
+                             "hdd_size": 1, "hdd_id": "h"}) + "\n" for i in range(10)]
+
+        def interrupted():
+            yield from lines[:7]
+            raise KeyboardInterrupt
+
+        with self.assertRaises(KeyboardInterrupt):
+            inventory.import_records(self.db, interrupted(), "ndjson", source="file", transaction_size=3)
+        # Сохранены две полные транзакции, незавершенная откачена
+        self.assertEqual(self.db.execute("SELECT records FROM import_progress").fetchone(), (6,))
+        self.assertEqual(self.db.execute("SELECT COUNT(*) FROM clients").fetchone(), (6,))
+
+        result = inventory.import_records(self.db, iter(lines), "ndjson", source="file", resume=True,
+                                          transaction_size=3)
+        self.assertEqual((result["resumed_at"], result["records"], result["clients"]), (6, 10, 4))
+        self.assertEqual(self.db.execute("SELECT COUNT(*) FROM clients").fetchone(), (10,))
+        self.assertIsNone(self.db.execute("SELECT records FROM import_progress").fetchone())
+
+
+class TestLoadTestReport(unittest.TestCase):
+
+    def test_percentiles_and_regressions(self):
+        recorder = load_test.Recorder()
+        for i in range(1, 101):
+            recorder.add("list_total_stats", i / 1000)
+        recorder.error("update_client_info", "Error: test")
+        options = load_test.parse_args(["--clients", "1", "--mix", "list_total_stats=1"])
+        result = load_test.summarize(recorder, 2.0, options)
+        report = result["commands"]["list_total_stats"]
+        self.assertEqual((report["p50_ms"], report["p95_ms"], report["p99_ms"]), (50, 95, 99))
+        self.assertEqual(result["throughput"], 50)
+
+        baseline = {"commands": {"list_total_stats": dict(report, p95_ms=70)}}
+        self.assertEqual(load_test.compare(result, baseline, 0.5, "p95_ms"), [])
+        self.assertEqual([r[0] for r in load_test.compare(result, baseline, 0.2, "p95_ms")], ["list_total_stats"])
+
+
 if __name__ == '__main__':
     unittest.main()
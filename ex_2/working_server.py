@@ -1,73 +1,1789 @@
+import abc
+import argparse
 import asyncio
+import bisect
+import collections
+import contextlib
+import contextvars
+import functools
+import heapq
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import signal
+import socket
+import sqlite3
+import tempfile
+import time
 import aiosqlite
 import uuid
 
 # Имя базы данных
 DATABASE_NAME = "clients.db"
 
+# Адрес и порт сервера
+HOST = '127.0.0.1'
+PORT = 8888
+# Максимальная длина строки запроса (пакетные запросы машиночитаемого режима могут быть длинными)
+MAX_LINE_LENGTH = 1 << 20
+# Максимальное количество одновременных подключений (None - без ограничения)
+MAX_SESSIONS = 10000
+# Поведение при достижении MAX_SESSIONS: "queue" - ждать освобождения места, "reject" - сразу отказать
+ACCEPT_POLICY = "queue"
+# Максимальное количество подключений, ожидающих свободного места
+ACCEPT_QUEUE_SIZE = 1000
+# Максимальное время ожидания свободного места (в секундах)
+ACCEPT_QUEUE_TIMEOUT = 10.0
+# Максимальное время ожидания строки от клиента (в секундах; None - без ограничения)
+IDLE_TIMEOUT = 600.0
+# Границы буфера записи: при превышении верхней drain ждет, пока буфер не опустится до нижней
+WRITE_HIGH_WATERMARK = 256 * 1024
+WRITE_LOW_WATERMARK = 64 * 1024
+# Максимальное время ожидания отправки данных клиенту, который их не читает (в секундах)
+WRITE_TIMEOUT = 30.0
+# Длина очереди входящих подключений сокета сервера
+LISTEN_BACKLOG = 1024
+# Время на завершение сессий при остановке рабочего процесса (в секундах)
+WORKER_SHUTDOWN_TIMEOUT = 30.0
+# Время ожидания готовности нового рабочего процесса при перезапуске (в секундах)
+WORKER_START_TIMEOUT = 30.0
+
+# Количество соединений на чтение в пуле
+POOL_SIZE = 4
+# Максимальное время ожидания свободного соединения (в секундах)
+POOL_TIMEOUT = 5.0
+# Настройки SQLite, применяемые к каждому соединению пула
+CONNECTION_PRAGMAS = (
+    # В режиме WAL фиксация без fsync каждой транзакции остается безопасной для целостности базы
+    "PRAGMA synchronous = NORMAL",
+    # Кэш страниц 64 МБ на соединение
+    "PRAGMA cache_size = -65536",
+    # Чтение файла базы через отображение в память (до 256 МБ)
+    "PRAGMA mmap_size = 268435456",
+    "PRAGMA foreign_keys = ON",
+    "PRAGMA busy_timeout = 5000",
+)
+
+# Миграции схемы базы данных. Номер последней примененной миграции хранится в PRAGMA user_version,
+# поэтому существующие файлы clients.db обновляются на месте при запуске сервера.
+MIGRATIONS = (
+    # 1: исходная схема
+    """
+    CREATE TABLE IF NOT EXISTS users (
+        username TEXT PRIMARY KEY,
+        client_id TEXT UNIQUE
+    );
+    CREATE TABLE IF NOT EXISTS clients (
+        client_id TEXT PRIMARY KEY,
+        ram_size TEXT,
+        cpu_count TEXT,
+        hdd_size TEXT,
+        hdd_id TEXT
+    );
+    CREATE TABLE IF NOT EXISTS current_connections (
+        client_id TEXT PRIMARY KEY
+    );
+    """,
+    # 2: целочисленные ресурсы с проверкой значений, индекс users(client_id) и внешний ключ
+    # из current_connections. Значения, которые нельзя перевести в положительное число, становятся NULL.
+    """
+    CREATE TABLE clients_new (
+        client_id TEXT PRIMARY KEY,
+        ram_size INTEGER CHECK (ram_size IS NULL OR (typeof(ram_size) = 'integer' AND ram_size > 0)),
+        cpu_count INTEGER CHECK (cpu_count IS NULL OR (typeof(cpu_count) = 'integer' AND cpu_count > 0)),
+        hdd_size INTEGER CHECK (hdd_size IS NULL OR (typeof(hdd_size) = 'integer' AND hdd_size > 0)),
+        hdd_id TEXT
+    );
+    INSERT INTO clients_new (client_id, ram_size, cpu_count, hdd_size, hdd_id)
+    SELECT
+        client_id,
+        CASE WHEN CAST(ram_size AS INTEGER) > 0 AND CAST(CAST(ram_size AS INTEGER) AS TEXT) = TRIM(ram_size)
+             THEN CAST(ram_size AS INTEGER) END,
+        CASE WHEN CAST(cpu_count AS INTEGER) > 0 AND CAST(CAST(cpu_count AS INTEGER) AS TEXT) = TRIM(cpu_count)
+             THEN CAST(cpu_count AS INTEGER) END,
+        CASE WHEN CAST(hdd_size AS INTEGER) > 0 AND CAST(CAST(hdd_size AS INTEGER) AS TEXT) = TRIM(hdd_size)
+             THEN CAST(hdd_size AS INTEGER) END,
+        hdd_id
+    FROM clients;
+    DROP TABLE clients;
+    ALTER TABLE clients_new RENAME TO clients;
+
+    CREATE TABLE current_connections_new (
+        client_id TEXT PRIMARY KEY REFERENCES users (client_id) ON DELETE CASCADE
+    );
+    INSERT INTO current_connections_new (client_id)
+    SELECT client_id FROM current_connections WHERE client_id IN (SELECT client_id FROM users);
+    DROP TABLE current_connections;
+    ALTER TABLE current_connections_new RENAME TO current_connections;
+
+    CREATE INDEX IF NOT EXISTS idx_users_client_id ON users (client_id);
+    """,
+    # 3: позиция продолжения прерванного импорта (inventory.py import --resume)
+    """
+    CREATE TABLE IF NOT EXISTS import_progress (
+        source TEXT PRIMARY KEY,
+        records INTEGER NOT NULL,
+        updated_at REAL NOT NULL
+    );
+    """,
+    # 4: покрывающие индексы для команды query. Каждый индекс начинается с ресурса, по диапазону которого
+    # выполняется отбор (сортировка для top, группировка для hdd_by_id), и содержит остальные ресурсы,
+    # поэтому запрос читает только нужный участок индекса, не обращаясь к таблице clients.
+    """
+    CREATE INDEX IF NOT EXISTS idx_clients_ram_size ON clients (ram_size, cpu_count, hdd_size);
+    CREATE INDEX IF NOT EXISTS idx_clients_cpu_count ON clients (cpu_count, ram_size, hdd_size);
+    CREATE INDEX IF NOT EXISTS idx_clients_hdd_size ON clients (hdd_size, ram_size, cpu_count);
+    CREATE INDEX IF NOT EXISTS idx_clients_hdd_id ON clients (hdd_id, hdd_size, ram_size, cpu_count);
+    """,
+)
+
+# Максимальная задержка перед фиксацией пакета изменений (в секундах)
+WRITE_BATCH_DELAY = 0.005
+# Максимальное количество операций записи в одной транзакции
+WRITE_BATCH_SIZE = 256
+# Количество строк списка, читаемых из базы и отправляемых клиенту за один раз
+LIST_CHUNK_SIZE = 500
+# Задержка повторной сверки статистики в режиме нескольких рабочих процессов (в секундах)
+STATS_CONFIRM_DELAY = 1.0
+# Интервал сохранения снимка текущих подключений в базу (в секундах, None - без снимков)
+CONNECTIONS_SNAPSHOT_INTERVAL = None
+# Интервал сверки агрегированной статистики с базой данных (в секундах, None - без сверки)
+STATS_CHECK_INTERVAL = 300
+# Размер кэшей пользователей и клиентов (количество записей)
+CACHE_SIZE = 10000
+# Время жизни записи кэша (в секундах)
+CACHE_TTL = 60.0
+
+
+# Пул долгоживущих соединений с базой данных.
+# Каждое соединение aiosqlite держит собственный фоновый поток, поэтому соединения
+# открываются один раз при запуске сервера: несколько соединений на чтение и одно на запись.
+class ConnectionPool:
+    def __init__(self, database=DATABASE_NAME, size=POOL_SIZE, timeout=POOL_TIMEOUT):
+        if size < 1:
+            raise ValueError("Pool size must be at least 1")
+        self.database = database
+        self.size = size
+        self.timeout = timeout
+        self._readers = asyncio.Queue()
+        self._writer = None
+        self._writer_lock = asyncio.Lock()
+        self._connections = []
+        self._stats = {
+            "reader_acquired": 0,
+            "writer_acquired": 0,
+            "waits": 0,
+            "timeouts": 0,
+            "wait_time": 0.0,
+        }
+
+    # Открытие всех соединений пула
+    async def open(self):
+        self._writer = await self._connect()
+        for _ in range(self.size):
+            db = await self._connect()
+            # Соединения на чтение не должны изменять базу данных
+            await db.execute("PRAGMA query_only = ON")
+            self._readers.put_nowait(db)
+
+    # Открытие одного соединения с настройками CONNECTION_PRAGMAS
+    async def _connect(self):
+        db = await aiosqlite.connect(self.database)
+        for pragma in CONNECTION_PRAGMAS:
+            await db.execute(pragma)
+        self._connections.append(db)
+        return db
+
+    # Закрытие всех соединений пула
+    async def close(self):
+        for db in self._connections:
+            await db.close()
+        self._connections.clear()
+        self._writer = None
+
+    # Ожидание ресурса с учетом таймаута и статистики ожидания
+    async def _wait(self, awaitable, kind):
+        started = time.perf_counter()
+        self._stats["waits"] += 1
+        try:
+            return await asyncio.wait_for(awaitable, self.timeout)
+        except asyncio.TimeoutError:
+            self._stats["timeouts"] += 1
+            raise TimeoutError(f"No free {kind} connection in the pool after {self.timeout} s") from None
+        finally:
+            self._stats["wait_time"] += time.perf_counter() - started
+
+    # Получение соединения на чтение
+    @contextlib.asynccontextmanager
+    async def reader(self):
+        if self._readers.empty():
+            db = await self._wait(self._readers.get(), "reader")
+        else:
+            db = self._readers.get_nowait()
+        self._stats["reader_acquired"] += 1
+        # Если текущая команда выбрана для поиска медленных команд, записываем ее запросы SQL
+        trace = _sql_trace.get()
+        if trace is not None:
+            await db.set_trace_callback(trace.append)
+        try:
+            yield db
+        finally:
+            if trace is not None:
+                await db.set_trace_callback(None)
+            self._readers.put_nowait(db)
+
+    # Получение единственного соединения на запись
+    @contextlib.asynccontextmanager
+    async def writer(self):
+        if self._writer_lock.locked():
+            await self._wait(self._writer_lock.acquire(), "writer")
+        else:
+            await self._writer_lock.acquire()
+        self._stats["writer_acquired"] += 1
+        try:
+            yield self._writer
+        finally:
+            self._writer_lock.release()
+
+    # Статистика использования пула
+    def get_stats(self):
+        stats = dict(self._stats)
+        stats["size"] = self.size
+        stats["readers_free"] = self._readers.qsize()
+        stats["readers_in_use"] = self.size - self._readers.qsize()
+        stats["writer_in_use"] = self._writer_lock.locked()
+        return stats
+
+
+# Функция для применения недостающих миграций схемы
+async def migrate_database(db):
+    # Режим WAL сохраняется в файле базы: читатели больше не блокируют писателя
+    await db.execute("PRAGMA journal_mode = WAL")
+
+    cursor = await db.execute("PRAGMA user_version")
+    version = (await cursor.fetchone())[0]
+    await cursor.close()
+    if version >= len(MIGRATIONS):
+        return version
+
+    # Перестройка таблиц требует отключения внешних ключей (вне транзакции)
+    await db.execute("PRAGMA foreign_keys = OFF")
+    try:
+        for number, script in enumerate(MIGRATIONS[version:], start=version + 1):
+            try:
+                await db.executescript(f"BEGIN; {script} PRAGMA user_version = {number}; COMMIT;")
+            except sqlite3.Error:
+                await db.rollback()
+                raise
+            version = number
+    finally:
+        await db.execute("PRAGMA foreign_keys = ON")
+
+    return version
+
+
+# Функция для проверки размера ресурса виртуальной машины (целое положительное число)
+def parse_resource_size(value):
+    size = int(value)
+    if size <= 0:
+        raise ValueError(f"Resource size must be positive: {value}")
+    return size
+
+
+# Характеристики машины в виде, в котором они хранятся в базе: [ram_size, cpu_count, hdd_size, hdd_id]
+def make_spec(ram_size, cpu_count, hdd_size, hdd_id):
+    return [_resource_value(ram_size), _resource_value(cpu_count), _resource_value(hdd_size), hdd_id]
+
+
+# Применение зафиксированного изменения к состоянию процесса: агрегированной статистике и реестру сессий,
+# и публикация соответствующих событий подписчикам. Вызывается как для изменений этого процесса,
+# так и для изменений, полученных от других рабочих процессов.
+def apply_change(event):
+    kind = event["type"]
+    stats = _total_stats
+    # Итоги до изменения нужны только для события stats, поэтому без подписчиков не вычисляются
+    before = stats.totals() if stats is not None and event_bus and kind.startswith("client_") else None
+    if kind.startswith("client_"):
+        if stats is not None:
+            stats.apply(event)
+        # Статистика загружается: изменение будет применено и к загружаемой статистике
+        if _stats_backlog is not None:
+            _stats_backlog.append(event)
+    if kind == "client_created":
+        client_cache.invalidate(event["client_id"])
+        event_bus.publish("vm_created", client_id=event["client_id"], spec=event["spec"])
+    elif kind == "client_updated":
+        client_cache.invalidate(event["client_id"])
+        sessions.update_spec(event["client_id"], event["spec"])
+        event_bus.publish("vm_updated", client_id=event["client_id"], spec=event["spec"])
+    elif kind == "client_removed":
+        invalidate_client(event["client_id"], event.get("username"))
+        session = sessions.remove(event["client_id"])
+        sessions.remove_remote(event["client_id"])
+        event_bus.publish("vm_removed", client_id=event["client_id"], username=event.get("username"))
+        if session is not None:
+            event_bus.publish("disconnected", client_id=event["client_id"], username=session.username)
+    elif kind == "session_added":
+        sessions.add_remote(event["client_id"], event["username"], event["spec"])
+        event_bus.publish("connected", client_id=event["client_id"], username=event["username"],
+                          spec=event["spec"])
+    elif kind == "session_removed":
+        sessions.remove_remote(event["client_id"])
+        event_bus.publish("disconnected", client_id=event["client_id"], username=event.get("username"))
+    if before is not None:
+        publish_stats_delta(stats, before)
+
+
+# Фиксация изменения: применение в этом процессе и рассылка остальным рабочим процессам
+def commit_change(event):
+    apply_change(event)
+    publish_cluster_event(event)
+
+
+# Текущий пул соединений сервера
+_pool = None
+
+
+# Функция для создания пула соединений
+async def init_pool(database=None, size=POOL_SIZE, timeout=POOL_TIMEOUT):
+    global _pool
+    await close_pool()
+    pool = ConnectionPool(database or DATABASE_NAME, size, timeout)
+    await pool.open()
+    _pool = pool
+    # Кэши относятся к базе данных прежнего пула
+    user_cache.clear()
+    client_cache.clear()
+    return pool
+
+
+# Функция для закрытия пула соединений
+async def close_pool():
+    global _pool
+    if _pool is not None:
+        pool, _pool = _pool, None
+        await pool.close()
+
+
+# Функция для получения пула соединений (создается при первом обращении)
+async def get_pool():
+    if _pool is None:
+        await init_pool()
+    return _pool
+
+
+# Метрики сервера в формате Prometheus.
+# По умолчанию метрики выключены (metrics is None): точки измерения проверяют только эту переменную,
+# поэтому без --metrics-port накладные расходы сводятся к одному сравнению на команду или запрос.
+# Счетчики и гистограммы обновляются в точках измерения, а датчики (gauges) вычисляются при запросе
+# метрик, поэтому не стоят ничего между запросами.
+
+# Границы интервалов гистограмм длительности (в секундах)
+METRICS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Количество хранимых медленных команд, доступных по адресу /slow
+SLOW_COMMANDS_KEPT = 100
+
+
+# Гистограмма длительностей с накопленными счетчиками по интервалам
+class Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(METRICS_BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(METRICS_BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+# Реестр метрик процесса
+class Metrics:
+    def __init__(self, slow_threshold=None, slow_sample_rate=1.0):
+        # (имя метрики, имя метки, значение метки) -> значение или гистограмма
+        self.counters = {}
+        self.histograms = {}
+        # Имя метрики -> (описание, функция без аргументов, возвращающая значение)
+        self.gauges = {}
+        self.help = {}
+        self.slow_threshold = slow_threshold
+        self.slow_sample_rate = slow_sample_rate
+        self.slow_commands = collections.deque(maxlen=SLOW_COMMANDS_KEPT)
+
+    # Описание метрики для вывода в строке # HELP
+    def describe(self, name, text):
+        self.help[name] = text
+
+    # Увеличение счетчика
+    def inc(self, name, value=1, label=None, label_value=None):
+        key = (name, label, label_value)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    # Добавление наблюдения в гистограмму
+    def observe(self, name, value, label=None, label_value=None):
+        key = (name, label, label_value)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(value)
+
+    # Регистрация датчика, значение которого вычисляется при выводе метрик
+    def gauge(self, name, text, func):
+        self.gauges[name] = func
+        self.help[name] = text
+
+    # Решение о трассировке SQL очередной команды для поиска медленных команд
+    def should_trace(self):
+        return self.slow_threshold is not None and random.random() < self.slow_sample_rate
+
+    # Сохранение медленной команды вместе с выполненными ею запросами SQL. В журнал выводится
+    # одна строка на команду, сами запросы доступны по адресу /slow
+    def record_slow(self, kind, name, elapsed, sql):
+        self.inc("vm_slow_commands_total", label="command", label_value=name)
+        entry = {"time": time.time(), "kind": kind, "command": name, "duration": elapsed, "sql": sql}
+        self.slow_commands.append(entry)
+        print(f"Slow {kind} '{name}': {elapsed * 1000:.1f} ms, {len(sql)} SQL statements")
+
+    # Вывод всех метрик в текстовом формате Prometheus
+    def render(self):
+        lines = []
+        typed = set()
+
+        def header(name, kind):
+            if name not in typed:
+                typed.add(name)
+                if name in self.help:
+                    lines.append(f"# HELP {name} {self.help[name]}")
+                lines.append(f"# TYPE {name} {kind}")
+
+        def labels(label, value, extra=""):
+            pairs = [f'{label}="{value}"'] if label is not None else []
+            if extra:
+                pairs.append(extra)
+            return "{" + ",".join(pairs) + "}" if pairs else ""
+
+        for (name, label, value), count in sorted(self.counters.items(), key=_metric_sort_key):
+            header(name, "counter")
+            lines.append(f"{name}{labels(label, value)} {count}")
+        for (name, label, value), histogram in sorted(self.histograms.items(), key=_metric_sort_key):
+            header(name, "histogram")
+            cumulative = 0
+            for bound, count in zip(METRICS_BUCKETS + ("+Inf",), histogram.counts):
+                cumulative += count
+                bucket_label = f'le="{bound}"'
+                lines.append(f"{name}_bucket{labels(label, value, bucket_label)} {cumulative}")
+            lines.append(f"{name}_sum{labels(label, value)} {histogram.sum}")
+            lines.append(f"{name}_count{labels(label, value)} {histogram.count}")
+        for name, func in self.gauges.items():
+            header(name, "gauge")
+            lines.append(f"{name} {func()}")
+        return "\n".join(lines) + "\n"
+
+
+# Ключ сортировки метрик: метрики без метки идут перед метриками с меткой
+def _metric_sort_key(item):
+    name, label, value = item[0]
+    return name, label or "", str(value or "")
+
+
+# Метрики процесса (None - метрики выключены)
+metrics = None
+# Запросы SQL, выполненные текущей командой, если она выбрана для трассировки
+_sql_trace = contextvars.ContextVar("sql_trace", default=None)
+
+
+# Декоратор для измерения длительности функций работы с базой данных
+def db_timer(func):
+    name = func.__name__
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        if metrics is None:
+            return await func(*args, **kwargs)
+        started = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            metrics.observe("vm_db_helper_duration_seconds", time.perf_counter() - started, "helper", name)
+    return wrapper
+
+
+# Выполнение команды с измерением длительности (kind - "command" для текстового протокола или "op" для JSON)
+async def observe_command(kind, name, coro):
+    trace = None
+    if metrics.slow_threshold is not None and metrics.should_trace():
+        trace = []
+        token = _sql_trace.set(trace)
+    started = time.perf_counter()
+    try:
+        return await coro
+    finally:
+        elapsed = time.perf_counter() - started
+        metrics.observe(f"vm_{kind}_duration_seconds", elapsed, kind, name)
+        if trace is not None:
+            _sql_trace.reset(token)
+            if elapsed >= metrics.slow_threshold:
+                metrics.record_slow(kind, name, elapsed, trace)
+
+
+# Суммарный и максимальный размер неотправленных данных в буферах записи сессий
+def _writer_buffers():
+    sizes = [
+        session.writer.transport.get_write_buffer_size()
+        for session in sessions
+        if session.writer is not None and getattr(session.writer, "transport", None) is not None
+    ]
+    return sum(sizes), max(sizes, default=0)
+
+
+# Функция для включения метрик процесса
+def init_metrics(slow_threshold=None, slow_sample_rate=1.0):
+    global metrics
+    registry = Metrics(slow_threshold, slow_sample_rate)
+    registry.describe("vm_connections_total", "Accepted client connections")
+    registry.describe("vm_disconnects_total", "Connections closed by the peer or by an error, by reason")
+    registry.describe("vm_bytes_written_total", "Bytes written to client connections")
+    registry.describe("vm_unknown_commands_total", "Lines that did not match a registered command")
+    registry.describe("vm_slow_commands_total", "Sampled commands slower than the slow command threshold")
+    registry.describe("vm_command_duration_seconds", "Text protocol command latency")
+    registry.describe("vm_op_duration_seconds", "JSON protocol operation latency")
+    registry.describe("vm_db_helper_duration_seconds", "Database helper latency")
+    registry.describe("vm_db_commit_duration_seconds", "Write queue transaction latency")
+
+    def pool_stat(name):
+        return lambda: _pool.get_stats()[name] if _pool is not None else 0
+
+    def queue_stat(name):
+        return lambda: _write_queue.get_stats()[name] if _write_queue is not None else 0
+
+    registry.gauge("vm_sessions_active", "Sessions connected to this process", lambda: len(sessions))
+    registry.gauge("vm_connections_active", "Open client connections including unauthenticated ones",
+                   lambda: _limiter.active if _limiter is not None else 0)
+    registry.gauge("vm_connections_queued", "Connections waiting for a free session slot",
+                   lambda: _limiter.waiting if _limiter is not None else 0)
+    registry.gauge("vm_connections_rejected", "Connections rejected by the session limit",
+                   lambda: _limiter.rejected if _limiter is not None else 0)
+    registry.gauge("vm_connections_timed_out", "Connections closed by the idle or write timeout",
+                   lambda: _limiter.timed_out if _limiter is not None else 0)
+    registry.gauge("vm_sessions_cluster", "Sessions connected to all processes", lambda: len(sessions.client_ids()))
+    registry.gauge("vm_writer_buffer_bytes", "Unsent bytes in all session write buffers",
+                   lambda: _writer_buffers()[0])
+    registry.gauge("vm_writer_buffer_max_bytes", "Largest unsent session write buffer",
+                   lambda: _writer_buffers()[1])
+    registry.gauge("vm_pool_readers_in_use", "Reader connections in use", pool_stat("readers_in_use"))
+    registry.gauge("vm_pool_waits", "Pool acquisitions that had to wait", pool_stat("waits"))
+    registry.gauge("vm_pool_timeouts", "Pool acquisitions that timed out", pool_stat("timeouts"))
+    registry.gauge("vm_write_queue_pending", "Operations waiting in the write queue", queue_stat("pending"))
+    registry.gauge("vm_write_queue_batches", "Committed write queue transactions", queue_stat("batches"))
+    registry.gauge("vm_write_queue_operations", "Committed write operations", queue_stat("operations"))
+    registry.gauge("vm_write_queue_failed_operations", "Failed write operations", queue_stat("failed_operations"))
+    for cache_name, cache in (("user", user_cache), ("client", client_cache)):
+        for stat in ("hits", "misses", "size"):
+            registry.gauge(f"vm_{cache_name}_cache_{stat}", f"{cache_name.capitalize()} cache {stat}",
+                           functools.partial(lambda c, k: c.get_stats()[k], cache, stat))
+    registry.gauge("vm_event_subscribers", "Active event subscriptions", lambda: len(event_bus))
+    registry.gauge("vm_events_published", "Events published to subscribers", lambda: event_bus.published)
+    registry.gauge("vm_events_dropped", "Events dropped from full subscriber queues of active subscriptions",
+                   lambda: event_bus.get_stats()["dropped"])
+    registry.gauge("vm_machines", "Virtual machines",
+                   lambda: _total_stats.machines if _total_stats is not None else 0)
+    metrics = registry
+    return registry
+
+
+# Функция для выключения метрик процесса
+def close_metrics():
+    global metrics
+    metrics = None
+
+
+# Обработчик HTTP-запроса к экспортеру метрик: /metrics - метрики, /slow - медленные команды в JSON
+async def handle_metrics_request(reader, writer):
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()).strip():
+            pass
+        parts = request_line.decode(errors="replace").split()
+        path = parts[1] if len(parts) > 1 else "/"
+        if metrics is None:
+            status, content_type, body = "503 Service Unavailable", "text/plain", "Metrics are disabled\n"
+        elif path.startswith("/slow"):
+            status, content_type = "200 OK", "application/json"
+            body = json.dumps(list(metrics.slow_commands), ensure_ascii=False)
+        else:
+            status, content_type, body = "200 OK", "text/plain; version=0.0.4", metrics.render()
+        body = body.encode()
+        writer.write(f"HTTP/1.0 {status}\r\nContent-Type: {content_type}\r\n"
+                     f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+        await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+# Функция для запуска экспортера метрик на отдельном порту
+# (reuse_port позволяет новому рабочему процессу занять порт до остановки заменяемого)
+async def start_metrics_server(host, port, reuse_port=False):
+    return await asyncio.start_server(handle_metrics_request, host, port, reuse_port=reuse_port or None)
+
+
+# Очередь записи с групповой фиксацией.
+# Все изменяющие операции выполняются единственной задачей-писателем: операции, пришедшие от разных
+# сессий за WRITE_BATCH_DELAY секунд (или до накопления WRITE_BATCH_SIZE операций), выполняются в одной
+# транзакции, после фиксации которой каждый вызывающий получает свой результат.
+class WriteQueue:
+    def __init__(self, pool, max_delay=WRITE_BATCH_DELAY, max_batch=WRITE_BATCH_SIZE):
+        if max_batch < 1:
+            raise ValueError("Batch size must be at least 1")
+        self.pool = pool
+        self.max_delay = max_delay
+        self.max_batch = max_batch
+        self._queue = asyncio.Queue()
+        self._task = None
+        self._stats = {
+            "batches": 0,
+            "operations": 0,
+            "statements": 0,
+            "failed_operations": 0,
+            "max_batch": 0,
+            "commit_time": 0.0,
+            "max_commit_time": 0.0,
+        }
+
+    # Запуск задачи-писателя
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    # Остановка задачи-писателя после выполнения уже поставленных в очередь операций.
+    # Операции, поставленные в очередь после остановки, завершаются ошибкой
+    async def stop(self):
+        if self._task is not None:
+            self._queue.put_nowait(None)
+            try:
+                await asyncio.wait([self._task])
+            finally:
+                self._task = None
+                self._fail_pending()
+
+    # Завершение ошибкой операций, которые уже не будут выполнены: невыполненных операций пакета
+    # и оставшихся в очереди
+    def _fail_pending(self, batch=()):
+        items = list(batch)
+        while not self._queue.empty():
+            items.append(self._queue.get_nowait())
+        for item in items:
+            if item is not None and not item[2].done():
+                self._stats["failed_operations"] += 1
+                item[2].set_exception(RuntimeError("Write queue is stopped"))
+
+    # Постановка операции в очередь.
+    # Операция - последовательность пар (SQL, параметры), выполняемая атомарно.
+    # Функция on_commit вызывается сразу после фиксации со строками, прочитанными запросами SELECT
+    # операции, до начала следующей транзакции. Возвращает суммарное количество измененных строк.
+    async def submit(self, statements, on_commit=None):
+        if self._task is None:
+            raise RuntimeError("Write queue is not running")
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((statements, on_commit, future))
+        return await future
+
+    # Основной цикл задачи-писателя
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        batch = []
+        try:
+            while not stopping:
+                item = await self._queue.get()
+                if item is None:
+                    break
+                batch = [item]
+                deadline = loop.time() + self.max_delay
+                while len(batch) < self.max_batch:
+                    if self._queue.empty():
+                        timeout = deadline - loop.time()
+                        if timeout <= 0:
+                            break
+                        try:
+                            item = await asyncio.wait_for(self._queue.get(), timeout)
+                        except asyncio.TimeoutError:
+                            break
+                    else:
+                        item = self._queue.get_nowait()
+                    if item is None:
+                        stopping = True
+                        break
+                    batch.append(item)
+                await self._commit_batch(batch)
+        finally:
+            # Писатель остановлен или отменен: операции текущего пакета и очереди не будут выполнены
+            self._fail_pending(batch)
+
+    # Выполнение пакета операций в одной транзакции
+    async def _commit_batch(self, batch):
+        results = []
+        started = time.perf_counter()
+        try:
+            async with self.pool.writer() as db:
+                await db.execute("BEGIN IMMEDIATE")
+                # Транзакция откатывается при любом исключении, в том числе при отмене задачи,
+                # иначе следующие пакеты не смогут начать транзакцию на этом соединении
+                try:
+                    for statements, _, _ in batch:
+                        results.append(await self._execute_operation(db, statements))
+                    await db.commit()
+                except BaseException:
+                    await db.rollback()
+                    raise
+        except Exception as e:
+            # Транзакция не зафиксирована: ошибку получают все операции пакета
+            self._stats["failed_operations"] += len(batch)
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        commit_time = time.perf_counter() - started
+        if metrics is not None:
+            metrics.observe("vm_db_commit_duration_seconds", commit_time)
+        self._stats["batches"] += 1
+        self._stats["operations"] += len(batch)
+        self._stats["statements"] += sum(len(statements) for statements, _, _ in batch)
+        self._stats["max_batch"] = max(self._stats["max_batch"], len(batch))
+        self._stats["commit_time"] += commit_time
+        self._stats["max_commit_time"] = max(self._stats["max_commit_time"], commit_time)
+
+        for (_, on_commit, future), result in zip(batch, results):
+            if isinstance(result, Exception):
+                self._stats["failed_operations"] += 1
+                if not future.done():
+                    future.set_exception(result)
+                continue
+            rowcount, rows = result
+            if on_commit is not None:
+                try:
+                    on_commit(rows)
+                except Exception as e:
+                    print(f"Warning: on_commit callback failed: {e!r}")
+            if not future.done():
+                future.set_result(rowcount)
+
+    # Выполнение одной операции внутри точки сохранения:
+    # ошибка одной операции откатывает только ее, не затрагивая остальные операции пакета
+    @staticmethod
+    async def _execute_operation(db, statements):
+        await db.execute("SAVEPOINT write_operation")
+        try:
+            rowcount = 0
+            rows = []
+            for sql, params in statements:
+                cursor = await db.execute(sql, params)
+                if cursor.description is not None:
+                    rows.extend(await cursor.fetchall())
+                rowcount += max(cursor.rowcount, 0)
+                await cursor.close()
+        except sqlite3.Error as e:
+            await db.execute("ROLLBACK TO write_operation")
+            await db.execute("RELEASE write_operation")
+            return e
+        await db.execute("RELEASE write_operation")
+        return rowcount, rows
+
+    # Статистика очереди записи
+    def get_stats(self):
+        stats = dict(self._stats)
+        stats["pending"] = self._queue.qsize()
+        stats["avg_batch"] = stats["operations"] / stats["batches"] if stats["batches"] else 0.0
+        stats["avg_commit_time"] = stats["commit_time"] / stats["batches"] if stats["batches"] else 0.0
+        return stats
+
+
+# Текущая очередь записи сервера
+_write_queue = None
+
+
+# Функция для запуска очереди записи
+async def init_write_queue(max_delay=WRITE_BATCH_DELAY, max_batch=WRITE_BATCH_SIZE):
+    global _write_queue
+    await close_write_queue()
+    queue = WriteQueue(await get_pool(), max_delay, max_batch)
+    queue.start()
+    _write_queue = queue
+    return queue
+
+
+# Функция для остановки очереди записи
+async def close_write_queue():
+    global _write_queue
+    if _write_queue is not None:
+        queue, _write_queue = _write_queue, None
+        await queue.stop()
+
+
+# Функция для получения очереди записи (запускается при первом обращении)
+async def get_write_queue():
+    if _write_queue is None:
+        await init_write_queue()
+    return _write_queue
+
+
+# Функция для выполнения изменяющей операции через очередь записи
+async def execute_write(*statements, on_commit=None):
+    trace = _sql_trace.get()
+    if trace is not None:
+        trace.extend(f"{' '.join(sql.split())} -- {params!r}" for sql, params in statements)
+    queue = await get_write_queue()
+    return await queue.submit(statements, on_commit)
+
+
+# Хранилище данных сервера.
+# Функции работы с данными (create_user, client_exists, iter_rows, init_total_stats, ...) обращаются
+# к текущему хранилищу, выбранному при запуске (--storage), и сами отвечают за кэши, статистику и события.
+# Изменяющие методы вызывают on_commit сразу после фиксации изменения, до следующего изменения,
+# поэтому порядок применения изменений к состоянию процесса совпадает с порядком их фиксации.
+# Нарушения уникальности и ограничений CHECK оба хранилища сообщают исключением sqlite3.IntegrityError.
+class Storage(abc.ABC):
+    name = None
+
+    async def open(self):
+        pass
+
+    async def close(self):
+        pass
+
+    # Создание пользователя; on_commit()
+    @abc.abstractmethod
+    async def create_user(self, username, client_id, on_commit=None):
+        raise NotImplementedError
+
+    # Создание машины клиента; on_commit()
+    @abc.abstractmethod
+    async def create_client(self, client_id, ram_size, cpu_count, hdd_size, hdd_id, on_commit=None):
+        raise NotImplementedError
+
+    # Атомарное создание пользователя вместе с машиной; on_commit()
+    @abc.abstractmethod
+    async def create_user_with_client(self, username, client_id, ram_size, cpu_count, hdd_size, hdd_id,
+                                      on_commit=None):
+        raise NotImplementedError
+
+    # Изменение машины; on_commit(old), old - прежние [ram_size, cpu_count, hdd_size, hdd_id] или None
+    @abc.abstractmethod
+    async def update_client(self, client_id, ram_size, cpu_count, hdd_size, hdd_id, on_commit=None):
+        raise NotImplementedError
+
+    # Удаление машины и ее пользователя; on_commit(old, username), old - характеристики машины или None
+    @abc.abstractmethod
+    async def remove_client(self, client_id, on_commit=None):
+        raise NotImplementedError
+
+    # Поиск пользователя: (client_id, (ram_size, cpu_count, hdd_size, hdd_id), есть ли машина) или None
+    @abc.abstractmethod
+    async def lookup_user(self, username):
+        raise NotImplementedError
+
+    # Поиск клиента: (username, (ram_size, cpu_count, hdd_size, hdd_id), есть ли машина) или None
+    @abc.abstractmethod
+    async def get_client(self, client_id):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def client_exists(self, client_id):
+        raise NotImplementedError
+
+    # Страница списка query (HARD_DISKS_PAGE_QUERY или EVER_CONNECTED_CLIENTS_PAGE_QUERY):
+    # строки с ключом больше key, не больше size строк
+    @abc.abstractmethod
+    async def page(self, query, key, size):
+        raise NotImplementedError
+
+    # Загрузка агрегированной статистики
+    @abc.abstractmethod
+    async def load_stats(self, stats):
+        raise NotImplementedError
+
+    # Сверка итогов; compare((машин, сумма RAM, сумма CPU, сумма HDD)) вызывается между изменениями
+    @abc.abstractmethod
+    async def check_totals(self, compare):
+        raise NotImplementedError
+
+    # Запрос по характеристикам машин с отбором (см. query_clients)
+    @abc.abstractmethod
+    async def query(self, kind, ranges, hdd_id, field, bucket, by, limit):
+        raise NotImplementedError
+
+    # Сохранение снимка текущих подключений
+    @abc.abstractmethod
+    async def save_connections(self, client_ids):
+        raise NotImplementedError
+
+    def get_stats(self):
+        return {"backend": self.name}
+
+
+# Хранилище в базе данных SQLite: пул соединений на чтение и очередь записи с групповой фиксацией
+class SqliteStorage(Storage):
+    name = "sqlite"
+
+    def __init__(self, database=None, pool_size=POOL_SIZE, pool_timeout=POOL_TIMEOUT,
+                 write_batch_delay=WRITE_BATCH_DELAY, write_batch_size=WRITE_BATCH_SIZE):
+        self.database = database
+        self.pool_size = pool_size
+        self.pool_timeout = pool_timeout
+        self.write_batch_delay = write_batch_delay
+        self.write_batch_size = write_batch_size
+
+    async def open(self):
+        pool = await init_pool(self.database, self.pool_size, self.pool_timeout)
+        # Приводим схему базы данных к актуальной версии
+        async with pool.writer() as db:
+            await migrate_database(db)
+        await init_write_queue(self.write_batch_delay, self.write_batch_size)
+
+    async def close(self):
+        await close_write_queue()
+        await close_pool()
+
+    async def create_user(self, username, client_id, on_commit=None):
+        await execute_write(
+            ("INSERT INTO users (username, client_id) VALUES (?, ?)", (username, client_id)),
+            on_commit=on_commit and (lambda rows: on_commit())
+        )
+
+    async def create_client(self, client_id, ram_size, cpu_count, hdd_size, hdd_id, on_commit=None):
+        await execute_write(
+            ("INSERT INTO clients (client_id, ram_size, cpu_count, hdd_size, hdd_id) VALUES (?, ?, ?, ?, ?)",
+             (client_id, ram_size, cpu_count, hdd_size, hdd_id)),
+            on_commit=on_commit and (lambda rows: on_commit())
+        )
+
+    async def create_user_with_client(self, username, client_id, ram_size, cpu_count, hdd_size, hdd_id,
+                                      on_commit=None):
+        await execute_write(
+            ("INSERT INTO users (username, client_id) VALUES (?, ?)", (username, client_id)),
+            ("INSERT INTO clients (client_id, ram_size, cpu_count, hdd_size, hdd_id) VALUES (?, ?, ?, ?, ?)",
+             (client_id, ram_size, cpu_count, hdd_size, hdd_id)),
+            on_commit=on_commit and (lambda rows: on_commit())
+        )
+
+    async def update_client(self, client_id, ram_size, cpu_count, hdd_size, hdd_id, on_commit=None):
+        # Прежние характеристики читаются в той же транзакции, что и обновление
+        await execute_write(
+            ("SELECT ram_size, cpu_count, hdd_size, hdd_id FROM clients WHERE client_id = ?", (client_id,)),
+            (
+                """
+                UPDATE clients
+                SET ram_size = ?, cpu_count = ?, hdd_size = ?, hdd_id = ?
+                WHERE client_id = ?
+                """,
+                (ram_size, cpu_count, hdd_size, hdd_id, client_id)
+            ),
+            on_commit=on_commit and (lambda rows: on_commit(list(rows[0]) if rows else None))
+        )
+
+    async def remove_client(self, client_id, on_commit=None):
+        # Удаляем виртуальную машину из таблиц клиентов, пользователей и текущих подключений одной операцией
+        await execute_write(
+            ("SELECT c.ram_size, c.cpu_count, c.hdd_size, c.hdd_id, u.username FROM clients c "
+             "LEFT JOIN users u ON u.client_id = c.client_id WHERE c.client_id = ?", (client_id,)),
+            ("DELETE FROM clients WHERE client_id = ?", (client_id,)),
+            ("DELETE FROM users WHERE client_id = ?", (client_id,)),
+            ("DELETE FROM current_connections WHERE client_id = ?", (client_id,)),
+            on_commit=on_commit and (
+                lambda rows: on_commit(list(rows[0][:4]), rows[0][4]) if rows else on_commit(None, None)
+            )
+        )
+
+    async def lookup_user(self, username):
+        rows = await fetch_all(
+            """
+            SELECT u.client_id, c.ram_size, c.cpu_count, c.hdd_size, c.hdd_id, c.client_id IS NOT NULL
+            FROM users u
+            LEFT JOIN clients c ON u.client_id = c.client_id
+            WHERE u.username = ?
+            """,
+            (username,)
+        )
+        return (rows[0][0], rows[0][1:5], bool(rows[0][5])) if rows else None
+
+    async def get_client(self, client_id):
+        rows = await fetch_all(
+            """
+            SELECT u.username, c.ram_size, c.cpu_count, c.hdd_size, c.hdd_id, c.client_id IS NOT NULL
+            FROM users u
+            LEFT JOIN clients c ON u.client_id = c.client_id
+            WHERE u.client_id = ?
+            """,
+            (client_id,)
+        )
+        return (rows[0][0], rows[0][1:5], bool(rows[0][5])) if rows else None
+
+    async def client_exists(self, client_id):
+        rows = await fetch_all("SELECT COUNT(*) FROM clients WHERE client_id = ?", (client_id,))
+        return rows[0][0] > 0
+
+    async def page(self, query, key, size):
+        return await fetch_all(query, (key, size))
+
+    async def load_stats(self, stats):
+        pool = await get_pool()
+        async with pool.reader() as db:
+            # Все запросы загрузки читают один снимок базы
+            await db.execute("BEGIN")
+            try:
+                await stats.load(db)
+            finally:
+                await db.rollback()
+
+    async def check_totals(self, compare):
+        # Запрос выполняется через очередь записи, поэтому между ним и сравнением не может быть
+        # зафиксировано других изменений
+        await execute_write(
+            ("SELECT COUNT(*), SUM(ram_size), SUM(cpu_count), SUM(hdd_size) FROM clients", ()),
+            on_commit=lambda rows: compare(tuple(value or 0 for value in rows[0]))
+        )
+
+    async def query(self, kind, ranges, hdd_id, field, bucket, by, limit):
+        if kind == "summary":
+            where, params = query_conditions(ranges, hdd_id)
+            rows = await fetch_all(
+                f"SELECT COUNT(*), SUM(ram_size), SUM(cpu_count), SUM(hdd_size) FROM clients{where}", params
+            )
+            return tuple(value or 0 for value in rows[0])
+        if kind == "histogram":
+            where, params = query_conditions(ranges, hdd_id, required=field)
+            return await fetch_all(
+                f"SELECT ({field} / ?) * ?, COUNT(*) FROM clients{where} GROUP BY 1 ORDER BY 1",
+                [bucket, bucket] + params
+            )
+        if kind == "top":
+            where, params = query_conditions(ranges, hdd_id, required=by)
+            return await fetch_all(
+                f"""
+                SELECT u.username, c.client_id, c.ram_size, c.cpu_count, c.hdd_size, c.hdd_id
+                FROM (SELECT rowid FROM clients{where} ORDER BY {by} DESC LIMIT ?) t
+                JOIN clients c ON c.rowid = t.rowid
+                LEFT JOIN users u ON u.client_id = c.client_id
+                ORDER BY c.{by} DESC
+                """,
+                params + [limit]
+            )
+        # '+hdd_id' не дает планировщику обойти весь индекс по hdd_id ради группировки:
+        # отбор по диапазону ресурса читает только подходящие строки
+        where, params = query_conditions(ranges, hdd_id, required="hdd_size")
+        return await fetch_all(
+            f"""
+            SELECT hdd_id, COUNT(*), SUM(hdd_size) AS total FROM clients{where}
+            GROUP BY +hdd_id ORDER BY total DESC, hdd_id LIMIT ?
+            """,
+            params + [limit]
+        )
+
+    async def save_connections(self, client_ids):
+        await execute_write(
+            ("DELETE FROM current_connections", ()),
+            (
+                """
+                INSERT INTO current_connections (client_id)
+                SELECT value FROM json_each(?) WHERE value IN (SELECT client_id FROM users)
+                """,
+                (json.dumps(client_ids),)
+            )
+        )
+
+
+# Проверка значения ресурса по ограничению CHECK столбцов таблицы clients: NULL или положительное целое.
+# Значения, не прошедшие проверку, отклоняются исключением sqlite3.IntegrityError, как в SqliteStorage
+def _checked_resource(column, value):
+    value = _resource_value(value)
+    if value is None or isinstance(value, int) and 0 < value < 2 ** 63:
+        return value
+    raise sqlite3.IntegrityError(
+        f"CHECK constraint failed: {column} IS NULL OR (typeof({column}) = 'integer' AND {column} > 0)"
+    )
+
+
+# Машина клиента в хранилище в памяти
+class MemoryMachine:
+    __slots__ = ("ram_size", "cpu_count", "hdd_size", "hdd_id")
+
+    def __init__(self, ram_size, cpu_count, hdd_size, hdd_id):
+        self.ram_size = _checked_resource("ram_size", ram_size)
+        self.cpu_count = _checked_resource("cpu_count", cpu_count)
+        self.hdd_size = _checked_resource("hdd_size", hdd_size)
+        self.hdd_id = None if hdd_id is None else str(hdd_id)
+
+    def spec(self):
+        return self.ram_size, self.cpu_count, self.hdd_size, self.hdd_id
+
+
+# Хранилище в памяти процесса (--storage memory): для тестов и для измерения накладных расходов протокола
+# без базы данных. Данные теряются при остановке и не разделяются между рабочими процессами.
+class MemoryStorage(Storage):
+    name = "memory"
+
+    # Характеристики пользователя без машины
+    NO_MACHINE = (None, None, None, None)
+
+    def __init__(self):
+        # username -> client_id и обратно
+        self.users = {}
+        self.owners = {}
+        # client_id -> MemoryMachine
+        self.machines = {}
+        # Идентификаторы клиентов пользователей по возрастанию (для постраничных списков)
+        self._user_ids = []
+        self.connections = set()
+        self.operations = 0
+        self._pages = {
+            HARD_DISKS_PAGE_QUERY: self._hard_disks_page,
+            EVER_CONNECTED_CLIENTS_PAGE_QUERY: self._ever_connected_page,
+        }
+
+    def _add_user(self, username, client_id):
+        self.users[username] = client_id
+        self.owners[client_id] = username
+        bisect.insort(self._user_ids, client_id)
+
+    def _check_user(self, username, client_id):
+        if username in self.users:
+            raise sqlite3.IntegrityError("UNIQUE constraint failed: users.username")
+        if client_id in self.owners:
+            raise sqlite3.IntegrityError("UNIQUE constraint failed: users.client_id")
+
+    def _check_client(self, client_id):
+        if client_id in self.machines:
+            raise sqlite3.IntegrityError("UNIQUE constraint failed: clients.client_id")
+
+    # Учет выполненного изменения и вызов on_commit
+    def _commit(self, on_commit, *args):
+        self.operations += 1
+        if on_commit is not None:
+            on_commit(*args)
+
+    async def create_user(self, username, client_id, on_commit=None):
+        self._check_user(username, client_id)
+        self._add_user(username, client_id)
+        self._commit(on_commit)
+
+    async def create_client(self, client_id, ram_size, cpu_count, hdd_size, hdd_id, on_commit=None):
+        self._check_client(client_id)
+        self.machines[client_id] = MemoryMachine(ram_size, cpu_count, hdd_size, hdd_id)
+        self._commit(on_commit)
+
+    async def create_user_with_client(self, username, client_id, ram_size, cpu_count, hdd_size, hdd_id,
+                                      on_commit=None):
+        self._check_user(username, client_id)
+        self._check_client(client_id)
+        # Машина создается до пользователя: при ошибке проверки ничего не изменяется
+        machine = MemoryMachine(ram_size, cpu_count, hdd_size, hdd_id)
+        self._add_user(username, client_id)
+        self.machines[client_id] = machine
+        self._commit(on_commit)
+
+    async def update_client(self, client_id, ram_size, cpu_count, hdd_size, hdd_id, on_commit=None):
+        machine = self.machines.get(client_id)
+        old = None
+        if machine is not None:
+            old = list(machine.spec())
+            self.machines[client_id] = MemoryMachine(ram_size, cpu_count, hdd_size, hdd_id)
+        self._commit(on_commit, old)
+
+    async def remove_client(self, client_id, on_commit=None):
+        machine = self.machines.pop(client_id, None)
+        username = self.owners.pop(client_id, None)
+        if username is not None:
+            del self.users[username]
+            del self._user_ids[bisect.bisect_left(self._user_ids, client_id)]
+        self.connections.discard(client_id)
+        if machine is None:
+            self._commit(on_commit, None, None)
+        else:
+            self._commit(on_commit, list(machine.spec()), username)
+
+    async def lookup_user(self, username):
+        client_id = self.users.get(username)
+        if client_id is None:
+            return None
+        machine = self.machines.get(client_id)
+        return client_id, machine.spec() if machine is not None else self.NO_MACHINE, machine is not None
+
+    async def get_client(self, client_id):
+        username = self.owners.get(client_id)
+        if username is None:
+            return None
+        machine = self.machines.get(client_id)
+        return username, machine.spec() if machine is not None else self.NO_MACHINE, machine is not None
+
+    async def client_exists(self, client_id):
+        return client_id in self.machines
+
+    async def page(self, query, key, size):
+        return self._pages[query](key, size)
+
+    # Пользователи с client_id больше key по возрастанию client_id
+    def _user_ids_after(self, key):
+        return itertools.islice(self._user_ids, bisect.bisect_right(self._user_ids, key), None)
+
+    def _hard_disks_page(self, key, size):
+        rows = []
+        for client_id in self._user_ids_after(key):
+            machine = self.machines.get(client_id)
+            if machine is not None:
+                rows.append((self.owners[client_id], machine.hdd_size, client_id))
+                if len(rows) == size:
+                    break
+        return rows
+
+    def _ever_connected_page(self, key, size):
+        rows = []
+        for client_id in itertools.islice(self._user_ids_after(key), size):
+            machine = self.machines.get(client_id)
+            rows.append((self.owners[client_id], client_id) + (machine.spec() if machine else self.NO_MACHINE))
+        return rows
+
+    async def load_stats(self, stats):
+        stats.reset()
+        for machine in self.machines.values():
+            stats.add_client(machine.spec())
+
+    async def check_totals(self, compare):
+        totals = [len(self.machines), 0, 0, 0]
+        for machine in self.machines.values():
+            totals[1] += machine.ram_size or 0
+            totals[2] += machine.cpu_count or 0
+            totals[3] += machine.hdd_size or 0
+        compare(tuple(totals))
+
+    # Машины, подходящие под отбор по диапазонам ресурсов и идентификатору диска
+    def _select(self, ranges, hdd_id, required=None):
+        for client_id, machine in self.machines.items():
+            if required is not None and getattr(machine, required) is None:
+                continue
+            if hdd_id is not None and machine.hdd_id != hdd_id:
+                continue
+            for column, (low, high) in ranges.items():
+                value = getattr(machine, column)
+                if value is None or low is not None and value < low or high is not None and value > high:
+                    break
+            else:
+                yield client_id, machine
+
+    async def query(self, kind, ranges, hdd_id, field, bucket, by, limit):
+        if kind == "summary":
+            stats = TotalStats()
+            for _, machine in self._select(ranges, hdd_id):
+                stats.add_client(machine.spec())
+            return stats.totals()
+        if kind == "histogram":
+            resource = ResourceStats()
+            for _, machine in self._select(ranges, hdd_id, required=field):
+                resource.add(getattr(machine, field))
+            return resource.histogram(bucket)
+        if kind == "top":
+            top = heapq.nlargest(limit, self._select(ranges, hdd_id, required=by),
+                                 key=lambda item: getattr(item[1], by))
+            return [(self.owners.get(client_id), client_id) + machine.spec() for client_id, machine in top]
+        stats = TotalStats()
+        for _, machine in self._select(ranges, hdd_id, required="hdd_size"):
+            stats.add_client(machine.spec())
+        return stats.top_disks(limit)
+
+    async def save_connections(self, client_ids):
+        self.connections = {client_id for client_id in client_ids if client_id in self.owners}
+
+    def get_stats(self):
+        return {"backend": self.name, "users": len(self.users), "machines": len(self.machines),
+                "operations": self.operations}
+
+
+# Доступные хранилища (--storage)
+STORAGE_BACKENDS = ("sqlite", "memory")
+# Хранилище по умолчанию
+STORAGE_BACKEND = "sqlite"
+
+# Текущее хранилище сервера
+_storage = None
+
+
+# Функция для открытия хранилища; options - параметры SqliteStorage (database, pool_size, ...)
+async def init_storage(backend=STORAGE_BACKEND, **options):
+    global _storage
+    await close_storage()
+    if backend not in STORAGE_BACKENDS:
+        raise ValueError(f"Unknown storage: {backend}. Storages: {', '.join(STORAGE_BACKENDS)}")
+    storage = SqliteStorage(**options) if backend == "sqlite" else MemoryStorage()
+    await storage.open()
+    _storage = storage
+    # Кэши и статистика относятся к данным прежнего хранилища
+    user_cache.clear()
+    client_cache.clear()
+    return storage
+
+
+# Функция для закрытия хранилища
+async def close_storage():
+    global _storage, _total_stats
+    if _storage is not None:
+        storage, _storage = _storage, None
+        await storage.close()
+        _total_stats = None
+
+
+# Функция для получения хранилища. Без init_storage используется SQLite с общим пулом соединений
+# (get_pool) и очередью записи (get_write_queue), которые создаются при первом обращении.
+def get_storage():
+    global _storage
+    if _storage is None:
+        _storage = SqliteStorage()
+    return _storage
+
 
 # Функция для создания нового пользователя
+@db_timer
 async def create_user(username, client_id):
-    async with aiosqlite.connect(DATABASE_NAME) as db:
-        await db.execute(
-            "INSERT INTO users (username, client_id) VALUES (?, ?)",
-            (username, client_id)
-        )
-        await db.commit()
+    await get_storage().create_user(username, client_id, on_commit=lambda: invalidate_client(client_id, username))
 
 
 # Функция для создания нового клиента (виртуальной машины)
+@db_timer
 async def create_client(client_id, ram_size, cpu_count, hdd_size, hdd_id):
-    async with aiosqlite.connect(DATABASE_NAME) as db:
-        await db.execute(
-            "INSERT INTO clients (client_id, ram_size, cpu_count, hdd_size, hdd_id) VALUES (?, ?, ?, ?, ?)",
-            (client_id, ram_size, cpu_count, hdd_size, hdd_id)
-        )
-        await db.commit()
+    await get_stats_aggregator()
+    spec = make_spec(ram_size, cpu_count, hdd_size, hdd_id)
+    await get_storage().create_client(
+        client_id, ram_size, cpu_count, hdd_size, hdd_id,
+        on_commit=lambda: commit_change({"type": "client_created", "client_id": client_id, "spec": spec})
+    )
+
+
+# Учет созданного пользователя с машиной после фиксации
+def on_user_created(username, client_id, spec):
+    invalidate_client(client_id, username)
+    commit_change({"type": "client_created", "client_id": client_id, "spec": spec})
+
+
+# Функция для создания пользователя вместе с его виртуальной машиной одной операцией записи
+@db_timer
+async def create_user_with_client(username, client_id, ram_size, cpu_count, hdd_size, hdd_id):
+    await get_stats_aggregator()
+    spec = make_spec(ram_size, cpu_count, hdd_size, hdd_id)
+    await get_storage().create_user_with_client(
+        username, client_id, ram_size, cpu_count, hdd_size, hdd_id,
+        on_commit=lambda: on_user_created(username, client_id, spec)
+    )
+
+
+# Функция для поиска пользователя при входе: один запрос возвращает идентификатор клиента
+# и характеристики его машины, которые сохраняются в кэшах для следующих входов
+@db_timer
+async def lookup_user(username):
+    client_id = user_cache.get(username)
+    if client_id is not None:
+        entry = client_cache.get(client_id)
+        if entry is not None:
+            return client_id, entry[1]
+
+    found = await get_storage().lookup_user(username)
+    if found is None:
+        return None, None
+    client_id, spec, has_machine = found
+    user_cache.set(username, client_id)
+    client_cache.set(client_id, (username, spec, has_machine))
+    return client_id, spec
+
+
+# Сессия подключенного клиента
+class Session:
+    __slots__ = ("client_id", "username", "writer", "peer", "connected_at", "last_activity", "spec")
+
+    def __init__(self, client_id, username=None, writer=None, spec=None):
+        self.client_id = client_id
+        self.username = username
+        self.writer = writer
+        self.peer = writer.get_extra_info("peername") if writer is not None else None
+        self.connected_at = time.time()
+        self.last_activity = self.connected_at
+        # Характеристики машины: (ram_size, cpu_count, hdd_size, hdd_id)
+        self.spec = spec if spec is not None else (None, None, None, None)
+
+    # Отметка активности клиента
+    def touch(self):
+        self.last_activity = time.time()
+
+    # Строка для вывода в списке текущих подключений
+    def row(self):
+        return (self.username, self.client_id) + tuple(self.spec)
+
+
+# Реестр текущих подключений сервера: client_id -> Session.
+# Текущие подключения - это состояние процесса, поэтому они хранятся в памяти,
+# а в таблицу current_connections при необходимости сохраняется только периодический снимок.
+class SessionRegistry:
+    def __init__(self):
+        self._sessions = {}
+        # Сессии, обслуживаемые другими рабочими процессами (режим --workers)
+        self._remote = {}
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def __iter__(self):
+        return iter(list(self._sessions.values()))
+
+    def get(self, client_id):
+        return self._sessions.get(client_id)
+
+    def add(self, session):
+        self._sessions[session.client_id] = session
+
+    # Удаление сессии; если передана session, удаляется только она (а не более новая сессия клиента)
+    def remove(self, client_id, session=None):
+        current = self._sessions.get(client_id)
+        if current is not None and (session is None or current is session):
+            del self._sessions[client_id]
+            return current
+        return None
+
+    def clear(self):
+        self._sessions.clear()
+        self._remote.clear()
+
+    # Учет сессии другого рабочего процесса
+    def add_remote(self, client_id, username, spec):
+        self._remote[client_id] = Session(client_id, username, spec=spec)
+
+    def remove_remote(self, client_id):
+        self._remote.pop(client_id, None)
+
+    # Обновление характеристик машины подключенного клиента
+    def update_spec(self, client_id, spec):
+        for registry in (self._sessions, self._remote):
+            session = registry.get(client_id)
+            if session is not None:
+                session.spec = tuple(spec)
+
+    # Идентификаторы клиентов, подключенных к этому и к другим рабочим процессам
+    def client_ids(self):
+        return list(self._remote.keys() | self._sessions.keys())
+
+    # Строки списка текущих подключений в порядке client_id (с постраничной выборкой)
+    def rows(self, after=None, limit=None):
+        client_ids = sorted(client_id for client_id in self.client_ids() if after is None or client_id > after)
+        if limit is not None:
+            client_ids = client_ids[:limit]
+        return [(self._sessions.get(client_id) or self._remote[client_id]).row() for client_id in client_ids]
+
+
+# Текущие подключения сервера
+sessions = SessionRegistry()
+
+
+# Типы событий, рассылаемых подписчикам (команда subscribe)
+EVENT_TYPES = ("connected", "disconnected", "vm_created", "vm_updated", "vm_removed", "stats")
+# Максимальное количество неотправленных событий одного подписчика
+SUBSCRIBER_QUEUE_SIZE = 1000
+
+
+# Подписка на события с ограниченной очередью.
+# Событие stats, еще не отправленное подписчику, объединяется с новым (изменения суммируются, итоги
+# заменяются последними), а при переполнении очереди отбрасываются самые старые события: медленный
+# подписчик теряет часть событий, но не задерживает сервер и не занимает неограниченную память.
+# Количество отброшенных событий сообщается подписчику событием overflow перед следующим событием.
+class Subscription:
+    def __init__(self, bus, types=None, maxsize=SUBSCRIBER_QUEUE_SIZE):
+        self.bus = bus
+        self.types = frozenset(types) if types else None
+        self.maxsize = maxsize
+        self.dropped = 0
+        self.coalesced = 0
+        self.closed = False
+        self._events = collections.deque()
+        # Неотправленное событие stats, с которым объединяются следующие
+        self._stats = None
+        # Отброшено событий с момента последнего уведомления overflow
+        self._lost = 0
+        self._ready = asyncio.Event()
+
+    def __len__(self):
+        return len(self._events)
+
+    # Добавление события в очередь подписчика (без ожидания)
+    def put(self, event):
+        if self.closed or (self.types is not None and event["type"] not in self.types):
+            return
+        if event["type"] == "stats" and self._stats is not None:
+            # Объединенное событие переносится в конец очереди: итоги соответствуют предшествующим событиям
+            self._events.remove(self._stats)
+            for name, value in event["delta"].items():
+                self._stats["delta"][name] = self._stats["delta"].get(name, 0) + value
+            self._stats["totals"] = event["totals"]
+            self._stats["time"] = event["time"]
+            self._events.append(self._stats)
+            self.coalesced += 1
+            return
+        if len(self._events) >= self.maxsize:
+            if self._events.popleft() is self._stats:
+                self._stats = None
+            self.dropped += 1
+            self._lost += 1
+        if event["type"] == "stats":
+            # Копия: изменения объединяются в событии этого подписчика, а не в общем событии шины
+            event = dict(event, delta=dict(event["delta"]))
+            self._stats = event
+        self._events.append(event)
+        self._ready.set()
+
+    # Получение следующего события; None - подписка закрыта
+    async def get(self):
+        while not self._events and not self.closed:
+            self._ready.clear()
+            await self._ready.wait()
+        if self._lost:
+            lost, self._lost = self._lost, 0
+            return {"type": "overflow", "dropped": lost, "time": time.time()}
+        if not self._events:
+            return None
+        event = self._events.popleft()
+        if event is self._stats:
+            self._stats = None
+        return event
+
+    # Получение всех накопившихся событий (не больше limit) одним вызовом; пустой список - подписка закрыта
+    async def get_batch(self, limit=SUBSCRIBER_QUEUE_SIZE):
+        event = await self.get()
+        if event is None:
+            return []
+        batch = [event]
+        while self._events and len(batch) < limit:
+            batch.append(await self.get())
+        return batch
+
+    # Отмена подписки; ожидающий get возвращает None
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.bus.unsubscribe(self)
+            self._ready.set()
+
+
+# Внутренняя шина событий процесса (публикация и подписка).
+# Функции записи и реестр сессий публикуют события после фиксации изменений, в том числе изменений,
+# полученных от других рабочих процессов. Публикация не ждет подписчиков и ничего не делает без них.
+class EventBus:
+    def __init__(self):
+        self._subscribers = set()
+        self.published = 0
+
+    def __len__(self):
+        return len(self._subscribers)
+
+    def subscribe(self, types=None, maxsize=SUBSCRIBER_QUEUE_SIZE):
+        unknown = set(types or ()) - set(EVENT_TYPES)
+        if unknown:
+            raise ValueError(f"Unknown event types: {', '.join(sorted(unknown))}")
+        subscription = Subscription(self, types, maxsize)
+        self._subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        self._subscribers.discard(subscription)
+
+    # Рассылка события всем подписчикам
+    def publish(self, kind, **fields):
+        if not self._subscribers:
+            return
+        fields["type"] = kind
+        fields["time"] = time.time()
+        self.published += 1
+        for subscription in list(self._subscribers):
+            subscription.put(fields)
+
+    def get_stats(self):
+        subscribers = list(self._subscribers)
+        return {"subscribers": len(subscribers), "published": self.published,
+                "queued": sum(len(s) for s in subscribers),
+                "dropped": sum(s.dropped for s in subscribers),
+                "coalesced": sum(s.coalesced for s in subscribers)}
+
+
+# Шина событий сервера
+event_bus = EventBus()
+
+
+# Публикация изменения агрегированной статистики: изменения количества машин и сумм ресурсов и новые итоги
+def publish_stats_delta(stats, before):
+    after = stats.totals()
+    names = ("machines",) + TotalStats.RESOURCES
+    event_bus.publish("stats", delta={name: new - old for name, old, new in zip(names, before, after)},
+                      totals=dict(zip(names, after)))
+
+
+# Кэш с вытеснением давно не использованных записей (LRU) и ограниченным временем жизни записей.
+# Используется для чтения через кэш: промах заполняется запросом к базе, а функции записи
+# удаляют затронутые записи после фиксации изменений.
+class LRUCache:
+    def __init__(self, maxsize=CACHE_SIZE, ttl=CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # Ключ -> (значение, время устаревания)
+        self._entries = collections.OrderedDict()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0, "invalidations": 0}
+
+    def __len__(self):
+        return len(self._entries)
+
+    # Получение значения (None, если записи нет или она устарела)
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            self._stats["misses"] += 1
+            return None
+        if entry[1] < time.monotonic():
+            del self._entries[key]
+            self._stats["expirations"] += 1
+            self._stats["misses"] += 1
+            return None
+        self._entries.move_to_end(key)
+        self._stats["hits"] += 1
+        return entry[0]
+
+    # Сохранение значения с вытеснением самой давно использованной записи при переполнении
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+        self._entries[key] = (value, time.monotonic() + self.ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self._stats["evictions"] += 1
+
+    # Удаление записи после изменения данных; возвращает удаленное значение
+    def invalidate(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return None
+        self._stats["invalidations"] += 1
+        return entry[0]
+
+    def clear(self):
+        self._entries.clear()
+
+    # Статистика кэша
+    def get_stats(self):
+        stats = dict(self._stats)
+        stats["size"] = len(self._entries)
+        requests = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / requests if requests else 0.0
+        return stats
+
+
+# Кэш пользователей: username -> client_id
+user_cache = LRUCache()
+# Кэш клиентов: client_id -> (username, характеристики машины (ram_size, cpu_count, hdd_size, hdd_id),
+# есть ли машина). Наличие машины хранится отдельно: столбцы характеристик могут содержать NULL
+client_cache = LRUCache()
+
+
+# Удаление из кэшей клиента и его пользователя
+def invalidate_client(client_id, username=None):
+    entry = client_cache.invalidate(client_id)
+    if username is None and entry is not None:
+        username = entry[0]
+    if username is not None:
+        user_cache.invalidate(username)
+
+
+# Функция для настройки размера и времени жизни кэшей
+def configure_caches(size=CACHE_SIZE, ttl=CACHE_TTL):
+    for cache in (user_cache, client_cache):
+        cache.maxsize = size
+        cache.ttl = ttl
+        cache.clear()
+
+
+# Функция для получения имени пользователя и характеристик машины клиента
+@db_timer
+async def get_client_info(client_id):
+    entry = client_cache.get(client_id)
+    if entry is not None:
+        return entry[:2]
+
+    found = await get_storage().get_client(client_id)
+    if found is None:
+        return None, None
+    client_cache.set(client_id, found)
+    return found[:2]
 
 
 # Функция для добавления текущего подключения
-async def add_current_connection(client_id):
-    async with aiosqlite.connect(DATABASE_NAME) as db:
-        await db.execute(
-            "INSERT INTO current_connections (client_id) VALUES (?)",
-            (client_id,)
-        )
-        await db.commit()
+async def add_current_connection(client_id, username=None, writer=None, spec=None):
+    # Характеристики машины запоминаются в сессии при подключении, чтобы список
+    # текущих подключений не обращался к базе данных
+    if username is None or spec is None:
+        known_username, known_spec = await get_client_info(client_id)
+        username = username if username is not None else known_username
+        spec = spec if spec is not None else known_spec
+    session = Session(client_id, username, writer, spec)
+    sessions.add(session)
+    publish_cluster_event(
+        {"type": "session_added", "client_id": client_id, "username": username, "spec": list(session.spec)}
+    )
+    event_bus.publish("connected", client_id=client_id, username=username, spec=list(session.spec))
+    return session
 
 
 # Функция для удаления текущего подключения
-async def remove_current_connection(client_id):
-    async with aiosqlite.connect(DATABASE_NAME) as db:
-        await db.execute(
-            "DELETE FROM current_connections WHERE client_id = ?",
-            (client_id,)
-        )
-        await db.commit()
+async def remove_current_connection(client_id, session=None):
+    removed = sessions.remove(client_id, session)
+    if removed is not None:
+        publish_cluster_event({"type": "session_removed", "client_id": client_id, "username": removed.username})
+        event_bus.publish("disconnected", client_id=client_id, username=removed.username)
 
 
 # Функция для очистки текущих подключений
+@db_timer
 async def clear_current_connections():
-    async with aiosqlite.connect(DATABASE_NAME) as db:
-        await db.execute("DELETE FROM current_connections")
-        await db.commit()
+    sessions.clear()
+    await get_storage().save_connections([])
+
+
+# Функция для сохранения снимка текущих подключений в хранилище (таблицу current_connections)
+@db_timer
+async def snapshot_current_connections():
+    await get_storage().save_connections(sessions.client_ids())
+
+
+# Периодическое сохранение снимка текущих подключений (для разбора после аварийного завершения)
+async def snapshot_current_connections_periodically(interval=CONNECTIONS_SNAPSHOT_INTERVAL):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await snapshot_current_connections()
+        except Exception as e:
+            print(f"Warning: current connections snapshot failed: {e!r}")
 
 
 # Функция для проверки существования клиента
+@db_timer
 async def client_exists(client_id):
-    async with aiosqlite.connect(DATABASE_NAME) as db:
-        cursor = await db.execute("SELECT COUNT(*) FROM clients WHERE client_id = ?", (client_id,))
-        count = await cursor.fetchone()
-        await cursor.close()
+    entry = client_cache.get(client_id)
+    if entry is not None:
+        return entry[2]
 
-    return count[0] > 0
+    return await get_storage().client_exists(client_id)
 
 
 # Обработчик удаления виртуальной машины
 async def handle_remove_virtual_machine(reader, writer, client_id):
     writer.write(b"Enter client_id to remove the virtual machine: ")
     await writer.drain()
-    client_id_to_remove = (await reader.readuntil(b'\n')).decode().strip()
+    client_id_to_remove = (await read_line(reader)).decode().strip()
 
     if client_id == client_id_to_remove:
         writer.write(b"Removing your own virtual machine. Disconnecting...\r\n")
@@ -86,28 +1802,26 @@ async def handle_remove_virtual_machine(reader, writer, client_id):
             await writer.drain()
 
 
+@db_timer
 async def remove_virtual_machine(client_id):
-    async with aiosqlite.connect(DATABASE_NAME) as db:
-        # Удаляем виртуальную машину из таблицы клиентов
-        await db.execute("DELETE FROM clients WHERE client_id = ?", (client_id,))
-        # Удаляем виртуальную машину из таблицы пользователей
-        await db.execute("DELETE FROM users WHERE client_id = ?", (client_id,))
+    await get_stats_aggregator()
 
-        try:
-            # Удаляем запись из таблицы текущих подключений
-            await db.execute("DELETE FROM current_connections WHERE client_id = ?", (client_id,))
-        except aiosqlite.IntegrityError as e:
-            # Обработка ошибки ограничения UNIQUE (client_id не найден в current_connections)
-            print(f"Warning: {e}")
+    # Исключаем машину из статистики, если она была найдена в момент удаления, и отключаем ее сессию
+    def on_commit(old, username):
+        if old is not None:
+            commit_change({"type": "client_removed", "client_id": client_id, "old": old, "username": username})
+        else:
+            invalidate_client(client_id)
+            sessions.remove(client_id)
 
-        await db.commit()
+    await get_storage().remove_client(client_id, on_commit=on_commit)
 
 
 # Обработчик обновления информации о клиенте
 async def handle_update_client_info(reader, writer):
     writer.write(b"Enter client_id to update client information: ")
     await writer.drain()
-    client_id_to_update = (await reader.readuntil(b'\n')).decode().strip()
+    client_id_to_update = (await read_line(reader)).decode().strip()
 
     # Проверяем существование клиента с указанным ID
     if not await client_exists(client_id_to_update):
@@ -117,19 +1831,29 @@ async def handle_update_client_info(reader, writer):
 
     writer.write(b"Enter new RAM size: ")
     await writer.drain()
-    new_ram_size = (await reader.readuntil(b'\n')).decode().strip()
+    new_ram_size = (await read_line(reader)).decode().strip()
 
     writer.write(b"Enter new CPU count: ")
     await writer.drain()
-    new_cpu_count = (await reader.readuntil(b'\n')).decode().strip()
+    new_cpu_count = (await read_line(reader)).decode().strip()
 
     writer.write(b"Enter new HDD size: ")
     await writer.drain()
-    new_hdd_size = (await reader.readuntil(b'\n')).decode().strip()
+    new_hdd_size = (await read_line(reader)).decode().strip()
 
     writer.write(b"Enter new HDD ID: ")
     await writer.drain()
-    new_hdd_id = (await reader.readuntil(b'\n')).decode().strip()
+    new_hdd_id = (await read_line(reader)).decode().strip()
+
+    # Размеры ресурсов хранятся в базе как целые положительные числа
+    try:
+        new_ram_size = parse_resource_size(new_ram_size)
+        new_cpu_count = parse_resource_size(new_cpu_count)
+        new_hdd_size = parse_resource_size(new_hdd_size)
+    except ValueError:
+        writer.write(b"Error: RAM size, CPU count and HDD size must be positive integers\r\n")
+        await writer.drain()
+        return
 
     await update_client_info(client_id_to_update, new_ram_size, new_cpu_count, new_hdd_size, new_hdd_id)
 
@@ -137,133 +1861,560 @@ async def handle_update_client_info(reader, writer):
     await writer.drain()
 
 
+# Запросы постраничного чтения списков. Страницы выбираются по ключу (keyset pagination):
+# каждый запрос начинается после последнего ключа предыдущей страницы и использует индекс,
+# поэтому стоимость страницы не зависит от ее номера и размера таблицы.
+HARD_DISKS_PAGE_QUERY = """
+    SELECT u.username, c.hdd_size, c.client_id
+    FROM users u
+    JOIN clients c ON u.client_id = c.client_id
+    WHERE c.client_id > ?
+    ORDER BY c.client_id
+    LIMIT ?
+"""
+EVER_CONNECTED_CLIENTS_PAGE_QUERY = """
+    SELECT u.username, u.client_id, c.ram_size, c.cpu_count, c.hdd_size, c.hdd_id
+    FROM users u
+    LEFT JOIN clients c ON u.client_id = c.client_id
+    WHERE u.client_id > ?
+    ORDER BY u.client_id
+    LIMIT ?
+"""
+
+
+# Постраничное чтение строк запроса порциями по chunk_size строк.
+# Соединение берется из пула только на время чтения одной порции, поэтому медленный клиент
+# не удерживает соединение, а в памяти находится не больше одной порции.
+async def iter_rows(query, key_index, after=None, limit=None, chunk_size=LIST_CHUNK_SIZE):
+    key = after or ""
+    remaining = limit
+    while remaining is None or remaining > 0:
+        size = chunk_size if remaining is None else min(chunk_size, remaining)
+        rows = await get_storage().page(query, key, size)
+        if not rows:
+            return
+        yield rows
+        if len(rows) < size:
+            return
+        if remaining is not None:
+            remaining -= len(rows)
+        key = rows[-1][key_index]
+
+
+# Разбор необязательных аргументов постраничного вывода: after=<client_id> limit=<число>
+def parse_list_args(args):
+    after, limit = None, None
+    for arg in args:
+        name, _, value = arg.partition("=")
+        if name == "after" and value:
+            after = value
+        elif name == "limit" and value.isdigit() and int(value) > 0:
+            limit = int(value)
+        else:
+            raise ValueError(f"Invalid argument: {arg}")
+    return after, limit
+
+
+# Потоковый вывод списка: каждая порция строк форматируется в один буфер и отправляется
+# одной записью с одним ожиданием drain
+async def write_rows(writer, header, rows_iter, format_row, key_index, limit):
+    writer.write(header)
+    count = 0
+    last_key = None
+    async for rows in rows_iter:
+        writer.write("".join(map(format_row, rows)).encode())
+        await writer.drain()
+        count += len(rows)
+        last_key = rows[-1][key_index]
+
+    # Если список обрезан ограничением, сообщаем ключ для запроса следующей страницы
+    if limit is not None and count == limit:
+        writer.write(f"Next page: after={last_key} limit={limit}\r\n".encode())
+    writer.write(b"End of the list\r\n")
+    await writer.drain()
+
+
 # Функция для получения списка жестких дисков
+@db_timer
 async def list_hard_disks():
-    async with aiosqlite.connect(DATABASE_NAME) as db:
-        cursor = await db.execute(
-            """
-            SELECT u.username, c.hdd_size
-            FROM users u
-            JOIN clients c ON u.client_id = c.client_id
-            """
-        )
-        hard_disks = await cursor.fetchall()
-        await cursor.close()
-
+    hard_disks = []
+    async for rows in iter_rows(HARD_DISKS_PAGE_QUERY, 2):
+        hard_disks.extend(row[:2] for row in rows)
     return hard_disks
 
 
 # Обработчик вывода списка жестких дисков
-async def handle_list_hard_disks(reader, writer):
-    writer.write(b"List of hard disks:\r\n")
-    await writer.drain()
-
-    hard_disks = await list_hard_disks()
-
-    for disk in hard_disks:
-        disk_info = f"Username: {disk[0]}, HDD Size: {disk[1]}\r\n"
-        writer.write(disk_info.encode())
+async def handle_list_hard_disks(reader, writer, args=()):
+    try:
+        after, limit = parse_list_args(args)
+    except ValueError as e:
+        writer.write(f"Error: {e}\r\n".encode())
         await writer.drain()
+        return
 
-    writer.write(b"End of the list\r\n")
-    await writer.drain()
+    await write_rows(
+        writer, b"List of hard disks:\r\n",
+        iter_rows(HARD_DISKS_PAGE_QUERY, 2, after, limit),
+        lambda disk: f"Username: {disk[0]}, HDD Size: {disk[1]}\r\n",
+        2, limit
+    )
 
 
 # Функция для получения списка всех подключенных клиентов
+@db_timer
 async def list_ever_connected_clients():
-    async with aiosqlite.connect(DATABASE_NAME) as db:
-        cursor = await db.execute(
-            """
-            SELECT u.username, c.client_id, c.ram_size, c.cpu_count, c.hdd_size, c.hdd_id
-            FROM users u
-            LEFT JOIN clients c ON u.client_id = c.client_id
-            """
-        )
-        clients = await cursor.fetchall()
-        await cursor.close()
-
+    clients = []
+    async for rows in iter_rows(EVER_CONNECTED_CLIENTS_PAGE_QUERY, 1):
+        clients.extend(rows)
     return clients
 
 
 # Обработчик вывода списка всех подключенных клиентов
-async def handle_list_ever_connected_clients(reader, writer):
-    writer.write(b"List of ever connected clients:\r\n")
-    await writer.drain()
+async def handle_list_ever_connected_clients(reader, writer, args=()):
+    try:
+        after, limit = parse_list_args(args)
+    except ValueError as e:
+        writer.write(f"Error: {e}\r\n".encode())
+        await writer.drain()
+        return
 
-    clients = await list_ever_connected_clients()
+    await write_rows(
+        writer, b"List of ever connected clients:\r\n",
+        iter_rows(EVER_CONNECTED_CLIENTS_PAGE_QUERY, 1, after, limit),
+        lambda client: f"Username: {client[0]}, Client ID: {client[1]}, RAM: {client[2]}, CPU: {client[3]}, "
+                       f"HDD Size: {client[4]}, HDD ID: {client[5]}\r\n",
+        1, limit
+    )
 
-    for client in clients:
-        client_info = f"Username: {client[0]}, Client ID: {client[1]}, RAM: {client[2]}, CPU: {client[3]}, HDD Size: " \
-                      f"{client[4]}, HDD ID: {client[5]}\r\n "
-        writer.write(client_info.encode())
-        await writer.drain()
 
-    writer.write(b"End of the list\r\n")
-    await writer.drain()
+# Постраничная выдача строк реестра текущих подключений порциями по chunk_size строк
+async def iter_current_connections(after=None, limit=None, chunk_size=LIST_CHUNK_SIZE):
+    rows = sessions.rows(after, limit)
+    for i in range(0, len(rows), chunk_size):
+        yield rows[i:i + chunk_size]
 
 
 # Функция для получения списка текущих подключений
 async def list_current_connections():
-    async with aiosqlite.connect(DATABASE_NAME) as db:
-        cursor = await db.execute(
-            """
-            SELECT u.username, c.client_id, c.ram_size, c.cpu_count, c.hdd_size, c.hdd_id
-            FROM users u
-            JOIN clients c ON u.client_id = c.client_id
-            JOIN current_connections cc ON u.client_id = cc.client_id
-            """
-        )
-        current_connections = await cursor.fetchall()
-        await cursor.close()
-
-    return current_connections
+    return sessions.rows()
 
 
 # Обработчик вывода списка текущих подключений
-async def handle_list_current_connections(reader, writer):
-    writer.write(b"List of currently connected clients:\r\n")
-    await writer.drain()
-
-    current_connections = await list_current_connections()
+async def handle_list_current_connections(reader, writer, args=()):
+    try:
+        after, limit = parse_list_args(args)
+    except ValueError as e:
+        writer.write(f"Error: {e}\r\n".encode())
+        await writer.drain()
+        return
 
-    for connection in current_connections:
-        connection_info = f"Username: {connection[0]}, Client ID: {connection[1]}, RAM: {connection[2]}, CPU: " \
-                          f"{connection[3]}, HDD Size: {connection[4]}, HDD ID: {connection[5]}\r\n"
-        writer.write(connection_info.encode())
+    await write_rows(
+        writer, b"List of currently connected clients:\r\n",
+        iter_current_connections(after, limit),
+        lambda connection: f"Username: {connection[0]}, Client ID: {connection[1]}, RAM: {connection[2]}, "
+                           f"CPU: {connection[3]}, HDD Size: {connection[4]}, HDD ID: {connection[5]}\r\n",
+        1, limit
+    )
+
+
+# Запросы по характеристикам машин (команда query).
+# Отбор по диапазонам ресурсов выполняется по покрывающим индексам (миграция 4): запрос читает только
+# участок индекса, соответствующий диапазону, поэтому время ответа зависит от количества найденных машин,
+# а не от размера таблицы. Гистограмма и итоги без отбора берутся из агрегированной статистики процесса.
+
+# Ресурсы, доступные в запросах: имя аргумента -> столбец таблицы clients
+QUERY_FIELDS = {"ram": "ram_size", "cpu": "cpu_count", "hdd": "hdd_size"}
+# Виды запросов: итоги, гистограмма по ресурсу, машины с наибольшим ресурсом, объем дисков по hdd_id
+QUERY_KINDS = ("summary", "histogram", "top", "hdd_by_id")
+# Количество строк ответа top и hdd_by_id по умолчанию и максимальное
+QUERY_DEFAULT_LIMIT = 10
+QUERY_MAX_LIMIT = 1000
+
+
+# Разбор диапазона значений ресурса: '4' - ровно 4, '2..8' - от 2 до 8 включительно, '4..' и '..8' -
+# диапазоны, ограниченные с одной стороны. Возвращает (минимум, максимум), None - без ограничения.
+def parse_range(value):
+    low, separator, high = str(value).partition("..")
+    if not separator:
+        high = low
+    try:
+        low = int(low) if low else None
+        high = int(high) if high else None
+    except ValueError:
+        raise ValueError(f"Invalid range: {value}") from None
+    if low is None and high is None or low is not None and high is not None and low > high:
+        raise ValueError(f"Invalid range: {value}")
+    return low, high
+
+
+# Приведение имени ресурса из запроса ('ram' или 'ram_size') к столбцу таблицы
+def query_field(name):
+    name = str(name).lower()
+    if name in QUERY_FIELDS.values():
+        return name
+    if name not in QUERY_FIELDS:
+        raise ValueError(f"Unknown resource: {name}. Resources: {', '.join(QUERY_FIELDS)}")
+    return QUERY_FIELDS[name]
+
+
+# Условие WHERE по диапазонам ресурсов {столбец: (минимум, максимум)} и идентификатору диска
+def query_conditions(ranges, hdd_id=None, required=None):
+    conditions = []
+    params = []
+    if required is not None:
+        conditions.append(f"{required} IS NOT NULL")
+    for column, (low, high) in sorted(ranges.items()):
+        if low is not None:
+            conditions.append(f"{column} >= ?")
+            params.append(low)
+        if high is not None:
+            conditions.append(f"{column} <= ?")
+            params.append(high)
+    if hdd_id is not None:
+        conditions.append("hdd_id = ?")
+        params.append(hdd_id)
+    return (" WHERE " + " AND ".join(conditions) if conditions else ""), params
+
+
+# Чтение всех строк запроса через пул соединений
+async def fetch_all(query, params=()):
+    pool = await get_pool()
+    async with pool.reader() as db:
+        cursor = await db.execute(query, params)
+        rows = await cursor.fetchall()
+        await cursor.close()
+    return rows
+
+
+# Функция для выполнения запроса по характеристикам машин.
+# ranges - {столбец: (минимум, максимум)}, hdd_id - отбор по идентификатору диска.
+#   summary   - (количество машин, сумма RAM, сумма CPU, сумма HDD)
+#   histogram - [(начало интервала шириной bucket, количество машин)] по ресурсу field
+#   top       - limit машин с наибольшим значением ресурса by: [(username, client_id, ram, cpu, hdd, hdd_id)]
+#   hdd_by_id - limit идентификаторов дисков с наибольшим суммарным объемом: [(hdd_id, машин, объем)]
+@db_timer
+async def query_clients(kind, ranges=None, hdd_id=None, field="ram_size", bucket=1, by="hdd_size",
+                        limit=QUERY_DEFAULT_LIMIT):
+    if kind not in QUERY_KINDS:
+        raise ValueError(f"Unknown query: {kind}. Queries: {', '.join(QUERY_KINDS)}")
+    ranges = ranges or {}
+    if not ranges and hdd_id is None and kind != "top":
+        # Без отбора ответ берется из агрегированной статистики процесса
+        stats = await get_stats_aggregator()
+        if kind == "summary":
+            return stats.totals()
+        if kind == "histogram":
+            return stats.resources[field].histogram(bucket)
+        return stats.top_disks(limit)
+    return await get_storage().query(kind, ranges, hdd_id, field, bucket, by, limit)
+
+
+# Разбор аргументов команды query: вид запроса и параметры name=value.
+# Возвращает (вид, аргументы query_clients).
+def parse_query_args(args):
+    if not args or args[0].lower() not in QUERY_KINDS:
+        raise ValueError(f"Specify a query: {', '.join(QUERY_KINDS)}")
+    kind = args[0].lower()
+    options = {"ranges": {}}
+    for arg in args[1:]:
+        name, _, value = arg.partition("=")
+        name = name.lower()
+        if not value:
+            raise ValueError(f"Invalid argument: {arg}")
+        if name in QUERY_FIELDS or name in QUERY_FIELDS.values():
+            options["ranges"][query_field(name)] = parse_range(value)
+        elif name == "hdd_id":
+            options["hdd_id"] = value
+        elif name in ("field", "by"):
+            options[name] = query_field(value)
+        elif name in ("bucket", "limit") and value.isdigit() and int(value) > 0:
+            options[name] = int(value)
+        else:
+            raise ValueError(f"Invalid argument: {arg}")
+    if options.get("limit", 0) > QUERY_MAX_LIMIT:
+        raise ValueError(f"limit must not exceed {QUERY_MAX_LIMIT}")
+    return kind, options
+
+
+# Обработчик запроса по характеристикам машин
+async def handle_query(reader, writer, session, args=()):
+    try:
+        kind, options = parse_query_args(args)
+    except ValueError as e:
+        writer.write(f"Error: {e}\r\n".encode())
         await writer.drain()
+        return
 
-    writer.write(b"End of the list\r\n")
+    result = await query_clients(kind, **options)
+    if kind == "summary":
+        lines = [f"Machines: {result[0]}, Total RAM: {result[1]}, Total CPU: {result[2]}, "
+                 f"Total HDD Size: {result[3]}\r\n"]
+    elif kind == "histogram":
+        bucket = options.get("bucket", 1)
+        lines = [f"{start}: {count}\r\n" if bucket == 1 else f"{start}-{start + bucket - 1}: {count}\r\n"
+                 for start, count in result]
+        lines.insert(0, f"Histogram of {options.get('field', 'ram_size')}:\r\n")
+        lines.append("End of the list\r\n")
+    elif kind == "top":
+        lines = [f"Username: {row[0]}, Client ID: {row[1]}, RAM: {row[2]}, CPU: {row[3]}, "
+                 f"HDD Size: {row[4]}, HDD ID: {row[5]}\r\n" for row in result]
+        lines.insert(0, f"Top machines by {options.get('by', 'hdd_size')}:\r\n")
+        lines.append("End of the list\r\n")
+    else:
+        lines = [f"HDD ID: {row[0]}, Machines: {row[1]}, Total HDD Size: {row[2]}\r\n" for row in result]
+        lines.insert(0, "Total HDD size by HDD ID:\r\n")
+        lines.append("End of the list\r\n")
+    writer.write("".join(lines).encode())
     await writer.drain()
 
 
 # Функция для обновления информации о клиенте
+@db_timer
 async def update_client_info(client_id, ram_size, cpu_count, hdd_size, hdd_id):
-    async with aiosqlite.connect(DATABASE_NAME) as db:
-        await db.execute(
-            """
-            UPDATE clients
-            SET ram_size = ?, cpu_count = ?, hdd_size = ?, hdd_id = ?
-            WHERE client_id = ?
-            """,
-            (ram_size, cpu_count, hdd_size, hdd_id, client_id)
+    await get_stats_aggregator()
+    spec = make_spec(ram_size, cpu_count, hdd_size, hdd_id)
+
+    # Прежние характеристики читаются в той же транзакции, что и обновление
+    def on_commit(old):
+        if old is not None:
+            commit_change({"type": "client_updated", "client_id": client_id, "old": old, "spec": spec})
+
+    await get_storage().update_client(client_id, ram_size, cpu_count, hdd_size, hdd_id, on_commit=on_commit)
+
+
+# Статистика по одному ресурсу виртуальных машин: сумма, количество, минимум и максимум.
+# Хранит количество машин для каждого значения, поэтому минимум и максимум пересчитываются
+# по различным значениям только при удалении последней машины с крайним значением.
+class ResourceStats:
+    __slots__ = ("total", "count", "min", "max", "_values")
+
+    def __init__(self):
+        self.total = 0
+        self.count = 0
+        self.min = None
+        self.max = None
+        self._values = {}
+
+    # Учет значения ресурса (times - количество машин с этим значением)
+    def add(self, value, times=1):
+        if value is None:
+            return
+        self.total += value * times
+        self.count += times
+        self._values[value] = self._values.get(value, 0) + times
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    # Исключение значения ресурса
+    def remove(self, value):
+        if value is None or value not in self._values:
+            return
+        self.total -= value
+        self.count -= 1
+        left = self._values[value] - 1
+        if left:
+            self._values[value] = left
+            return
+        del self._values[value]
+        if value == self.min:
+            self.min = min(self._values, default=None)
+        if value == self.max:
+            self.max = max(self._values, default=None)
+
+    # Количество машин по интервалам значений шириной bucket: [(начало интервала, количество)]
+    def histogram(self, bucket=1):
+        counts = {}
+        for value, times in self._values.items():
+            start = value // bucket * bucket
+            counts[start] = counts.get(start, 0) + times
+        return sorted(counts.items())
+
+    # Среднее значение ресурса
+    @property
+    def avg(self):
+        return self.total / self.count if self.count else None
+
+
+# Агрегированная статистика по всем виртуальным машинам.
+# Загружается из базы один раз при запуске и затем обновляется функциями записи после фиксации
+# изменений, поэтому команда list_total_stats не обращается к базе данных.
+class TotalStats:
+    RESOURCES = ("ram_size", "cpu_count", "hdd_size")
+
+    def __init__(self):
+        self.reset()
+
+    # Сброс статистики перед загрузкой
+    def reset(self):
+        self.machines = 0
+        self.resources = {name: ResourceStats() for name in self.RESOURCES}
+        # hdd_id -> [количество машин, суммарный объем дисков] (машины с указанным hdd_size)
+        self.disks = {}
+
+    # Загрузка статистики из базы данных
+    async def load(self, db):
+        self.reset()
+        cursor = await db.execute("SELECT COUNT(*) FROM clients")
+        self.machines = (await cursor.fetchone())[0]
+        await cursor.close()
+        for name in self.RESOURCES:
+            cursor = await db.execute(
+                f"SELECT {name}, COUNT(*) FROM clients WHERE {name} IS NOT NULL GROUP BY {name}"
+            )
+            for value, times in await cursor.fetchall():
+                self.resources[name].add(value, times)
+            await cursor.close()
+        cursor = await db.execute(
+            "SELECT hdd_id, COUNT(*), SUM(hdd_size) FROM clients WHERE hdd_size IS NOT NULL GROUP BY hdd_id"
         )
-        await db.commit()
+        self.disks = {hdd_id: [machines, total] for hdd_id, machines, total in await cursor.fetchall()}
+        await cursor.close()
+
+    # Учет диска машины; spec - значения (ram_size, cpu_count, hdd_size, hdd_id).
+    # Характеристики без hdd_id (от рабочих процессов прежней версии) в статистике дисков не учитываются.
+    def _add_disk(self, spec, sign):
+        if len(spec) < 4 or spec[2] is None:
+            return
+        entry = self.disks.setdefault(spec[3], [0, 0])
+        entry[0] += sign
+        entry[1] += sign * _resource_value(spec[2])
+        if not entry[0]:
+            del self.disks[spec[3]]
+
+    # Учет новой машины; spec - значения (ram_size, cpu_count, hdd_size[, hdd_id])
+    def add_client(self, spec):
+        self.machines += 1
+        for name, value in zip(self.RESOURCES, spec):
+            self.resources[name].add(_resource_value(value))
+        self._add_disk(spec, 1)
+
+    # Исключение удаленной машины
+    def remove_client(self, spec):
+        self.machines -= 1
+        for name, value in zip(self.RESOURCES, spec):
+            self.resources[name].remove(_resource_value(value))
+        self._add_disk(spec, -1)
+
+    # Замена характеристик машины
+    def update_client(self, old_spec, new_spec):
+        for name, old_value, new_value in zip(self.RESOURCES, old_spec, new_spec):
+            self.resources[name].remove(_resource_value(old_value))
+            self.resources[name].add(_resource_value(new_value))
+        self._add_disk(old_spec, -1)
+        self._add_disk(new_spec, 1)
+
+    # Учет зафиксированного изменения: события client_created, client_updated или client_removed
+    def apply(self, event):
+        kind = event["type"]
+        if kind == "client_created":
+            self.add_client(event["spec"])
+        elif kind == "client_updated":
+            self.update_client(event["old"], event["spec"])
+        elif kind == "client_removed":
+            self.remove_client(event["old"])
+
+    # limit идентификаторов дисков с наибольшим суммарным объемом: [(hdd_id, машин, объем)]
+    def top_disks(self, limit):
+        top = heapq.nsmallest(limit, self.disks.items(), key=lambda item: (-item[1][1], item[0] or ""))
+        return [(hdd_id, machines, total) for hdd_id, (machines, total) in top]
+
+    # Значения для сверки с базой: количество машин и суммы ресурсов
+    def totals(self):
+        return (self.machines,) + tuple(self.resources[name].total for name in self.RESOURCES)
+
+
+# Приведение значения ресурса из запроса к числу, в котором оно хранится в базе. Как в столбце INTEGER
+# SQLite, строки с числом и дробные числа с целым значением становятся целыми, остальные значения
+# не изменяются (их отклоняет проверка столбца)
+def _resource_value(value):
+    number = value
+    if isinstance(value, str):
+        text = value.strip()
+        if text.isascii() and "_" not in text:
+            with contextlib.suppress(ValueError):
+                number = float(text)
+            with contextlib.suppress(ValueError):
+                number = int(text)
+    if isinstance(number, float) and number.is_integer():
+        return int(number)
+    if isinstance(number, int):
+        return int(number)
+    return value
+
+
+# Текущая агрегированная статистика сервера
+_total_stats = None
+# Изменения, зафиксированные во время загрузки статистики (None - статистика не загружается)
+_stats_backlog = None
+
+
+# Функция для загрузки агрегированной статистики из базы данных
+@db_timer
+async def init_total_stats():
+    global _total_stats, _stats_backlog
+    stats = TotalStats()
+    # Изменения этого и других рабочих процессов, пришедшие во время загрузки, применяются
+    # к загруженной статистике, чтобы они не потерялись при ее замене
+    _stats_backlog = backlog = []
+    try:
+        await get_storage().load_stats(stats)
+    finally:
+        _stats_backlog = None
+    for event in backlog:
+        stats.apply(event)
+    _total_stats = stats
+    return stats
+
+
+# Функция для получения агрегированной статистики (загружается при первом обращении)
+async def get_stats_aggregator():
+    if _total_stats is None:
+        await init_total_stats()
+    return _total_stats
+
+
+# Функция для сверки агрегированной статистики с хранилищем.
+# Итоги хранилища сравниваются со статистикой между изменениями (см. Storage.check_totals).
+# При расхождении статистика перезагружается. Возвращает True, если расхождений нет.
+@db_timer
+async def check_total_stats():
+    stats = await get_stats_aggregator()
+    result = {}
+
+    def compare(actual):
+        result["consistent"] = actual == stats.totals()
+        if not result["consistent"]:
+            print(f"Warning: total stats drifted from the database: {stats.totals()} != {actual}")
+
+    storage = get_storage()
+    await storage.check_totals(compare)
+    if not result["consistent"] and _cluster is not None:
+        # Изменения других рабочих процессов приходят с задержкой: расхождение подтверждается повторной сверкой
+        await asyncio.sleep(STATS_CONFIRM_DELAY)
+        await storage.check_totals(compare)
+    if not result["consistent"]:
+        await init_total_stats()
+    return result["consistent"]
+
+
+# Периодическая сверка агрегированной статистики с базой данных
+async def check_total_stats_periodically(interval=STATS_CHECK_INTERVAL, first_delay=None):
+    delay = interval if first_delay is None else first_delay
+    while True:
+        await asyncio.sleep(delay)
+        delay = interval
+        try:
+            await check_total_stats()
+        except Exception as e:
+            print(f"Warning: total stats check failed: {e!r}")
 
 
 # Функция для получения общей статистики
 async def get_total_stats():
-    async with aiosqlite.connect(DATABASE_NAME) as db:
-        # Получаем общее количество машин
-        cursor = await db.execute("SELECT COUNT(*) FROM clients")
-        total_machines = await cursor.fetchone()
-        await cursor.close()
-
-        # Получаем общий объем RAM и CPU
-        cursor = await db.execute("SELECT SUM(ram_size), SUM(cpu_count) FROM clients")
-        total_stats = await cursor.fetchone()
-        await cursor.close()
-
-    return total_machines[0], total_stats[0], total_stats[1]
+    stats = await get_stats_aggregator()
+    return stats.machines, stats.resources["ram_size"].total, stats.resources["cpu_count"].total
 
 
 # Обработчик вывода общей статистики
@@ -271,69 +2422,797 @@ async def handle_total_stats(reader, writer):
     total_machines, total_ram, total_cpu = await get_total_stats()
     stats_message = f"Total machines: {total_machines}, Total RAM: {total_ram}, Total CPU: {total_cpu}\r\n"
     writer.write(stats_message.encode())
+
+    stats = await get_stats_aggregator()
+    for name, title in (("ram_size", "RAM"), ("cpu_count", "CPU"), ("hdd_size", "HDD Size")):
+        resource = stats.resources[name]
+        avg = f"{resource.avg:.2f}" if resource.count else None
+        stats_message = f"{title}: min {resource.min}, max {resource.max}, avg {avg}\r\n"
+        writer.write(stats_message.encode())
     await writer.drain()
 
 
-# Обработчик основного потока клиента
+# Обработчик вывода статистики хранилища (пула соединений и очереди записи SQLite) и кэшей
+async def handle_db_stats(reader, writer):
+    storage = get_storage()
+    if isinstance(storage, SqliteStorage):
+        pool = await get_pool()
+        stats = pool.get_stats()
+        stats_message = f"Pool size: {stats['size']}, Readers in use: {stats['readers_in_use']}, " \
+                        f"Writer in use: {stats['writer_in_use']}, Reader acquisitions: {stats['reader_acquired']}, " \
+                        f"Writer acquisitions: {stats['writer_acquired']}, Waits: {stats['waits']}, " \
+                        f"Timeouts: {stats['timeouts']}, Wait time: {stats['wait_time']:.3f} s\r\n"
+        writer.write(stats_message.encode())
+
+        queue = await get_write_queue()
+        stats = queue.get_stats()
+        stats_message = f"Write batches: {stats['batches']}, Operations: {stats['operations']}, " \
+                        f"Failed operations: {stats['failed_operations']}, Pending: {stats['pending']}, " \
+                        f"Avg batch size: {stats['avg_batch']:.1f}, Max batch size: {stats['max_batch']}, " \
+                        f"Avg commit time: {stats['avg_commit_time'] * 1000:.2f} ms, " \
+                        f"Max commit time: {stats['max_commit_time'] * 1000:.2f} ms\r\n"
+        writer.write(stats_message.encode())
+    else:
+        stats = storage.get_stats()
+        writer.write(", ".join(f"{name.capitalize()}: {value}" for name, value in stats.items()).encode() + b"\r\n")
+
+    for title, cache in (("User cache", user_cache), ("Client cache", client_cache)):
+        stats = cache.get_stats()
+        stats_message = f"{title}: size {stats['size']}, hits {stats['hits']}, misses {stats['misses']}, " \
+                        f"hit rate {stats['hit_rate']:.1%}, evictions {stats['evictions']}, " \
+                        f"expirations {stats['expirations']}, invalidations {stats['invalidations']}\r\n"
+        writer.write(stats_message.encode())
+    await writer.drain()
+
+
+# Запрос размера ресурса у клиента до получения корректного значения
+async def read_resource_size(reader, writer, prompt):
+    while True:
+        writer.write(prompt)
+        await writer.drain()
+        value = (await read_line(reader)).decode().strip()
+        try:
+            return parse_resource_size(value)
+        except ValueError:
+            writer.write(b"Error: Value must be a positive integer\r\n")
+            await writer.drain()
+
+
+# Зарегистрированные команды: имя -> (обработчик, описание, аргументы).
+# Обработчик - корутина handler(reader, writer, session, args), где args - аргументы из строки команды.
+COMMANDS = {}
+# Меню команд, закодированное один раз (сбрасывается при регистрации новой команды)
+_menu = None
+
+
+# Регистрация обработчика команды; может использоваться из внешних модулей:
+#
+#     @working_server.register_command("ping", "check the connection")
+#     async def ping(reader, writer, session, args):
+#         writer.write(b"pong\r\n")
+def register_command(name, description, usage=""):
+    def decorator(handler):
+        global _menu
+        COMMANDS[name.lower()] = (handler, description, usage)
+        _menu = None
+        return handler
+    return decorator
+
+
+# Меню команд для отправки клиенту
+def get_menu():
+    global _menu
+    if _menu is None:
+        _menu = "".join(
+            f"Type '{' '.join(filter(None, (name, usage)))}' to {description}\r\n"
+            for name, (_, description, usage) in COMMANDS.items()
+        ).encode()
+    return _menu
+
+
+# Выполнение строки команды: имя команды приводится к нижнему регистру один раз,
+# обработчик выбирается по словарю зарегистрированных команд
+async def dispatch_command(reader, writer, session, line):
+    name, *args = line.split() or ['']
+    command = COMMANDS.get(name.lower())
+    if command is None:
+        # Отправляем сообщение об ошибке при вводе неизвестной команды
+        writer.write(b"Error: Unknown command. Type 'help' to see the list of commands\r\n")
+        await writer.drain()
+        if metrics is not None:
+            metrics.inc("vm_unknown_commands_total")
+        return
+    if metrics is None:
+        await command[0](reader, writer, session, args)
+    else:
+        await observe_command("command", name.lower(), command[0](reader, writer, session, args))
+
+
+# Обработчик вывода меню команд
+async def handle_help(reader, writer, session=None, args=()):
+    writer.write(get_menu())
+    await writer.drain()
+
+
+# Обработчик выхода: удаляем текущее соединение из списка активных соединений и закрываем его
+async def handle_exit(reader, writer, session, args=()):
+    await remove_current_connection(session.client_id, session)
+    writer.write(b"Disconnecting...\r\n")
+    await writer.drain()
+    writer.close()
+
+
+# Машиночитаемый режим протокола (MODE json).
+# Каждая строка запроса - объект JSON {"id": ..., "op": "...", "args": {...}}, каждая строка ответа -
+# {"id": ..., "ok": true, "result": ...} или {"id": ..., "ok": false, "error": "..."}. Запросы выполняются
+# конвейерно: клиент может отправить много запросов, не дожидаясь ответов, ответы сопоставляются по id
+# и могут приходить не в порядке запросов. Операции login и exit выполняются по очереди с остальными.
+
+# Зарегистрированные операции: имя -> корутина op(connection, args)
+JSON_OPS = {}
+# Максимальное количество одновременно выполняемых запросов одного подключения
+JSON_MAX_IN_FLIGHT = 64
+# Максимальное количество строк списка в одном ответе
+JSON_MAX_LIST_LIMIT = 10000
+
+
+# Ошибка запроса, сообщение которой возвращается клиенту
+class RequestError(Exception):
+    pass
+
+
+# Регистрация операции машиночитаемого режима
+def register_json_op(name):
+    def decorator(op):
+        JSON_OPS[name] = op
+        return op
+    return decorator
+
+
+# Подключение в машиночитаемом режиме
+class JsonConnection:
+    def __init__(self, reader, writer, session=None):
+        self.reader = reader
+        self.writer = writer
+        self.session = session
+        self._semaphore = asyncio.Semaphore(JSON_MAX_IN_FLIGHT)
+        self._tasks = set()
+        # Подписка на события (операция subscribe) и задача их отправки
+        self.subscription = None
+        self._events_task = None
+
+    # Отправка одного ответа
+    async def respond(self, request_id, result=None, error=None):
+        if error is None:
+            response = {"id": request_id, "ok": True, "result": result}
+        else:
+            response = {"id": request_id, "ok": False, "error": error}
+        if not self.writer.is_closing():
+            self.writer.write(json.dumps(response, ensure_ascii=False).encode() + b"\n")
+            await self.writer.drain()
+
+    # Отправка событий подписки строками {"event": {...}} до отмены подписки
+    async def send_events(self, subscription):
+        try:
+            while True:
+                events = await subscription.get_batch()
+                if not events or self.writer.is_closing():
+                    break
+                self.writer.write(b"".join(
+                    json.dumps({"event": event}, ensure_ascii=False).encode() + b"\n" for event in events
+                ))
+                await self.writer.drain()
+        except (ConnectionError, ClientTimeoutError):
+            # Клиент не читает события или отключился: подключение закрывается, цикл чтения запросов завершается
+            subscription.close()
+            self.writer.transport.abort()
+
+    # Подписка на события указанных типов (вместо предыдущей подписки)
+    def subscribe(self, types):
+        self.unsubscribe()
+        self.subscription = event_bus.subscribe(types)
+        self._events_task = asyncio.create_task(self.send_events(self.subscription))
+
+    # Отмена подписки на события
+    def unsubscribe(self):
+        if self.subscription is not None:
+            self.subscription.close()
+            self.subscription = None
+            self._events_task = None
+
+    # Выполнение одного запроса
+    async def execute(self, request_id, name, op, args):
+        try:
+            if self.session is None and op not in (json_login, json_exit):
+                raise RequestError("Not logged in: send the 'login' operation first")
+            if metrics is None:
+                result = await op(self, args)
+            else:
+                result = await observe_command("op", name, op(self, args))
+        except RequestError as e:
+            await self.respond(request_id, error=str(e))
+        except (sqlite3.Error, TimeoutError) as e:
+            await self.respond(request_id, error=f"Database error: {e}")
+        else:
+            await self.respond(request_id, result)
+
+    # Выполнение запроса в отдельной задаче с ограничением количества одновременных запросов
+    async def _execute_limited(self, request_id, name, op, args):
+        try:
+            await self.execute(request_id, name, op, args)
+        finally:
+            self._semaphore.release()
+
+    # Ожидание завершения всех выполняемых запросов
+    async def wait_in_flight(self):
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    # Основной цикл: чтение запросов и запуск их выполнения
+    async def serve(self):
+        await self.respond(None, {"mode": "json"})
+        try:
+            while not self.writer.is_closing():
+                try:
+                    line = await read_line(self.reader)
+                except asyncio.IncompleteReadError:
+                    break
+                if not line.strip():
+                    continue
+                try:
+                    request = json.loads(line)
+                    request_id = request.get("id")
+                    name = request.get("op")
+                    op = JSON_OPS.get(name)
+                    args = request.get("args") or {}
+                    if not isinstance(args, dict):
+                        raise ValueError("args must be an object")
+                except (ValueError, AttributeError, TypeError) as e:
+                    await self.respond(None, error=f"Invalid request: {e}")
+                    continue
+                if op is None:
+                    await self.respond(request_id, error=f"Unknown op: {name}")
+                    continue
+                if self.session is not None:
+                    self.session.touch()
+
+                if op is json_login or op is json_exit:
+                    # Вход и выход зависят от предыдущих запросов и выполняются после них
+                    await self.wait_in_flight()
+                    await self.execute(request_id, name, op, args)
+                    if op is json_exit:
+                        break
+                    continue
+                await self._semaphore.acquire()
+                task = asyncio.create_task(self._execute_limited(request_id, name, op, args))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+        finally:
+            self.unsubscribe()
+            await self.wait_in_flight()
+            if self.session is not None:
+                await remove_current_connection(self.session.client_id, self.session)
+
+
+# Получение обязательного аргумента запроса
+def _require(args, name):
+    if name not in args:
+        raise RequestError(f"Missing argument: {name}")
+    return args[name]
+
+
+# Проверка характеристик машины из запроса
+def _json_spec(args):
+    try:
+        return (
+            parse_resource_size(_require(args, "ram_size")),
+            parse_resource_size(_require(args, "cpu_count")),
+            parse_resource_size(_require(args, "hdd_size")),
+            str(_require(args, "hdd_id")),
+        )
+    except (TypeError, ValueError):
+        raise RequestError("ram_size, cpu_count and hdd_size must be positive integers") from None
+
+
+# Представление строки клиента в ответе
+def _client_object(row):
+    return dict(zip(("username", "client_id", "ram_size", "cpu_count", "hdd_size", "hdd_id"), row))
+
+
+# Постраничная выборка списка для ответа: {"items": [...], "next": ключ следующей страницы или null}
+async def _json_page(args, rows_iter_factory, key_index, to_object):
+    after = args.get("after")
+    limit = args.get("limit", LIST_CHUNK_SIZE)
+    if not isinstance(limit, int) or not 0 < limit <= JSON_MAX_LIST_LIMIT:
+        raise RequestError(f"limit must be an integer from 1 to {JSON_MAX_LIST_LIMIT}")
+    items = []
+    last_key = None
+    async for rows in rows_iter_factory(after, limit):
+        items.extend(map(to_object, rows))
+        last_key = rows[-1][key_index]
+    return {"items": items, "next": last_key if len(items) == limit else None}
+
+
+# Вход: существующий пользователь подключается к своей машине, новый создается с машиной из spec
+@register_json_op("login")
+async def json_login(connection, args):
+    if connection.session is not None:
+        raise RequestError("Already logged in")
+    username = str(_require(args, "username"))
+    client_id, spec = await lookup_user(username)
+    created = False
+    if client_id is None:
+        if "spec" not in args or not isinstance(args["spec"], dict):
+            raise RequestError("User not found: 'spec' is required to create a virtual machine")
+        spec = _json_spec(args["spec"])
+        client_id = str(uuid.uuid4())
+        await create_user_with_client(username, client_id, *spec)
+        created = True
+    connection.session = await add_current_connection(client_id, username, connection.writer, spec)
+    return {"client_id": client_id, "created": created}
+
+
+# Пакетное создание пользователей с машинами: {"clients": [{"username", "ram_size", ...}, ...]}
+@register_json_op("create_clients")
+async def json_create_clients(connection, args):
+    clients = _require(args, "clients")
+    if not isinstance(clients, list):
+        raise RequestError("clients must be a list")
+
+    async def create(item):
+        try:
+            if not isinstance(item, dict):
+                raise RequestError("client must be an object")
+            username = str(_require(item, "username"))
+            spec = _json_spec(item)
+            client_id = str(uuid.uuid4())
+            await create_user_with_client(username, client_id, *spec)
+            return {"username": username, "client_id": client_id}
+        except RequestError as e:
+            return {"error": str(e)}
+        except sqlite3.IntegrityError as e:
+            return {"error": f"Integrity error: {e}"}
+
+    # Все операции попадают в очередь записи одновременно и фиксируются общими транзакциями
+    return await asyncio.gather(*map(create, clients))
+
+
+@register_json_op("update_client_info")
+async def json_update_client_info(connection, args):
+    client_id = str(_require(args, "client_id"))
+    if not await client_exists(client_id):
+        raise RequestError("No client found with the provided client_id")
+    await update_client_info(client_id, *_json_spec(args))
+    return {"client_id": client_id}
+
+
+# Удаление машин: {"client_ids": [...]}; удаление собственной машины завершает подключение
+@register_json_op("remove_virtual_machines")
+async def json_remove_virtual_machines(connection, args):
+    client_ids = _require(args, "client_ids")
+    if not isinstance(client_ids, list):
+        raise RequestError("client_ids must be a list")
+
+    async def remove(client_id):
+        client_id = str(client_id)
+        exists = await client_exists(client_id)
+        if exists:
+            await remove_virtual_machine(client_id)
+        return {"client_id": client_id, "removed": exists}
+
+    results = await asyncio.gather(*map(remove, client_ids))
+    if connection.session.client_id in map(str, client_ids):
+        connection.writer.close()
+    return results
+
+
+@register_json_op("remove_virtual_machine")
+async def json_remove_virtual_machine(connection, args):
+    results = await json_remove_virtual_machines(connection, {"client_ids": [_require(args, "client_id")]})
+    return results[0]
+
+
+@register_json_op("list_of_users_ever_connected")
+async def json_list_ever_connected_clients(connection, args):
+    return await _json_page(
+        args, lambda after, limit: iter_rows(EVER_CONNECTED_CLIENTS_PAGE_QUERY, 1, after, limit), 1, _client_object
+    )
+
+
+@register_json_op("list_of_current_connections")
+async def json_list_current_connections(connection, args):
+    return await _json_page(args, iter_current_connections, 1, _client_object)
+
+
+@register_json_op("list_of_hard_disks")
+async def json_list_hard_disks(connection, args):
+    return await _json_page(
+        args, lambda after, limit: iter_rows(HARD_DISKS_PAGE_QUERY, 2, after, limit), 2,
+        lambda row: {"username": row[0], "hdd_size": row[1], "client_id": row[2]}
+    )
+
+
+@register_json_op("list_total_stats")
+async def json_list_total_stats(connection, args):
+    stats = await get_stats_aggregator()
+    result = {"machines": stats.machines}
+    for name, resource in stats.resources.items():
+        result[name] = {"total": resource.total, "min": resource.min, "max": resource.max, "avg": resource.avg}
+    return result
+
+
+@register_json_op("list_db_stats")
+async def json_list_db_stats(connection, args):
+    storage = get_storage()
+    result = {"storage": storage.get_stats(), "user_cache": user_cache.get_stats(),
+              "client_cache": client_cache.get_stats()}
+    if isinstance(storage, SqliteStorage):
+        result["pool"] = (await get_pool()).get_stats()
+        result["write_queue"] = (await get_write_queue()).get_stats()
+    return result
+
+
+# Подписка на события: после ответа события приходят строками {"event": {...}} до операции unsubscribe
+@register_json_op("subscribe")
+async def json_subscribe(connection, args):
+    types = args.get("types") or []
+    if not isinstance(types, list):
+        raise RequestError("types must be a list of event types")
+    try:
+        connection.subscribe(types)
+    except (ValueError, TypeError) as e:
+        raise RequestError(str(e)) from None
+    return {"types": sorted(connection.subscription.types or EVENT_TYPES)}
+
+
+@register_json_op("unsubscribe")
+async def json_unsubscribe(connection, args):
+    connection.unsubscribe()
+    return {}
+
+
+# Запрос по характеристикам машин: {"kind": "summary|histogram|top|hdd_by_id", "ram": "2..8" или [2, 8], ...}
+# с теми же параметрами, что и у команды query
+@register_json_op("query")
+async def json_query(connection, args):
+    tokens = [str(_require(args, "kind"))]
+    for name, value in args.items():
+        if name == "kind":
+            continue
+        if isinstance(value, list) and len(value) == 2:
+            value = "..".join("" if bound is None else str(bound) for bound in value)
+        tokens.append(f"{name}={value}")
+    try:
+        kind, options = parse_query_args(tokens)
+    except ValueError as e:
+        raise RequestError(str(e)) from None
+    result = await query_clients(kind, **options)
+    if kind == "summary":
+        return dict(zip(("machines",) + TotalStats.RESOURCES, result))
+    if kind == "histogram":
+        return {"items": [{"start": start, "count": count} for start, count in result]}
+    if kind == "top":
+        return {"items": list(map(_client_object, result))}
+    return {"items": [{"hdd_id": hdd_id, "machines": machines, "hdd_size": total}
+                      for hdd_id, machines, total in result]}
+
+
+# Выход: подключение закрывается после ответа на все предыдущие запросы
+@register_json_op("exit")
+async def json_exit(connection, args):
+    return {}
+
+
+# Обработчик подписки на события: события выводятся строками 'Event: {...}', пока клиент не отправит
+# любую строку (например, 'stop'), после чего сессия возвращается к вводу команд
+async def handle_subscribe(reader, writer, session, args=()):
+    try:
+        subscription = event_bus.subscribe([arg.lower() for arg in args])
+    except ValueError as e:
+        writer.write(f"Error: {e}. Event types: {', '.join(EVENT_TYPES)}\r\n".encode())
+        await writer.drain()
+        return
+    writer.write(b"Subscribed. Send any line to stop\r\n")
+    await writer.drain()
+
+    # Подписчик может долго ничего не отправлять, поэтому ожидание строки не ограничено idle timeout
+    stop = asyncio.ensure_future(reader.readuntil(b'\n'))
+    try:
+        while True:
+            events = asyncio.ensure_future(subscription.get_batch())
+            await asyncio.wait((stop, events), return_when=asyncio.FIRST_COMPLETED)
+            if stop.done():
+                events.cancel()
+                # При обрыве связи исключение завершает сессию
+                stop.result()
+                break
+            writer.write(b"".join(
+                b"Event: " + json.dumps(event, ensure_ascii=False).encode() + b"\r\n" for event in events.result()
+            ))
+            await writer.drain()
+    finally:
+        subscription.close()
+        stop.cancel()
+    session.touch()
+    writer.write(b"Unsubscribed\r\n")
+    await writer.drain()
+
+
+# Обработчик переключения протокола: 'mode json' переводит сессию в машиночитаемый режим
+async def handle_mode(reader, writer, session, args=()):
+    if [arg.lower() for arg in args] != ["json"]:
+        writer.write(b"Error: Supported modes: json\r\n")
+        await writer.drain()
+        return
+    # Сессия машиночитаемого режима не считается частью команды mode при поиске медленных команд
+    _sql_trace.set(None)
+    await JsonConnection(reader, writer, session).serve()
+    writer.close()
+
+
+# Встроенные команды сервера
+LIST_USAGE = "[after=<client_id>] [limit=<n>]"
+register_command("list_of_users_ever_connected", "see the list of ever connected clients", LIST_USAGE)(
+    lambda reader, writer, session, args: handle_list_ever_connected_clients(reader, writer, args))
+register_command("list_of_current_connections", "see the list of currently connected clients", LIST_USAGE)(
+    lambda reader, writer, session, args: handle_list_current_connections(reader, writer, args))
+register_command("list_of_hard_disks", "see the list of hard disks", LIST_USAGE)(
+    lambda reader, writer, session, args: handle_list_hard_disks(reader, writer, args))
+register_command("remove_virtual_machine", "remove a virtual machine")(
+    lambda reader, writer, session, args: handle_remove_virtual_machine(reader, writer, session.client_id))
+register_command("update_client_info", "update client information")(
+    lambda reader, writer, session, args: handle_update_client_info(reader, writer))
+register_command("list_total_stats", "see the total statistics")(
+    lambda reader, writer, session, args: handle_total_stats(reader, writer))
+register_command("list_db_stats", "see the database connection statistics")(
+    lambda reader, writer, session, args: handle_db_stats(reader, writer))
+register_command("subscribe", "receive connection, virtual machine and statistics events",
+                 "[" + "|".join(EVENT_TYPES) + " ...]")(handle_subscribe)
+register_command("query", "query virtual machines by resources",
+                 f"{'|'.join(QUERY_KINDS)} [ram|cpu|hdd=<min>..<max>] [hdd_id=<id>] [field=<resource>] "
+                 f"[bucket=<n>] [by=<resource>] [limit=<n>]")(handle_query)
+register_command("mode", "switch to the newline-delimited JSON protocol", "json")(handle_mode)
+register_command("help", "see this list of commands")(handle_help)
+register_command("exit", "exit")(handle_exit)
+
+
+# Истекло время ожидания данных от клиента или отправки данных клиенту
+class ClientTimeoutError(Exception):
+    pass
+
+
+# Ограничение количества подключений и времени ожидания клиентов.
+# Подключение занимает место с момента принятия (до входа пользователя) и до закрытия, поэтому
+# полуоткрытые и медленные подключения также ограничены. При отсутствии свободного места подключение
+# ожидает в очереди (ACCEPT_POLICY = "queue") или сразу получает отказ ("reject").
+class ConnectionLimiter:
+    def __init__(self, max_sessions=MAX_SESSIONS, policy=ACCEPT_POLICY, queue_size=ACCEPT_QUEUE_SIZE,
+                 queue_timeout=ACCEPT_QUEUE_TIMEOUT, idle_timeout=IDLE_TIMEOUT,
+                 write_high=WRITE_HIGH_WATERMARK, write_low=WRITE_LOW_WATERMARK, write_timeout=WRITE_TIMEOUT):
+        if policy not in ("queue", "reject"):
+            raise ValueError(f"Unknown accept policy: {policy}")
+        if write_low > write_high:
+            raise ValueError("Low write watermark must not exceed the high one")
+        self.max_sessions = max_sessions
+        self.policy = policy
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.idle_timeout = idle_timeout
+        self.write_high = write_high
+        self.write_low = write_low
+        self.write_timeout = write_timeout
+        self.active = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self._waiters = collections.deque()
+
+    @property
+    def waiting(self):
+        return len(self._waiters)
+
+    # Получение места для подключения; False - подключению отказано
+    async def acquire(self):
+        if self.max_sessions is None or (self.active < self.max_sessions and not self._waiters):
+            self.active += 1
+            return True
+        if self.policy == "reject" or len(self._waiters) >= self.queue_size:
+            self.rejected += 1
+            return False
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append(future)
+        try:
+            await asyncio.wait_for(future, self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            return False
+        finally:
+            if not future.done() or future.cancelled():
+                with contextlib.suppress(ValueError):
+                    self._waiters.remove(future)
+        # Место передано освободившимся подключением без изменения счетчика
+        return True
+
+    # Освобождение места: оно передается первому ожидающему подключению
+    def release(self):
+        while self._waiters:
+            future = self._waiters.popleft()
+            if not future.done():
+                future.set_result(None)
+                return
+        self.active -= 1
+
+    # Настройка потока записи нового подключения
+    def wrap_writer(self, writer):
+        transport = writer.transport
+        if transport is not None:
+            transport.set_write_buffer_limits(self.write_high, self.write_low)
+        return ClientWriter(writer, self.write_high, self.write_timeout)
+
+    def get_stats(self):
+        return {"active": self.active, "waiting": self.waiting, "rejected": self.rejected,
+                "timed_out": self.timed_out, "max_sessions": self.max_sessions}
+
+
+# Поток записи подключения клиента.
+# drain ограничен по времени только при заполненном буфере (клиент не читает ответы), поэтому
+# обычная запись не создает таймеров; при включенных метриках считаются отправленные байты.
+class ClientWriter:
+    __slots__ = ("_writer", "_high", "_timeout", "transport")
+
+    def __init__(self, writer, high=WRITE_HIGH_WATERMARK, timeout=WRITE_TIMEOUT):
+        self._writer = writer
+        self._high = high
+        self._timeout = timeout
+        self.transport = writer.transport
+
+    def write(self, data):
+        if metrics is not None:
+            metrics.inc("vm_bytes_written_total", len(data))
+        self._writer.write(data)
+
+    async def drain(self):
+        if self._timeout is not None and self.transport.get_write_buffer_size() > self._high:
+            try:
+                await asyncio.wait_for(self._writer.drain(), self._timeout)
+            except asyncio.TimeoutError:
+                raise ClientTimeoutError("Client does not read the responses") from None
+        else:
+            await self._writer.drain()
+
+    def __getattr__(self, name):
+        return getattr(self._writer, name)
+
+
+# Текущие ограничения подключений сервера
+_limiter = None
+
+
+# Функция для настройки ограничений подключений
+def init_connection_limiter(**options):
+    global _limiter
+    _limiter = ConnectionLimiter(**options)
+    return _limiter
+
+
+# Функция для получения ограничений подключений (настраиваются по умолчанию при первом обращении)
+def get_connection_limiter():
+    if _limiter is None:
+        init_connection_limiter()
+    return _limiter
+
+
+# Чтение строки от клиента с ограничением времени ожидания
+async def read_line(reader):
+    timeout = get_connection_limiter().idle_timeout
+    if timeout is None:
+        return await reader.readuntil(b'\n')
+    try:
+        return await asyncio.wait_for(reader.readuntil(b'\n'), timeout)
+    except asyncio.TimeoutError:
+        raise ClientTimeoutError("Client is idle") from None
+
+
+# Функция для увеличения ограничения количества открытых файлов процесса до нужного количества сокетов
+def raise_open_files_limit(required):
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != resource.RLIM_INFINITY and soft < required:
+        target = required if hard == resource.RLIM_INFINITY else min(required, hard)
+        with contextlib.suppress(ValueError, OSError):
+            resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+
+
+# Обработчик подключения клиента: ограничение количества подключений и гарантированная очистка
+# при любом завершении (выход, обрыв связи, истечение времени ожидания, ошибка протокола)
 async def handle_client(reader, writer):
+    if metrics is not None:
+        metrics.inc("vm_connections_total")
+    limiter = get_connection_limiter()
+    if not await limiter.acquire():
+        with contextlib.suppress(ConnectionError):
+            writer.write(b"Error: Server is busy, try again later\r\n")
+        writer.close()
+        return
+
+    reason = None
+    try:
+        writer = limiter.wrap_writer(writer)
+        await serve_client(reader, writer)
+    except (asyncio.IncompleteReadError, ConnectionError):
+        reason = "disconnect"
+    except ClientTimeoutError:
+        reason = "timeout"
+        limiter.timed_out += 1
+    except (asyncio.LimitOverrunError, UnicodeDecodeError):
+        # Строка длиннее ограничения или не в кодировке UTF-8: продолжать разбор потока невозможно
+        reason = "protocol_error"
+        with contextlib.suppress(ConnectionError):
+            writer.write(b"Error: Invalid or too long line\r\n")
+    finally:
+        limiter.release()
+        if reason is not None and metrics is not None:
+            metrics.inc("vm_disconnects_total", label="reason", label_value=reason)
+        if reason in ("disconnect", "timeout") and writer.transport is not None:
+            # Неотправленные данные уже не нужны: сокет закрывается сразу, без ожидания буфера
+            writer.transport.abort()
+        else:
+            writer.close()
+
+
+# Обработчик основного потока клиента
+async def serve_client(reader, writer):
     # Запрашиваем у клиента ввод имени пользователя
     writer.write(b"Enter your username: ")
     await writer.drain()
 
     # Считываем введенное имя пользователя
-    username = (await reader.readuntil(b'\n')).decode().strip()
+    username = (await read_line(reader)).decode().strip()
 
-    # Проверяем, существует ли пользователь в базе данных
-    async with aiosqlite.connect(DATABASE_NAME) as db:
-        cursor = await db.execute(
-            "SELECT COUNT(*) FROM users WHERE username = ?",
-            (username,)
-        )
-        user_exists = await cursor.fetchone()
-        await cursor.close()
+    # Вместо имени пользователя клиент может запросить машиночитаемый режим
+    if username.lower() == "mode json":
+        await JsonConnection(reader, writer).serve()
+        writer.close()
+        return
 
-    # Если пользователь существует, получаем его идентификатор
-    if user_exists[0] > 0:
-        async with aiosqlite.connect(DATABASE_NAME) as db:
-            cursor = await db.execute(
-                "SELECT client_id FROM users WHERE username = ?",
-                (username,)
-            )
-            client_id = await cursor.fetchone()
-            await cursor.close()
-        client_id = client_id[0]
+    # Ищем пользователя и характеристики его машины одним запросом (или в кэше)
+    client_id, spec = await lookup_user(username)
+    if client_id is not None:
         # Сообщаем, что пользователь найден, идет подключение к виртуальной машине
         writer.write(b"User found. Connecting to virtual machine...\r\n")
         await writer.drain()
     else:
-        # Если пользователь не существует, создаем нового пользователя и его виртуальную машину
-        client_id = str(uuid.uuid4())
-        await create_user(username, client_id)
-
+        # Если пользователь не существует, создаем нового пользователя и его виртуальную машину.
+        # Запись выполняется только после ввода всех характеристик: при обрыве связи во время
+        # ввода в базе не остается пользователя без машины
         writer.write(b"User not found. Creating virtual machine...\r\n")
         await writer.drain()
 
         # Запрашиваем у пользователя информацию о виртуальной машине (RAM, CPU, HDD)
-        writer.write(b"Enter RAM size: ")
-        await writer.drain()
-        ram_size = (await reader.readuntil(b'\n')).decode().strip()
-
-        writer.write(b"Enter CPU count: ")
-        await writer.drain()
-        cpu_count = (await reader.readuntil(b'\n')).decode().strip()
-
-        writer.write(b"Enter HDD size: ")
-        await writer.drain()
-        hdd_size = (await reader.readuntil(b'\n')).decode().strip()
+        ram_size = await read_resource_size(reader, writer, b"Enter RAM size: ")
+        cpu_count = await read_resource_size(reader, writer, b"Enter CPU count: ")
+        hdd_size = await read_resource_size(reader, writer, b"Enter HDD size: ")
 
         writer.write(b"Enter HDD ID: ")
         await writer.drain()
-        hdd_id = (await reader.readuntil(b'\n')).decode().strip()
+        hdd_id = (await read_line(reader)).decode().strip()
 
-        # Создаем виртуальную машину для нового пользователя
-        await create_client(client_id, ram_size, cpu_count, hdd_size, hdd_id)
-
-        writer.write(b"Client information saved\r\n")
+        # Создаем пользователя вместе с виртуальной машиной одной операцией записи
+        client_id = str(uuid.uuid4())
+        try:
+            await create_user_with_client(username, client_id, ram_size, cpu_count, hdd_size, hdd_id)
+            spec = (ram_size, cpu_count, hdd_size, hdd_id)
+            writer.write(b"Client information saved\r\n")
+        except sqlite3.IntegrityError:
+            # Пользователь с таким именем создан параллельным подключением: входим в его машину
+            client_id, spec = await lookup_user(username)
+            if client_id is None:
+                writer.write(b"Error: Failed to create virtual machine\r\n")
+                await writer.drain()
+                return
+            writer.write(b"User already exists. Connecting to virtual machine...\r\n")
         await writer.drain()
 
     # Сообщаем об успешной аутентификации
@@ -341,94 +3220,442 @@ async def handle_client(reader, writer):
     await writer.drain()
 
     # Добавляем текущее соединение в список активных соединений
-    await add_current_connection(client_id)
-
-    while True:
-        # Выводим меню команд для пользователя
-        writer.write(b"Type 'list_of_users_ever_connected' to see the list of ever connected clients\r\n")
-        writer.write(b"Type 'list_of_current_connections' to see the list of currently connected clients\r\n")
-        writer.write(b"Type 'list_of_hard_disks' to see the list of hard disks\r\n")
-        writer.write(b"Type 'remove_virtual_machine' to remove a virtual machine\r\n")
-        writer.write(b"Type 'update_client_info' to update client information\r\n")
-        writer.write(b"Type 'list_total_stats' to see the total statistics\r\n")
-        writer.write(b"Type 'exit' to exit\r\n")
+    session = await add_current_connection(client_id, username, writer, spec)
+    try:
+        # Меню команд отправляется один раз после входа и затем только по команде 'help'
+        writer.write(get_menu())
         await writer.drain()
 
-        # Считываем команду пользователя
-        command = (await reader.readuntil(b'\n')).decode().strip()
-
-        # Обработка команд
-        if command.lower() == 'list_of_users_ever_connected':
-            await handle_list_ever_connected_clients(reader, writer)
-        elif command.lower() == 'list_of_current_connections':
-            await handle_list_current_connections(reader, writer)
-        elif command.lower() == 'list_of_hard_disks':
-            await handle_list_hard_disks(reader, writer)
-        elif command.lower() == 'remove_virtual_machine':
-            await handle_remove_virtual_machine(reader, writer, client_id)
-        elif command.lower() == 'update_client_info':
-            await handle_update_client_info(reader, writer)
-        elif command.lower() == 'list_total_stats':
-            await handle_total_stats(reader, writer)
-        # Выход из цикла и сервера при вводе команды 'exit'
-        elif command.lower() == 'exit':
-            # Удаляем текущее соединение из списка активных соединений
-            await remove_current_connection(client_id)
-            writer.write(b"Disconnecting...\r\n")
-            await writer.drain()
+        while not writer.is_closing():
+            # Считываем команду пользователя
+            line = (await read_line(reader)).decode()
+            session.touch()
+            await dispatch_command(reader, writer, session, line)
+    finally:
+        # Сессия удаляется при любом завершении, в том числе при обрыве связи
+        await remove_current_connection(client_id, session)
+
+
+# Связь рабочего процесса с супервизором в режиме --workers.
+# Процессы обмениваются изменениями общего состояния (сессии, статистика) строками JSON через
+# Unix-сокет супервизора, который пересылает каждое сообщение остальным рабочим процессам.
+class ClusterLink:
+    def __init__(self, path, on_lost=None):
+        self.path = path
+        # Вызывается при потере связи с супервизором: рабочий процесс без супервизора завершается
+        self.on_lost = on_lost
+        self._reader = None
+        self._writer = None
+        self._task = None
+
+    # Подключение к супервизору и запуск приема сообщений. Супервизор начинает пересылать процессу
+    # изменения остальных процессов сразу после сообщения hello, еще до загрузки статистики
+    async def connect(self):
+        self._reader, self._writer = await asyncio.open_unix_connection(self.path)
+        self.send({"type": "hello", "pid": os.getpid()})
+        self._task = asyncio.create_task(self._read_loop())
+
+    # Сообщение супервизору о готовности принимать подключения
+    def ready(self):
+        self.send({"type": "ready", "pid": os.getpid()})
+
+    # Отправка сообщения без ожидания: сообщения короткие, а супервизор читает их постоянно
+    def send(self, event):
+        if self._writer is not None and not self._writer.is_closing():
+            self._writer.write(json.dumps(event).encode() + b"\n")
+
+    # Прием изменений от других рабочих процессов
+    async def _read_loop(self):
+        try:
+            async for line in self._reader:
+                try:
+                    apply_change(json.loads(line))
+                except Exception as e:
+                    print(f"Warning: failed to apply cluster event {line!r}: {e!r}")
+        except ConnectionError:
+            pass
+        if self.on_lost is not None:
+            self.on_lost()
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+        if self._writer is not None:
+            self._writer.close()
+
+
+# Связь с супервизором (None в режиме одного процесса)
+_cluster = None
+
+
+# Рассылка изменения другим рабочим процессам
+def publish_cluster_event(event):
+    if _cluster is not None:
+        _cluster.send(event)
+
+
+# Супервизор режима --workers: запускает рабочие процессы, слушающие один порт через SO_REUSEPORT,
+# пересылает между ними изменения общего состояния, перезапускает упавшие процессы
+# и выполняет поочередный (rolling) перезапуск по сигналу SIGHUP.
+class Supervisor:
+    def __init__(self, workers, worker_options):
+        self.workers = workers
+        self.worker_options = worker_options
+        self.hub_path = os.path.join(tempfile.mkdtemp(prefix="working_server_"), "hub.sock")
+        self._context = multiprocessing.get_context("spawn")
+        self._processes = {}
+        # Все запущенные и еще не остановленные процессы, включая заменяемые при перезапуске
+        self._running = set()
+        self._links = {}
+        self._ready = {}
+        # Текущие сессии каждого рабочего процесса: pid -> {client_id: сообщение session_added}
+        self._sessions = {}
+        self._stopping = False
+        self._restarting = False
+
+    # Запуск рабочего процесса с номером index
+    def _start_worker(self, index):
+        options = self.worker_options
+        if options.get("metrics_port") is not None:
+            # У каждого рабочего процесса собственный порт метрик: metrics_port + номер процесса
+            options = dict(options, metrics_port=options["metrics_port"] + index)
+        process = self._context.Process(target=run_worker, args=(self.hub_path, options))
+        process.start()
+        self._processes[index] = process
+        self._running.add(process)
+        self._ready[process.pid] = asyncio.Event()
+        return process
+
+    # Остановка рабочего процесса с ожиданием завершения его сессий
+    async def _stop_worker(self, process):
+        if process.is_alive():
+            process.terminate()
+        await asyncio.get_running_loop().run_in_executor(None, process.join)
+        self._ready.pop(process.pid, None)
+        self._running.discard(process)
+
+    # Прием сообщений от рабочего процесса и пересылка их остальным
+    async def _handle_worker(self, reader, writer):
+        pid = None
+        try:
+            async for line in reader:
+                event = json.loads(line)
+                kind = event["type"]
+                if kind == "hello":
+                    # Процесс получает изменения остальных процессов с момента подключения,
+                    # поэтому изменения, зафиксированные во время его запуска, не теряются
+                    pid = event["pid"]
+                    self._links[pid] = writer
+                    self._sessions.setdefault(pid, {})
+                    # Новый процесс получает сессии, обслуживаемые остальными процессами
+                    for other_sessions in self._sessions.values():
+                        for session_event in other_sessions.values():
+                            writer.write(json.dumps(session_event).encode() + b"\n")
+                    continue
+                if kind == "ready":
+                    if event["pid"] in self._ready:
+                        self._ready[event["pid"]].set()
+                    continue
+                if kind == "session_added":
+                    self._sessions.setdefault(pid, {})[event["client_id"]] = event
+                elif kind == "session_removed":
+                    self._sessions.get(pid, {}).pop(event["client_id"], None)
+                elif kind == "client_removed":
+                    for worker_sessions in self._sessions.values():
+                        worker_sessions.pop(event["client_id"], None)
+                self._broadcast(line, exclude=writer)
+        except (ConnectionError, json.JSONDecodeError) as e:
+            print(f"Warning: worker link error: {e!r}")
+        finally:
+            self._links.pop(pid, None)
+            # Сессии завершившегося процесса исключаются у остальных процессов
+            for client_id in self._sessions.pop(pid, {}):
+                self._broadcast(json.dumps({"type": "session_removed", "client_id": client_id}).encode() + b"\n")
             writer.close()
-            break
-        else:
-            # Отправляем сообщение об ошибке при вводе неизвестной команды
-            writer.write(b"Error: Unknown command\r\n")
-            await writer.drain()
 
+    def _broadcast(self, line, exclude=None):
+        for writer in list(self._links.values()):
+            if writer is not exclude and not writer.is_closing():
+                writer.write(line)
 
-# Основная асинхронная функция
-async def main():
-    async with aiosqlite.connect(DATABASE_NAME) as db:
-        # Создаем таблицы, если они не существуют
-        await db.execute(
-            """
-            CREATE TABLE IF NOT EXISTS users (
-                username TEXT PRIMARY KEY,
-                client_id TEXT UNIQUE
-            )
-            """
-        )
-        await db.execute(
-            """
-            CREATE TABLE IF NOT EXISTS clients (
-                client_id TEXT PRIMARY KEY,
-                ram_size TEXT,
-                cpu_count TEXT,
-                hdd_size TEXT,
-                hdd_id TEXT
-            )
-            """
-        )
-        await db.execute(
-            """
-            CREATE TABLE IF NOT EXISTS current_connections (
-                client_id TEXT PRIMARY KEY
-            )
-            """
-        )
+    # Поочередный перезапуск: новый процесс начинает принимать подключения до остановки старого
+    async def rolling_restart(self):
+        if self._restarting:
+            return
+        self._restarting = True
+        try:
+            for index in sorted(self._processes):
+                if self._stopping:
+                    return
+                old = self._processes[index]
+                new = self._start_worker(index)
+                try:
+                    await asyncio.wait_for(self._ready[new.pid].wait(), WORKER_START_TIMEOUT)
+                except asyncio.TimeoutError:
+                    print(f"Worker {new.pid} did not become ready, keeping worker {old.pid}")
+                    self._processes[index] = old
+                    await self._stop_worker(new)
+                    return
+                print(f"Worker {index}: {old.pid} replaced by {new.pid}")
+                await self._stop_worker(old)
+        finally:
+            self._restarting = False
+
+    # Перезапуск неожиданно завершившихся рабочих процессов
+    async def _monitor(self):
+        while not self._stopping:
+            await asyncio.sleep(0.5)
+            if self._restarting:
+                continue
+            for index, process in list(self._processes.items()):
+                if not process.is_alive() and not self._stopping:
+                    print(f"Worker {process.pid} exited with code {process.exitcode}, restarting")
+                    self._ready.pop(process.pid, None)
+                    self._running.discard(process)
+                    self._start_worker(index)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        stop = asyncio.Event()
+        loop.add_signal_handler(signal.SIGTERM, stop.set)
+        loop.add_signal_handler(signal.SIGINT, stop.set)
+        restart_tasks = set()
+
+        def restart():
+            task = asyncio.create_task(self.rolling_restart())
+            restart_tasks.add(task)
+            task.add_done_callback(restart_tasks.discard)
+
+        loop.add_signal_handler(signal.SIGHUP, restart)
+
+        hub = await asyncio.start_unix_server(self._handle_worker, self.hub_path)
+        for index in range(self.workers):
+            self._start_worker(index)
+        monitor = asyncio.create_task(self._monitor())
+        print(f"Supervisor {os.getpid()} started {self.workers} workers "
+              f"on {self.worker_options['host']}:{self.worker_options['port']}")
+
+        try:
+            await stop.wait()
+        finally:
+            self._stopping = True
+            monitor.cancel()
+            for task in restart_tasks:
+                task.cancel()
+            await asyncio.gather(*(self._stop_worker(process) for process in list(self._running)))
+            hub.close()
+            with contextlib.suppress(OSError):
+                os.unlink(self.hub_path)
+                os.rmdir(os.path.dirname(self.hub_path))
+
+
+# Точка входа рабочего процесса
+def run_worker(hub_path, options):
+    # Остановкой по Ctrl+C управляет супервизор
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(main(cluster_path=hub_path, reuse_port=True, **options))
+
+
+# Функция для подготовки базы данных до запуска рабочих процессов
+async def prepare_database(database):
+    async with aiosqlite.connect(database) as db:
+        await migrate_database(db)
+        await db.execute("DELETE FROM current_connections")
         await db.commit()
 
+
+# Запуск сервера в режиме нескольких рабочих процессов
+def run_workers(workers, **options):
+    if not hasattr(socket, "SO_REUSEPORT"):
+        raise RuntimeError("--workers requires SO_REUSEPORT support (Linux, BSD or macOS)")
+    asyncio.run(prepare_database(options.get("database") or DATABASE_NAME))
+    asyncio.run(Supervisor(workers, options).run())
+
+
+# Основная асинхронная функция
+async def main(pool_size=POOL_SIZE, pool_timeout=POOL_TIMEOUT, write_batch_delay=WRITE_BATCH_DELAY,
+               write_batch_size=WRITE_BATCH_SIZE, stats_check_interval=STATS_CHECK_INTERVAL,
+               connections_snapshot_interval=CONNECTIONS_SNAPSHOT_INTERVAL, host=HOST, port=PORT, database=None,
+               reuse_port=False, cluster_path=None, shutdown_timeout=WORKER_SHUTDOWN_TIMEOUT, metrics_port=None,
+               slow_command_threshold=None, slow_command_sample_rate=1.0, cache_size=CACHE_SIZE,
+               cache_ttl=CACHE_TTL, max_line_length=MAX_LINE_LENGTH, listen_backlog=LISTEN_BACKLOG,
+               storage=STORAGE_BACKEND, **connection_limits):
+    global _cluster
+
+    configure_caches(cache_size, cache_ttl)
+
+    # Ограничения подключений; каждому подключению нужен файловый дескриптор
+    limiter = init_connection_limiter(**connection_limits)
+    if limiter.max_sessions is not None:
+        raise_open_files_limit(limiter.max_sessions + (limiter.queue_size if limiter.policy == "queue" else 0) + 256)
+
+    # Включаем метрики, если указан порт экспортера
+    metrics_server = None
+    if metrics_port is not None:
+        init_metrics(slow_command_threshold, slow_command_sample_rate)
+        metrics_server = await start_metrics_server(host, metrics_port, reuse_port)
+        print(f"Metrics on http://{host}:{metrics_port}/metrics (pid {os.getpid()})")
+
+    # Открываем хранилище, которым пользуются все функции работы с данными. Для SQLite это общий пул
+    # соединений, миграция схемы и задача-писатель, через которую проходят все изменения базы данных
+    if storage == "sqlite":
+        await init_storage(storage, database=database or DATABASE_NAME, pool_size=pool_size,
+                           pool_timeout=pool_timeout, write_batch_delay=write_batch_delay,
+                           write_batch_size=write_batch_size)
+    else:
+        await init_storage(storage)
+
     # Очищаем текущие подключения перед запуском сервера
-    await clear_current_connections()
+    # (в режиме нескольких процессов таблицу очищает супервизор)
+    if cluster_path is None:
+        await clear_current_connections()
+
+    # Подключаемся к супервизору до загрузки статистики, чтобы не пропустить изменения других процессов:
+    # изменения, пришедшие во время загрузки, применяются к загруженной статистике
+    stop = asyncio.Event()
+    if cluster_path is not None:
+        _cluster = ClusterLink(cluster_path, on_lost=stop.set)
+        await _cluster.connect()
+
+    # Запускаем периодическое сохранение снимка текущих подключений, если оно включено
+    snapshot_task = None
+    if connections_snapshot_interval:
+        snapshot_task = asyncio.create_task(snapshot_current_connections_periodically(connections_snapshot_interval))
+
+    # Загружаем агрегированную статистику и запускаем ее периодическую сверку с базой
+    await init_total_stats()
+    stats_check_task = None
+    if stats_check_interval:
+        # Изменение другого процесса, зафиксированное до начала загрузки, но полученное во время нее,
+        # учитывается дважды, поэтому в режиме нескольких процессов первая сверка выполняется сразу после запуска
+        stats_check_task = asyncio.create_task(check_total_stats_periodically(
+            stats_check_interval, STATS_CONFIRM_DELAY if _cluster is not None else None))
 
     # Запускаем сервер на указанном адресе и порте
     server = await asyncio.start_server(
-        handle_client, '127.0.0.1', 8888)
+        handle_client, host, port, reuse_port=reuse_port or None, limit=max_line_length, backlog=listen_backlog)
 
     addr = server.sockets[0].getsockname()
-    print(f'Serving on {addr}')
+    print(f'Serving on {addr} (pid {os.getpid()})')
+
+    # Остановка по SIGTERM: новые подключения больше не принимаются, текущие сессии получают
+    # shutdown_timeout секунд на завершение
+    with contextlib.suppress(NotImplementedError, AttributeError):
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop.set)
+    if _cluster is not None:
+        _cluster.ready()
+
+    try:
+        async with server:
+            await stop.wait()
+            server.close()
+            deadline = time.monotonic() + shutdown_timeout
+            while len(sessions) and time.monotonic() < deadline:
+                await asyncio.sleep(0.1)
+            for session in sessions:
+                if session.writer is not None:
+                    session.writer.close()
+    finally:
+        for task in (stats_check_task, snapshot_task):
+            if task is not None:
+                task.cancel()
+        if metrics_server is not None:
+            metrics_server.close()
+            close_metrics()
+        if _cluster is not None:
+            cluster, _cluster = _cluster, None
+            await cluster.close()
+        await close_storage()
+
+
+# Разбор аргументов командной строки
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Virtual machine management server")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--database", default=DATABASE_NAME)
+    parser.add_argument("--storage", choices=STORAGE_BACKENDS, default=STORAGE_BACKEND,
+                        help="where data is kept: the SQLite --database or process memory (lost on exit)")
+    parser.add_argument("--pool-size", type=int, default=POOL_SIZE,
+                        help="read connections to the SQLite database per process")
+    parser.add_argument("--pool-timeout", type=float, default=POOL_TIMEOUT,
+                        help="seconds a command may wait for a free read connection")
+    parser.add_argument("--write-batch-delay", type=float, default=WRITE_BATCH_DELAY,
+                        help="seconds the writer waits to group more changes into one transaction")
+    parser.add_argument("--write-batch-size", type=int, default=WRITE_BATCH_SIZE,
+                        help="largest number of changes committed in one transaction")
+    parser.add_argument("--stats-check-interval", type=float, default=STATS_CHECK_INTERVAL,
+                        help="seconds between checks of the aggregated statistics against the database (0 - never)")
+    parser.add_argument("--connections-snapshot-interval", type=float, default=CONNECTIONS_SNAPSHOT_INTERVAL,
+                        help="seconds between snapshots of the current connections to the database (default: none)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of worker processes sharing the port via SO_REUSEPORT "
+                             "(SIGHUP to the supervisor restarts them one by one)")
+    parser.add_argument("--shutdown-timeout", type=float, default=WORKER_SHUTDOWN_TIMEOUT,
+                        help="seconds given to open sessions on SIGTERM before they are closed")
+    parser.add_argument("--max-sessions", type=int, default=MAX_SESSIONS,
+                        help="maximum concurrent connections per process (0 - unlimited)")
+    parser.add_argument("--accept-policy", choices=("queue", "reject"), default=ACCEPT_POLICY,
+                        help="what to do with connections over --max-sessions")
+    parser.add_argument("--accept-queue-size", type=int, default=ACCEPT_QUEUE_SIZE,
+                        help="connections allowed to wait for a free slot with --accept-policy queue")
+    parser.add_argument("--accept-queue-timeout", type=float, default=ACCEPT_QUEUE_TIMEOUT,
+                        help="seconds a connection may wait for a free slot")
+    parser.add_argument("--idle-timeout", type=float, default=IDLE_TIMEOUT,
+                        help="seconds to wait for the next line from a client (0 - forever)")
+    parser.add_argument("--write-high-watermark", type=int, default=WRITE_HIGH_WATERMARK,
+                        help="bytes buffered for a client before writes wait for it to read")
+    parser.add_argument("--write-low-watermark", type=int, default=WRITE_LOW_WATERMARK,
+                        help="bytes buffered for a client at which writing resumes")
+    parser.add_argument("--write-timeout", type=float, default=WRITE_TIMEOUT,
+                        help="seconds a client may leave a full write buffer unread before it is disconnected")
+    parser.add_argument("--max-line-length", type=int, default=MAX_LINE_LENGTH,
+                        help="longest accepted request line in bytes")
+    parser.add_argument("--backlog", type=int, default=LISTEN_BACKLOG, help="listen queue length")
+    parser.add_argument("--cache-size", type=int, default=CACHE_SIZE,
+                        help="entries in each of the user and client lookup caches (0 disables caching)")
+    parser.add_argument("--cache-ttl", type=float, default=CACHE_TTL, help="lifetime of a cache entry in seconds")
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="serve Prometheus metrics on this port (with --workers N, worker i uses port + i)")
+    parser.add_argument("--slow-command-ms", type=float, default=None,
+                        help="with --metrics-port, print sampled commands slower than this together with their SQL")
+    parser.add_argument("--slow-command-sample", type=float, default=1.0,
+                        help="share of commands traced for the slow command log (0..1)")
+    return parser.parse_args(argv)
 
-    async with server:
-        await server.serve_forever()
 
 # Запуск основной асинхронной функции
 if __name__ == "__main__":
-    asyncio.run(main())
+    args = parse_args()
+    options = dict(
+        max_sessions=args.max_sessions or None,
+        policy=args.accept_policy,
+        queue_size=args.accept_queue_size,
+        queue_timeout=args.accept_queue_timeout,
+        idle_timeout=args.idle_timeout or None,
+        write_high=args.write_high_watermark,
+        write_low=args.write_low_watermark,
+        write_timeout=args.write_timeout or None,
+        max_line_length=args.max_line_length,
+        listen_backlog=args.backlog,
+        cache_size=args.cache_size,
+        cache_ttl=args.cache_ttl,
+        metrics_port=args.metrics_port,
+        slow_command_threshold=args.slow_command_ms / 1000 if args.slow_command_ms is not None else None,
+        slow_command_sample_rate=args.slow_command_sample,
+        storage=args.storage,
+        pool_size=args.pool_size,
+        pool_timeout=args.pool_timeout,
+        write_batch_delay=args.write_batch_delay,
+        write_batch_size=args.write_batch_size,
+        stats_check_interval=args.stats_check_interval or None,
+        connections_snapshot_interval=args.connections_snapshot_interval or None,
+    )
+    if args.workers > 1 and args.storage != "sqlite":
+        raise SystemExit("Error: --workers needs the shared sqlite storage")
+    if args.workers > 1:
+        run_workers(args.workers, host=args.host, port=args.port, database=args.database,
+                    shutdown_timeout=args.shutdown_timeout, **options)
+    else:
+        asyncio.run(main(host=args.host, port=args.port, database=args.database,
+                         shutdown_timeout=args.shutdown_timeout, **options))